@@ -7,7 +7,7 @@ import logging
 
 import eventlet
 
-from flask import Flask
+from flask import Flask, request
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -42,6 +42,10 @@ migrate = Migrate(app, db)
 # we import this here so it is picked by alembic
 from local_api.apiv1 import models
 from local_api.apiv1 import utils
+from local_api.apiv1 import broadcast
+from local_api.apiv1 import cache
+from local_api.apiv1 import event
+from local_api.apiv1 import telemetry
 # login manager setup
 from local_api.apiv1 import auth
 login_manager = LoginManager()
@@ -54,57 +58,36 @@ app.register_blueprint(api_blueprint, url_prefix='/api/v1')
 
 
 NS_SIM_CONNECTIVITY = '/sim-connectivity'
+ALERT_NAMESPACES = ['/dashboard', '/diagnostics']
 
 socketio = SocketIO(app)
 
-connected_clients = 0
+BROADCASTS = dict(
+    (namespace, broadcast.Broadcast(namespace, event_name, payload,
+                                    socketio.emit))
+    for namespace, event_name, payload in [
+        ('/dashboard', 'system', utils.get_system_state),
+        ('/diagnostics', 'diagnostics', utils.get_diagnostics_state),
+    ])
 
 
-def update_client_count(direction):
-    """Update connected websocket client count
-
-    We only send data downstream if there are connected clients.
-    """
-    global connected_clients
-    connected_clients += direction
-    app.logger.info('updated connected clients to: %d', connected_clients)
-
-
-def send_system_state():
-    """Sends system state payload to connected websocket clients.
-
-    Also, queues up the next task to send system state.
+def send_alert(name, **alert):
+    """Pushes an alert raised or cleared to connected websocket clients.
 
     :return: None
     """
-    global connected_clients
-    if connected_clients > 0:
-        socketio.emit('system', utils.get_system_state(), namespace='/dashboard')
-        eventlet.call_after_global(5, send_system_state)
-    else:
-        app.logger.info('skipping sending system state | no clients conected')
+    for namespace in ALERT_NAMESPACES:
+        socketio.emit('alert', alert, namespace=namespace)
 
 
-def send_diagnostics_state():
-    """Sends device diagnostics state payload to connected websocket clients.
-
-    Also, queues up the next task to send diagnostic data.
-
-    :return: None
-    """
-    global connected_clients
-    if connected_clients > 0:
-        socketio.emit('diagnostics', utils.get_diagnostics_data(), namespace='/diagnostics')
-        eventlet.call_after_global(5, send_diagnostics_state)
-    else:
-        app.logger.info('skipping sending diagnostic data | no connected clients')
+event.subscribe(event.ALERT_RAISED, send_alert)
+event.subscribe(event.ALERT_CLEARED, send_alert)
 
 
 @socketio.on('connect', namespace='/dashboard')
 @auth.authenticated_only
 def on_dashboard_connect():
-    update_client_count(1)
-    eventlet.call_after_global(5, send_system_state)
+    BROADCASTS['/dashboard'].subscribe(request.sid)
     app.logger.info('user connected / dashboard')
     socketio.emit('message', {'data': 'READY'}, namespace='/dashboard')
 
@@ -112,25 +95,45 @@ def on_dashboard_connect():
 @socketio.on('connect', namespace='/diagnostics')
 @auth.authenticated_only
 def on_diagnostic_connect():
-    update_client_count(1)
-    eventlet.call_after_global(5, send_diagnostics_state)
+    BROADCASTS['/diagnostics'].subscribe(request.sid)
     app.logger.info('user connected / diagnostics')
     socketio.emit('message', {'data': 'READY'}, namespace='/diagnostics')
 
 
+@socketio.on('resync', namespace='/dashboard')
+@auth.authenticated_only
+def on_dashboard_resync():
+    BROADCASTS['/dashboard'].resync(request.sid)
+
+
+@socketio.on('resync', namespace='/diagnostics')
+@auth.authenticated_only
+def on_diagnostic_resync():
+    BROADCASTS['/diagnostics'].resync(request.sid)
+
 
 @socketio.on('connect', namespace=NS_SIM_CONNECTIVITY)
 @auth.authenticated_only
 def on_sim_connectivity_connect():
-    update_client_count(1)
     app.logger.info('user connected / sim-connectivity')
     socketio.emit('message', {'data': 'READY'}, namespace=NS_SIM_CONNECTIVITY)
 
 
-@socketio.on('disconnect')
-def on_disconnect():
-    update_client_count(-1)
-    app.logger.info('websocket client disconnected')
+@socketio.on('disconnect', namespace='/dashboard')
+def on_dashboard_disconnect():
+    BROADCASTS['/dashboard'].unsubscribe(request.sid)
+    app.logger.info('websocket client disconnected / dashboard')
+
+
+@socketio.on('disconnect', namespace='/diagnostics')
+def on_diagnostic_disconnect():
+    BROADCASTS['/diagnostics'].unsubscribe(request.sid)
+    app.logger.info('websocket client disconnected / diagnostics')
+
+
+@socketio.on('disconnect', namespace=NS_SIM_CONNECTIVITY)
+def on_sim_connectivity_disconnect():
+    app.logger.info('websocket client disconnected / sim-connectivity')
 
 
 def get_retail_registration_token():
@@ -159,5 +162,8 @@ def get_retail_registration_token():
 
 
 def create_app():
+    cache.load_snapshot()
+    socketio.start_background_task(utils.warm_up_cache)
+    telemetry.start()
     socketio.start_background_task(get_retail_registration_token)
     return app
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Threshold alerts on sampled device metrics.
+
+Each sample is checked against the rules of its metric as it arrives. A
+rule raises an alert once the value reaches its threshold and clears it
+once the value has dropped `HYSTERESIS` below it, so that a reading
+hovering around the threshold does not flap. Raising and clearing
+publish `event.ALERT_RAISED` and `event.ALERT_CLEARED`.
+"""
+
+from collections import namedtuple
+
+from . import event
+from . import stats
+
+LOG = __import__('logging').getLogger()
+
+WARNING = 'warning'
+CRITICAL = 'critical'
+HYSTERESIS = 3
+
+Rule = namedtuple('Rule', ['metric', 'level', 'threshold'])
+
+# degrees celsius
+RULES = [
+    Rule('cpu_temperature', WARNING, 80),
+    Rule('cpu_temperature', CRITICAL, 95),
+    Rule('modem_temperature', WARNING, 70),
+    Rule('modem_temperature', CRITICAL, 85),
+    Rule('battery_temperature', WARNING, 50),
+    Rule('battery_temperature', CRITICAL, 60),
+]
+
+
+class Alerts(object):
+    """Evaluates rules on samples and keeps the alerts raised
+
+    :param list(Rule) rules: the rules
+    """
+
+    def __init__(self, rules=RULES):
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.metric, []).append(rule)
+        # rule -> alert
+        self.active = {}
+
+    def evaluate(self, metric, value, sampled_at):
+        """Checks a sample of `metric` against its rules
+
+        :return: list(dict) the alerts raised or cleared by the sample
+        """
+        changes = []
+        for rule in self.rules.get(metric, []):
+            alert = self.active.get(rule)
+            if alert is None and value >= rule.threshold:
+                alert = self.active[rule] = dict(
+                    metric=metric, level=rule.level,
+                    threshold=rule.threshold, value=value,
+                    raised_at=stats.format_timestamp(sampled_at),
+                    active=True)
+                LOG.warning('Alert raised: %s %s at %s', rule.level, metric,
+                            value)
+                event.publish(event.ALERT_RAISED, **alert)
+                changes.append(alert)
+            elif alert is not None:
+                if value > rule.threshold - HYSTERESIS:
+                    alert['value'] = value
+                    continue
+                del self.active[rule]
+                alert = dict(alert, value=value, active=False,
+                             cleared_at=stats.format_timestamp(sampled_at))
+                LOG.info('Alert cleared: %s %s at %s', rule.level, metric,
+                         value)
+                event.publish(event.ALERT_CLEARED, **alert)
+                changes.append(alert)
+        return changes
+
+    def get_active(self):
+        """Gets the alerts currently raised, oldest first
+
+        :return: list(dict)
+        """
+        return sorted(self.active.values(),
+                      key=lambda alert: (alert['raised_at'], alert['metric']))
+
+
+ALERTS = Alerts()
+
+
+def evaluate(metric, value, sampled_at):
+    return ALERTS.evaluate(metric, value, sampled_at)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Periodic pushes of state to the websocket clients of a namespace.
+
+A namespace has a single loop whatever the number of clients connected
+to it: the first subscriber starts it, and it stops once the last one
+has left. Each tick computes the payload once for every client of the
+namespace.
+
+Rather than the whole state every tick, clients get what changed since
+the previous push. The state last pushed is kept with a sequence number
+and each tick emits, as `<event>_patch`, only the keys that changed
+(nested dicts are compared key by key, other values replaced whole) and
+the paths of the keys removed, numbered with the next sequence number.
+Lists whose items change are best pushed as dicts keyed by item, e.g.
+the diagnostics clients by MAC address. Nothing is sent when nothing
+changed. The whole state goes out as
+`<event>` to a client when it connects and whenever it asks for it with
+a `resync`, e.g. on seeing a gap in the sequence numbers. When the state
+cannot be computed the last one is sent rather than nothing; clients ask
+again if no state comes at all.
+"""
+
+import copy
+
+import eventlet
+
+LOG = __import__('logging').getLogger()
+
+INTERVAL = 5
+
+
+def make_patch(old, new, path=()):
+    """Gets the changes from dict `old` to dict `new`
+
+    :return: (dict, list(list)) the keys changed with their new values,
+        a patch of its own for a nested dict, and the paths of the keys
+        removed
+    """
+    patch = {}
+    removed = []
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changes, gone = make_patch(old[key], value, path + (key,))
+            if changes:
+                patch[key] = changes
+            removed.extend(gone)
+        elif old[key] != value:
+            patch[key] = value
+    removed.extend(list(path + (key,)) for key in old if key not in new)
+    return (patch, removed)
+
+
+def apply_patch(state, patch, removed=()):
+    """Applies the changes of `make_patch` to a copy of `state`
+
+    :return: dict
+    """
+    state = dict(state)
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(state.get(key), dict):
+            value = apply_patch(state[key], value)
+        state[key] = value
+    for path in removed:
+        parent = state
+        for key in path[:-1]:
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+        parent.pop(path[-1], None)
+    return state
+
+
+class Broadcast(object):
+    """Pushes the changes of `payload()` to a namespace every `interval`
+    seconds while it has subscribers
+
+    :param str namespace: socket.io namespace e.g. `/dashboard`
+    :param str event: event name of the whole state e.g. `system`
+    :param callable payload: computes the state
+    :param callable emit: emits to the clients, as `SocketIO.emit`
+    :param float interval: seconds between pushes
+    """
+
+    def __init__(self, namespace, event, payload, emit, interval=INTERVAL):
+        self.namespace = namespace
+        self.event = event
+        self.payload = payload
+        self.emit = emit
+        self.interval = interval
+        # session ids of the clients subscribed
+        self.subscribers = set()
+        # the state last pushed and its sequence number
+        self.state = None
+        self.seq = 0
+        self._loop = None
+
+    @property
+    def running(self):
+        return self._loop is not None and not self._loop.dead
+
+    def subscribe(self, sid):
+        """Adds a client and sends it the whole state, starting the loop if
+        it is the first one
+        """
+        self.subscribers.add(sid)
+        if not self.running:
+            LOG.info('Starting %s broadcast', self.namespace)
+            # out of date since the last client left, kept if it cannot be
+            # computed afresh
+            self._refresh()
+            self._loop = eventlet.spawn(self._run)
+        self.resync(sid)
+
+    def unsubscribe(self, sid):
+        """Removes a client, the loop stopping at its next tick if it was
+        the last one
+        """
+        self.subscribers.discard(sid)
+
+    def _compute(self):
+        try:
+            return copy.deepcopy(self.payload())
+        except Exception as e:
+            LOG.error('Failed to compute %s state: %r', self.namespace, e)
+            return None
+
+    def _refresh(self):
+        # computes the whole state, keeping the last one on failure
+        state = self._compute()
+        if state is None:
+            return False
+        self.state = state
+        self.seq += 1
+        return True
+
+    def resync(self, sid=None):
+        """Sends the whole state to client `sid`, or to every client
+
+        Nothing is sent if no state could be computed yet; the loop tries
+        again at its next tick.
+        """
+        if self.state is None and not self._refresh():
+            return
+        kwargs = dict(namespace=self.namespace)
+        if sid is not None:
+            kwargs['room'] = sid
+        try:
+            self.emit(self.event, dict(seq=self.seq, state=self.state),
+                      **kwargs)
+        except Exception as e:
+            LOG.error('Failed to resync %s: %r', self.namespace, e)
+
+    def tick(self):
+        """Computes the state and pushes what changed to the namespace
+        """
+        if self.state is None:
+            return self.resync()
+        state = self._compute()
+        if state is None:
+            return
+        patch, removed = make_patch(self.state, state)
+        if not patch and not removed:
+            return
+        self.state = state
+        self.seq += 1
+        message = dict(seq=self.seq, patch=patch)
+        if removed:
+            message['removed'] = removed
+        try:
+            self.emit(self.event + '_patch', message,
+                      namespace=self.namespace)
+        except Exception as e:
+            LOG.error('Failed to broadcast %s: %r', self.namespace, e)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            if not self.subscribers:
+                LOG.info('Stopping %s broadcast | no clients connected',
+                         self.namespace)
+                return
+            self.tick()
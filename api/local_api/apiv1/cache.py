@@ -4,56 +4,781 @@
 Utilities for interacting with the filesystem.
 """
 
+import hashlib
+import inspect
 import os
+import sqlite3
+import time
 
+from collections import namedtuple, OrderedDict
 from functools import wraps
-from werkzeug.contrib.cache import SimpleCache, NullCache
+import eventlet
+from eventlet.corolocal import local
+from eventlet.event import Event
+from werkzeug.contrib.cache import BaseCache, NullCache
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from . import event
 
 
 LOG = __import__('logging').getLogger()
 
 MINUTE = 60
-CACHE = SimpleCache()
+KB = 1024
+# byte budget of each cache namespace unless listed in NAMESPACE_BUDGETS
+DEFAULT_BUDGET = 64 * KB
+DEFAULT_NAMESPACE = 'default'
+# seconds to cache falsy results (e.g. `{}` on a read failure) unless the
+# function gives a `negative_ttl`
+DEFAULT_NEGATIVE_TTL = 15
+NAMESPACE_BUDGETS = {
+    'local_api.apiv1.sim/get_modem_network_info': 16 * KB,
+}
+
+
+def get_namespace(key):
+    """Gets the namespace of a cache key.
+
+    Keys are `<namespace>/<id>`: cached functions use their namespace (see
+    `make_key`), other callers a fixed one e.g. `login_attempts`. Keys
+    without a namespace share `DEFAULT_NAMESPACE`.
+
+    Returns:
+        str: The namespace
+
+    """
+    if '/' in key:
+        return key.rsplit('/', 1)[0]
+    return DEFAULT_NAMESPACE
+
+
+class LRUCache(BaseCache):
+    """In-memory cache with LRU eviction under per-namespace byte budgets.
+
+    Values are stored pickled so that their size can be accounted for.
+    Once a namespace goes over its budget its least recently used entries
+    are evicted; other namespaces are unaffected. Hits, misses and
+    evictions are counted per namespace (see `get_stats`) for as long as
+    it holds entries: a namespace is only created by a write and is
+    dropped, counters included, once emptied.
+
+    Args:
+        default_timeout (int): Timeout used when `set` is given none
+        budget (int): Default byte budget of a namespace
+        budgets (dict, optional): Byte budgets of specific namespaces
+
+    """
+
+    def __init__(self, default_timeout=300, budget=DEFAULT_BUDGET,
+                 budgets=None):
+        super(LRUCache, self).__init__(default_timeout)
+        self.budget = budget
+        self.budgets = budgets or {}
+        # namespace -> OrderedDict(key -> (expires, data)), oldest first
+        self._spaces = {}
+        self._stats = {}
+
+    def _space(self, key, create=False):
+        namespace = get_namespace(key)
+        space = self._spaces.get(namespace)
+        if space is None and create:
+            space = self._spaces[namespace] = OrderedDict()
+            self._stats[namespace] = dict(
+                hits=0, misses=0, evictions=0, bytes=0)
+        return namespace, space
+
+    def _drop(self, namespace, space, key):
+        _, data = space.pop(key)
+        self._stats[namespace]['bytes'] -= len(key) + len(data)
+
+    def _release(self, namespace, space):
+        if not space:
+            del self._spaces[namespace]
+            del self._stats[namespace]
+
+    def get(self, key):
+        namespace, space = self._space(key)
+        if space is None:
+            return None
+        stats = self._stats[namespace]
+        item = space.pop(key, None)
+        if item is None:
+            stats['misses'] += 1
+            return None
+        expires, data = item
+        if expires and expires <= time.time():
+            stats['bytes'] -= len(key) + len(data)
+            stats['misses'] += 1
+            self._release(namespace, space)
+            return None
+        # re-insert as most recently used
+        space[key] = item
+        stats['hits'] += 1
+        return pickle.loads(data)
+
+    def has(self, key):
+        _, space = self._space(key)
+        item = space.get(key) if space is not None else None
+        return item is not None and not (item[0] and item[0] <= time.time())
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        expires = (time.time() + timeout) if timeout else 0
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        namespace, space = self._space(key, create=True)
+        stats = self._stats[namespace]
+        budget = self.budgets.get(namespace, self.budget)
+        if key in space:
+            self._drop(namespace, space, key)
+        size = len(key) + len(data)
+        if size > budget:
+            LOG.warn('Not caching %s: %d bytes is over budget', key, size)
+            self._release(namespace, space)
+            return False
+        now = time.time()
+        for old_key in list(space):
+            if stats['bytes'] + size <= budget:
+                break
+            old_expires = space[old_key][0]
+            self._drop(namespace, space, old_key)
+            if not old_expires or old_expires > now:
+                stats['evictions'] += 1
+        space[key] = (expires, data)
+        stats['bytes'] += size
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout=timeout)
+
+    def delete(self, key):
+        namespace, space = self._space(key)
+        if space is None or key not in space:
+            return False
+        self._drop(namespace, space, key)
+        self._release(namespace, space)
+        return True
+
+    def inc(self, key, delta=1):
+        """Increments the value of `key`, keeping its expiry
+        """
+        _, space = self._space(key)
+        item = space.get(key) if space is not None else None
+        if item is None or (item[0] and item[0] <= time.time()):
+            value = delta
+            timeout = None
+        else:
+            value = pickle.loads(item[1]) + delta
+            timeout = (item[0] - time.time()) if item[0] else 0
+        return value if self.set(key, value, timeout=timeout) else None
+
+    def delete_namespace(self, namespace):
+        """Deletes every entry of `namespace`
+        """
+        self._spaces.pop(namespace, None)
+        self._stats.pop(namespace, None)
+        return True
+
+    def clear(self):
+        self._spaces.clear()
+        self._stats.clear()
+        return True
+
+    def get_stats(self):
+        """Gets the counters of every namespace
+
+        Returns:
+            dict: namespace -> dict(hits, misses, evictions, bytes, entries)
+
+        """
+        stats = {}
+        for namespace, counters in self._stats.items():
+            stats[namespace] = dict(
+                counters, entries=len(self._spaces[namespace]))
+        return stats
+
+
+class SQLiteCache(BaseCache):
+    """Cache shared by several processes through a SQLite (WAL) database.
+
+    Every read-modify-write runs in an immediate transaction so that
+    workers see each other's writes atomically. Entries expire like in
+    `LRUCache` and each namespace is held to its byte budget by evicting
+    its least recently read entries. Hit, miss and eviction counters are
+    kept per process.
+
+    Args:
+        path (str): Path of the database file, ideally on tmpfs
+        default_timeout (int): Timeout used when `set` is given none
+        budget (int): Default byte budget of a namespace
+        budgets (dict, optional): Byte budgets of specific namespaces
+
+    """
+
+    def __init__(self, path, default_timeout=300, budget=DEFAULT_BUDGET,
+                 budgets=None):
+        super(SQLiteCache, self).__init__(default_timeout)
+        self.path = path
+        self.budget = budget
+        self.budgets = budgets or {}
+        self._conn = None
+        self._pid = None
+        self._stats = {}
+
+    @property
+    def conn(self):
+        # connections must not be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._enable_wal(conn)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, namespace TEXT NOT NULL, '
+                'expires REAL NOT NULL, accessed REAL NOT NULL, '
+                'size INTEGER NOT NULL, value BLOB NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_namespace '
+                         'ON cache (namespace, accessed)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _enable_wal(conn, attempts=50):
+        # switching the journal mode does not wait on the busy timeout, so
+        # workers starting together may find the database locked
+        for attempt in range(attempts):
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                return
+            except sqlite3.OperationalError:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.1)
+
+    def _count(self, key, counter):
+        namespace = get_namespace(key)
+        stats = self._stats.setdefault(
+            namespace, dict(hits=0, misses=0, evictions=0))
+        stats[counter] += 1
+
+    def _transaction(self):
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def _read(self, conn, key):
+        """Reads the unexpired `(expires, value)` of `key` or None
+        """
+        row = conn.execute('SELECT expires, value FROM cache WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        expires, data = row
+        if expires and expires <= time.time():
+            return None
+        return (expires, pickle.loads(bytes(data)))
+
+    def _write(self, conn, key, value, expires):
+        """Writes `key` and evicts entries over the namespace's budget
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        namespace = get_namespace(key)
+        budget = self.budgets.get(namespace, self.budget)
+        size = len(key) + len(data)
+        if size > budget:
+            LOG.warn('Not caching %s: %d bytes is over budget', key, size)
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return False
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache '
+            '(key, namespace, expires, accessed, size, value) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, namespace, expires, now, size, sqlite3.Binary(data)))
+        total = conn.execute('SELECT SUM(size) FROM cache WHERE namespace = ?',
+                             (namespace,)).fetchone()[0]
+        if total > budget:
+            rows = conn.execute(
+                'SELECT key, size, expires FROM cache '
+                'WHERE namespace = ? AND key != ? ORDER BY accessed',
+                (namespace, key)).fetchall()
+            for old_key, old_size, old_expires in rows:
+                if total <= budget:
+                    break
+                conn.execute('DELETE FROM cache WHERE key = ?', (old_key,))
+                total -= old_size
+                if not old_expires or old_expires > now:
+                    self._count(old_key, 'evictions')
+        return True
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return (time.time() + timeout) if timeout else 0
+
+    def get(self, key):
+        conn = self.conn
+        item = self._read(conn, key)
+        if item is None:
+            self._count(key, 'misses')
+            return None
+        conn.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                     (time.time(), key))
+        self._count(key, 'hits')
+        return item[1]
+
+    def has(self, key):
+        return self._read(self.conn, key) is not None
+
+    def set(self, key, value, timeout=None):
+        conn = self._transaction()
+        try:
+            stored = self._write(conn, key, value, self._expires(timeout))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return stored
+
+    def add(self, key, value, timeout=None):
+        conn = self._transaction()
+        try:
+            stored = False
+            if self._read(conn, key) is None:
+                stored = self._write(conn, key, value, self._expires(timeout))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return stored
+
+    def inc(self, key, delta=1):
+        """Atomically increments the value of `key`, keeping its expiry
+        """
+        conn = self._transaction()
+        try:
+            item = self._read(conn, key)
+            if item is None:
+                value, expires = delta, self._expires(None)
+            else:
+                value, expires = item[1] + delta, item[0]
+            stored = self._write(conn, key, value, expires)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return value if stored else None
+
+    def delete(self, key):
+        cursor = self.conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def delete_namespace(self, namespace):
+        """Deletes every entry of `namespace`
+        """
+        self.conn.execute('DELETE FROM cache WHERE namespace = ?',
+                          (namespace,))
+        return True
+
+    def clear(self):
+        self.conn.execute('DELETE FROM cache')
+        return True
+
+    def get_stats(self):
+        """Gets the counters of every namespace
+
+        Byte and entry counts cover all processes, the rest this one.
+
+        Returns:
+            dict: namespace -> dict(hits, misses, evictions, bytes, entries)
+
+        """
+        stats = {}
+        for namespace, counters in self._stats.items():
+            stats[namespace] = dict(counters, bytes=0, entries=0)
+        rows = self.conn.execute(
+            'SELECT namespace, SUM(size), COUNT(*) FROM cache '
+            'GROUP BY namespace').fetchall()
+        for namespace, size, entries in rows:
+            counters = stats.setdefault(
+                namespace, dict(hits=0, misses=0, evictions=0))
+            counters.update(bytes=size, entries=entries)
+        return stats
+
+
+# Set (e.g. to a file on tmpfs) to share the cache between workers. SQLite
+# calls block, so leave unset when running a single eventlet worker.
+CACHE_PATH = os.getenv('CACHE_PATH')
+
+# Long-lived entries (see `cached(persist=True)`) are kept here across
+# restarts of the service. The directory is created private to the service
+# user, see `save_snapshot`.
+SNAPSHOT_PATH = os.getenv(
+    'CACHE_SNAPSHOT_PATH', '/var/lib/local-dashboard/cache.snapshot')
+
+if CACHE_PATH:
+    CACHE = SQLiteCache(CACHE_PATH, budgets=NAMESPACE_BUDGETS)
+else:
+    CACHE = LRUCache(budgets=NAMESPACE_BUDGETS)
 if os.getenv('FLASK_TESTING'):
     CACHE = NullCache()
+    SNAPSHOT_PATH = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls that share a key into a single call.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for it and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Runs `func` unless a call for `key` is already in flight.
+
+        Args:
+            key (hashable): Identifies calls that can share a result
+            func (callable): The function to run
+
+        Returns:
+            The result of the (possibly shared) call
+
+        """
+        event = self.calls.get(key)
+        if event is not None:
+            LOG.debug("Joining in-flight call: %s", key)
+            return event.wait()
+        event = self.calls[key] = Event()
+        try:
+            res = func(*args, **kwargs)
+        except Exception as e:
+            event.send_exception(e)
+            raise
+        else:
+            event.send(res)
+            return res
+        finally:
+            self.calls.pop(key, None)
+
 
+FLIGHTS = SingleFlight()
 
-def cached(timeout=0, ignore=None):
+# cache key -> Entry of the results to snapshot
+_SNAPSHOT = {}
+
+# A cached result. `ttl` and `stale_ttl` are those that applied when the
+# result was stored; `error` is set for cached exceptions.
+Entry = namedtuple('Entry',
+                   ['stored_at', 'value', 'ttl', 'stale_ttl', 'error'])
+
+# age of the oldest cached value served to the current greenlet
+_AGES = local()
+
+
+def reset_age():
+    """Forgets the age of values served so far (e.g. at request start)
+    """
+    _AGES.oldest = None
+
+
+def get_age():
+    """Gets the age of the oldest cached value served since `reset_age`
+
+    Returns:
+        float: Age in seconds or None when no cached function was called
+
+    """
+    return getattr(_AGES, 'oldest', None)
+
+
+def record_age(age):
+    """Notes that a value `age` seconds old was served
+    """
+    oldest = get_age()
+    if oldest is None or age > oldest:
+        _AGES.oldest = age
+
+
+def _unwrap(entry):
+    if entry.error is not None:
+        raise entry.error
+    return entry.value
+
+
+# keyword arguments steering the cache rather than the wrapped function
+CONTROL_KWARGS = ('no_cache',)
+
+
+def make_key(namespace, f, args, kwargs):
+    """Builds the cache key of calling `f` with `args` and `kwargs`.
+
+    Arguments are bound to `f`'s signature, so that positional, keyword
+    and default arguments give the same key, and hashed as JSON. Control
+    keyword arguments (e.g. `no_cache`) are left out.
+
+    Returns:
+        str: `<namespace>/<sha1 of the arguments>`
+
+    """
+    callargs = inspect.getcallargs(f, *args, **kwargs)
+    for name in CONTROL_KWARGS:
+        callargs.pop(name, None)
+    payload = json.dumps(callargs, sort_keys=True, default=repr)
+    return '{}/{}'.format(namespace, hashlib.sha1(payload).hexdigest())
+
+
+def invalidate(target, *args, **kwargs):
+    """Evicts cached results.
+
+    ``invalidate('local_api.apiv1.sim/get_modem_network_info')`` or
+    ``invalidate(get_modem_network_info)`` evict every result of the
+    namespace; ``invalidate(get_modem_network_info, imsi, imei)`` only
+    the result of that call.
+
+    Args:
+        target (str|function): A namespace or a `cached` function
+        args: Arguments of the call to evict
+
+    """
+    if isinstance(target, basestring):
+        namespace = target
+    elif args or kwargs:
+        cache_key = target.make_key(*args, **kwargs)
+        CACHE.delete(cache_key)
+        if _SNAPSHOT.pop(cache_key, None) is not None:
+            save_snapshot()
+        return
+    else:
+        namespace = target.namespace
+    LOG.debug("Invalidating cache namespace: %s", namespace)
+    delete_namespace = getattr(CACHE, 'delete_namespace', None)
+    if delete_namespace is not None:
+        delete_namespace(namespace)
+    snapshotted = [k for k in _SNAPSHOT if get_namespace(k) == namespace]
+    for cache_key in snapshotted:
+        del _SNAPSHOT[cache_key]
+    if snapshotted:
+        save_snapshot()
+
+
+def _expires_at(entry):
+    if not entry.ttl:
+        return 0
+    return entry.stored_at + entry.ttl + entry.stale_ttl
+
+
+def save_snapshot(path=None):
+    """Writes the unexpired persisted results to the snapshot file
+
+    The snapshot is JSON, readable and writable by the service user only,
+    in a directory that is created private to it.
+
+    Args:
+        path (str, optional): Defaults to `SNAPSHOT_PATH`
+
+    """
+    path = path or SNAPSHOT_PATH
+    if not path:
+        return
+    now = time.time()
+    for cache_key, entry in list(_SNAPSHOT.items()):
+        expires = _expires_at(entry)
+        if expires and expires <= now:
+            del _SNAPSHOT[cache_key]
+    entries = dict((cache_key, [e.stored_at, e.value, e.ttl, e.stale_ttl])
+                   for cache_key, e in _SNAPSHOT.items())
+    tmp_path = path + '.tmp'
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        data = json.dumps(entries)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(fd, 0o600)
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        LOG.error("Failed to write cache snapshot %s: %r", path, e)
+
+
+def load_snapshot(path=None):
+    """Loads the snapshot file into the cache.
+
+    Entries keep the time they were computed, so they expire (and go
+    stale) when they would have without the restart. A file that is not
+    owned by the service user, or that others can write to, is ignored.
+
+    Args:
+        path (str, optional): Defaults to `SNAPSHOT_PATH`
+
+    Returns:
+        int: The number of entries restored
+
+    """
+    path = path or SNAPSHOT_PATH
+    if not path or not os.path.exists(path):
+        return 0
+    try:
+        info = os.stat(path)
+        if info.st_uid != os.getuid() or info.st_mode & 0o022:
+            LOG.error("Ignoring cache snapshot %s: unsafe owner or mode",
+                      path)
+            return 0
+        with open(path) as f:
+            entries = json.load(f)
+        entries = dict((cache_key, Entry(stored_at, value, ttl, stale, None))
+                       for cache_key, (stored_at, value, ttl, stale)
+                       in entries.items())
+    except Exception as e:
+        LOG.error("Failed to read cache snapshot %s: %r", path, e)
+        return 0
+    now = time.time()
+    restored = 0
+    for cache_key, entry in entries.items():
+        expires = _expires_at(entry)
+        if expires and expires <= now:
+            continue
+        CACHE.set(cache_key, entry, timeout=(expires - now) if expires else 0)
+        _SNAPSHOT[cache_key] = entry
+        restored += 1
+    LOG.info("Restored %d cache entries from %s", restored, path)
+    return restored
+
+
+def warm_up(*funcs):
+    """Calls each (cached) function so that later callers hit the cache
+
+    Failures are logged and do not stop the remaining functions.
+    """
+    for func in funcs:
+        try:
+            func()
+        except Exception as e:
+            LOG.error("Failed to warm up %s: %r", func.__name__, e)
+
+
+def cached(timeout=0, ignore=None, stale_ttl=0, negative_ttl=None,
+           namespace=None, invalidate_on=None, persist=False):
     """Caches Result of function call.
 
-    The cache key is generated from the function name any arguments.
+    The cache key is generated from the namespace (by default the module
+    and function name) and a hash of the arguments (see `make_key`).
+    Concurrent misses on the same key share one call of the function,
+    including calls made with `no_cache=True`.
+
+    For `stale_ttl` seconds after a value expires it is still returned
+    at once while a background greenlet refreshes it.
+
+    Falsy results (`False`, `0`, `{}`...) are cached too, but only for
+    `negative_ttl` seconds (`DEFAULT_NEGATIVE_TTL` if not given, at most
+    `timeout`) since they are often failed reads. Errors are only cached
+    (and raised again on a hit) when `negative_ttl` is given.
+
+    The whole namespace is invalidated whenever one of the `invalidate_on`
+    events (see `event`) is published.
+
+    Results of `persist` functions are also written to the snapshot file
+    (see `load_snapshot`) so that they survive a restart.
 
     Args:
         timeout (int): Time in seconds to store the response in cache
         ignore (list(int), optional): List of values that would not be cached.
+        stale_ttl (int, optional): Time in seconds to serve an expired
+            response while it is refreshed.
+        negative_ttl (int, optional): Time in seconds to store falsy
+            responses and errors. Defaults to `DEFAULT_NEGATIVE_TTL` for
+            falsy responses.
+        namespace (str, optional): Groups the cached results, see
+            `invalidate`. Defaults to `<module>/<function name>`.
+        invalidate_on (list(str), optional): Events invalidating the
+            cached results.
+        persist (bool, optional): Whether to snapshot the results to disk.
+            Results must be JSON serializable and must not hold secrets.
 
     Returns:
         function: Wrapped function
 
     """
     def decorated(f):
+        _namespace = namespace or '{}/{}'.format(f.__module__, f.__name__)
+
+        def store(cache_key, res, ttl, stale=0, error=None):
+            entry = Entry(time.time(), res, ttl, stale, error)
+            CACHE.set(cache_key, entry, timeout=(ttl + stale) if ttl else 0)
+            if persist and error is None:
+                _SNAPSHOT[cache_key] = entry
+                save_snapshot()
+
+        def compute(cache_key, args, kwargs):
+            res = None
+            try:
+                res = f(*args, **kwargs)
+            except Exception as e:
+                LOG.error("Error calculating cached value: Raising: %e", e)
+                if negative_ttl is not None:
+                    store(cache_key, None, negative_ttl, error=e)
+                raise(e)
+            _ignored = ignore or []
+            if res in _ignored:
+                return res
+            if res:
+                store(cache_key, res, timeout, stale_ttl)
+            elif negative_ttl is not None:
+                store(cache_key, res, negative_ttl)
+            else:
+                ttl = DEFAULT_NEGATIVE_TTL
+                if timeout:
+                    ttl = min(ttl, timeout)
+                store(cache_key, res, ttl)
+            return res
+
+        def revalidate(cache_key, args, kwargs):
+            try:
+                FLIGHTS.do(cache_key, compute, cache_key, args, kwargs)
+            except Exception:
+                LOG.error("Failed to refresh stale value: %s", cache_key)
+
         @wraps(f)
         def wrapped(*args, **kwargs):
-            arg_key = '-'.join([str(a) for a in args])
-            cache_key = '{}/{}/{}'.format(f.__module__, f.__name__, arg_key)
-            cached_val = None
+            cache_key = make_key(_namespace, f, args, kwargs)
+            entry = None
             if kwargs.get('no_cache') != True:
                 LOG.debug("Looking up cache: %r", cache_key)
-                cached_val = CACHE.get(cache_key)
-            if cached_val:
-                LOG.debug("Cache HIT: %s", cache_key)
-                return cached_val
-            else:
-                LOG.debug("Cache MISS: %s", cache_key)
-                res = None
-                try:
-                    res = f(*args, **kwargs)
-                except Exception as e:
-                    LOG.error("Error calculating cached value: Raising: %e", e)
-                    raise(e)
-                _ignored = ignore or []
-                if res and res not in _ignored:
-                    CACHE.set(cache_key, res, timeout=timeout)
-                return res
+                entry = CACHE.get(cache_key)
+            if entry is not None:
+                age = time.time() - entry.stored_at
+                if not entry.ttl or age < entry.ttl:
+                    LOG.debug("Cache HIT: %s", cache_key)
+                    record_age(age)
+                    return _unwrap(entry)
+                if age < entry.ttl + entry.stale_ttl:
+                    LOG.debug("Cache STALE: %s", cache_key)
+                    if cache_key not in FLIGHTS.calls:
+                        eventlet.spawn_n(revalidate, cache_key, args, kwargs)
+                    record_age(age)
+                    return _unwrap(entry)
+            LOG.debug("Cache MISS: %s", cache_key)
+            record_age(0)
+            return FLIGHTS.do(cache_key, compute, cache_key, args, kwargs)
+
+        def on_change(name, **data):
+            invalidate(_namespace)
+
+        for name in (invalidate_on or []):
+            event.subscribe(name, on_change)
+
+        wrapped.namespace = _namespace
+        wrapped.make_key = lambda *args, **kwargs: make_key(
+            _namespace, f, args, kwargs)
         return wrapped
     return decorated
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+Signal strength and serving cell history of the WAN modem.
+
+`sample` queries the modem's signal, access technology and serving cell
+over the AT session (see `modem`) at a fixed cadence (see `telemetry`).
+The RSSI goes to the `wan_rssi` stats series. The access technology and
+cell only change on a handover, so rather than storing them with every
+sample only the transitions are kept: a fixed-size record of (time,
+technology, MNC, LAC, cell ID) appended to one file per day whenever the
+serving cell differs from the previous one, losing service being recorded
+as a transition to `NO_SERVICE`. A failed query is not a transition:
+service is only lost when the modem reports no signal, and a cell whose
+access technology could not be read is the one served before if its
+identity is the same. Files older than `RETENTION` are deleted. As with the client ledger, only the first process to lock
+the directory stores transitions.
+"""
+
+import errno
+import fcntl
+import os
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from . import modem
+from . import stats
+
+LOG = __import__('logging').getLogger()
+
+DAY = 60 * 60 * 24
+INTERVAL = 30
+RETENTION = DAY * 30
+# time, access technology, mnc, lac, cell id
+RECORD = struct.Struct('<I12sHII')
+FILE_FORMAT = '%Y-%m-%d.cells'
+STATE_UNKNOWN = 'UNKNOWN'
+
+CELLS_DIR = None
+if stats.STATS_DIR:
+    CELLS_DIR = os.path.join(stats.STATS_DIR, 'cells')
+
+Cell = namedtuple('Cell', ['network_type', 'mnc', 'lac', 'cell_id'])
+# recorded while no cell is served
+NO_SERVICE = Cell(STATE_UNKNOWN, 0, 0, 0)
+
+
+def rssi_to_dbm(rssi):
+    """Converts a `+CSQ` RSSI index (0-31) to dBm
+
+    :return: int dBm, None when not known (99)
+    """
+    try:
+        rssi = int(rssi or '')
+    except (TypeError, ValueError):
+        return None
+    if 0 <= rssi <= 31:
+        return -113 + 2 * rssi
+    return None
+
+
+class CellLog(object):
+    """Transitions between serving cells
+
+    :param str directory: where transitions are stored, in memory only if
+        None
+    :param int retention: seconds transitions are kept for
+    """
+
+    def __init__(self, directory=None, retention=RETENTION):
+        self.directory = directory
+        self.retention = retention
+        # list((int, Cell)) oldest first
+        self.transitions = []
+        self._lock = None
+        if directory is not None:
+            self.load()
+            self._lock = self._acquire()
+
+    @property
+    def current(self):
+        return self.transitions[-1][1] if self.transitions else None
+
+    def _acquire(self):
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            lock = open(os.path.join(self.directory, '.lock'), 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except EnvironmentError as e:
+            LOG.info('Cell history stored by another process: %r', e)
+            return None
+
+    def _path(self, timestamp):
+        return os.path.join(
+            self.directory, datetime.utcfromtimestamp(timestamp).strftime(
+                FILE_FORMAT))
+
+    def load(self):
+        """Reads the stored transitions still within the retention period
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        oldest = time.time() - self.retention
+        for name in sorted(names):
+            if not name.endswith('.cells'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    data = f.read()
+            except IOError as e:
+                LOG.error('Failed to read cell history %s: %r', name, e)
+                continue
+            whole = len(data) - len(data) % RECORD.size
+            for offset in xrange(0, whole, RECORD.size):
+                timestamp, tech, mnc, lac, cell_id = RECORD.unpack_from(
+                    data, offset)
+                if timestamp >= oldest:
+                    self.transitions.append((timestamp, Cell(
+                        tech.rstrip('\0'), mnc, lac, cell_id)))
+
+    def store(self, timestamp, cell):
+        """Appends a transition to the file of its day
+        """
+        if self._lock is None:
+            return
+        record = RECORD.pack(
+            timestamp, cell.network_type[:12], cell.mnc, cell.lac, cell.cell_id)
+        try:
+            with open(self._path(timestamp), 'ab') as f:
+                f.write(record)
+        except EnvironmentError as e:
+            LOG.error('Failed to store cell history: %r', e)
+
+    def expire(self, now):
+        """Drops the transitions and files older than the retention period
+
+        The latest transition is kept, being the cell still served.
+        """
+        oldest = now - self.retention
+        while len(self.transitions) > 1 and self.transitions[0][0] < oldest:
+            self.transitions.pop(0)
+        if self._lock is None:
+            return
+        keep = datetime.utcfromtimestamp(oldest).strftime(FILE_FORMAT)
+        try:
+            for name in os.listdir(self.directory):
+                if name.endswith('.cells') and name < keep:
+                    os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            LOG.error('Failed to expire cell history: %r', e)
+
+    def observe(self, cell, now=None):
+        """Records `cell` if it is not the one served before
+
+        :param Cell cell: the serving cell
+        :param float now: seconds since the epoch of the sample
+        :return: bool whether it was a transition
+        """
+        if now is None:
+            now = time.time()
+        if cell == self.current:
+            return False
+        timestamp = int(now)
+        previous = self.transitions[-1][0] if self.transitions else None
+        self.transitions.append((timestamp, cell))
+        self.store(timestamp, cell)
+        if (previous is not None and
+                time.gmtime(previous)[:3] != time.gmtime(timestamp)[:3]):
+            self.expire(now)
+        return True
+
+    def get_transitions(self, start=None, end=None):
+        """Gets the transitions from `start` to `end`
+
+        The cell served at `start` comes first, so that the range is fully
+        covered.
+
+        :return: list(dict) oldest first
+        """
+        handovers = []
+        for i, (timestamp, cell) in enumerate(self.transitions):
+            if end is not None and timestamp > end:
+                break
+            if start is not None and timestamp < start:
+                following = self.transitions[i + 1:i + 2]
+                if following and following[0][0] <= start:
+                    continue
+            handovers.append(dict(
+                cell._asdict(), timestamp=stats.format_timestamp(timestamp)))
+        return handovers
+
+
+CELLS = CellLog(CELLS_DIR)
+
+
+def read_cell():
+    """Queries the modem for the signal and the serving cell
+
+    :return: (int, Cell) RSSI in dBm, None when not known, and the serving
+        cell, `NO_SERVICE` when the modem reports no signal and None when
+        not known
+    """
+    modem_info = modem.query_many('signal', 'network_mode')
+    rssi = rssi_to_dbm(modem_info['signal'])
+    network_type = modem_info['network_mode'] or STATE_UNKNOWN
+    cell = None
+    try:
+        info = modem.parse_cell_info(modem.run('AT+XCELLINFO?') or '')
+        cell = Cell(network_type, int(info['mnc']), info['lac'],
+                    info['cell_id'])
+    except ValueError as e:
+        LOG.debug('No serving cell: %r', e)
+        if modem_info['signal'] and rssi is None:
+            cell = NO_SERVICE
+    return (rssi, cell)
+
+
+def sample():
+    """Records the signal and any handover, or loss of service, since the
+    previous sample
+
+    :return: dict with `rssi` (dBm) and the serving cell's `network_type`,
+        `mnc`, `lac` and `cell_id`
+    """
+    now = time.time()
+    rssi, cell = read_cell()
+    if rssi is not None:
+        stats.record('wan_rssi', rssi, now)
+    current = CELLS.current
+    if (cell is not None and cell.network_type == STATE_UNKNOWN and
+            current is not None and cell[1:] == current[1:]):
+        # the access technology failed to read, not changed
+        cell = current
+    if cell is not None:
+        CELLS.observe(cell, now)
+    result = dict(rssi=rssi)
+    if cell not in (None, NO_SERVICE):
+        result.update(cell._asdict())
+    return result
+
+
+stats.register('wan_rssi', INTERVAL)
@@ -3,12 +3,21 @@
 API Controllers for the local dashboard
 """
 
+import hashlib
 import re
+import time
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from flask.views import MethodView
 
 from flask_login import (login_required, current_user)
+from . import alerts
+from . import cache
+from . import cellular
+from . import export
+from . import ledger
+from . import stats
+from . import telemetry
 from .errors import APIError
 
 from .utils import (get_system_state, get_battery_status, get_software,
@@ -16,7 +25,8 @@ from .utils import (get_system_state, get_battery_status, get_software,
                     get_device_setup_data, get_connection_state,
                     get_retail_registration_token, retail_device_registered,
                     get_power_data, get_device_id, get_modem_status,
-                    get_firmware, get_os, get_connected_clients)
+                    get_firmware, get_os, get_connected_clients,
+                    get_throughput)
 from .sim import (get_wan_connections, configure_sim)
 from .ethernet import (get_ethernet_networks, configure_ethernet)
 from .wifi import (get_wireless_config, configure_wifi)
@@ -38,6 +48,23 @@ ETHERNET_ID_REGEX = re.compile(r'^ETHERNET[1-3]$')
 WIFI_ID_REGEX = re.compile(r'^WIFI[1]$')
 
 
+@api_blueprint.before_request
+def reset_data_age():
+    cache.reset_age()
+
+
+@api_blueprint.after_request
+def add_age_header(response):
+    """
+    Reports how old the oldest cached device reading in the response is.
+    :return: flask.Response
+    """
+    age = cache.get_age()
+    if age is not None:
+        response.headers['Age'] = str(int(age))
+    return response
+
+
 @api_blueprint.app_errorhandler(APIError)
 def handle_bad_data_error(error):
     """
@@ -159,11 +186,12 @@ class BatteryAPI(ProtectedView):
 
 
 class PowerAPI(ProtectedView):
-    def get_config(self, **kwargs):
+    def get_config(self):
         if 'live' in request.args:
-            kwargs['no_cache'] = True
-        config = get_power_config(**kwargs)
-        battery = get_battery_status(**kwargs)
+            telemetry.resample('power')
+            telemetry.resample('battery')
+        config = get_power_config()
+        battery = get_battery_status()
         config['battery'] = battery
         return config
 
@@ -183,7 +211,7 @@ class PowerAPI(ProtectedView):
         power_config = payload.get('power') or {}
         status_code, errors = configure_power(power_config)
         if status_code == HTTP_OK:
-            return jsonify(self.get_config(no_cache=True))
+            return jsonify(self.get_config())
         else:
             raise APIError('Invalid Data', errors, 422)
 
@@ -239,6 +267,197 @@ class DiagnosticsAPI(ProtectedView):
         return jsonify(get_diagnostics_data())
 
 
+def get_time_range(errors):
+    """
+    Reads the `from` and `to` query parameters, timestamps (e.g.
+    `2018-02-28T00:00:00+0000`) or seconds since the epoch.
+    `from` defaults to 24 hours before `to`.
+    :return: (int, int|None) start and end, end None if not given
+    """
+    bounds = {}
+    for param in ['from', 'to']:
+        value = request.args.get(param)
+        if value is None:
+            continue
+        try:
+            bounds[param] = stats.parse_timestamp(value)
+        except ValueError:
+            errors[param] = 'Invalid timestamp'
+    end = bounds.get('to')
+    start = bounds.get('from')
+    if start is None:
+        start = (end or int(time.time())) - stats.DAY
+    return (start, end)
+
+
+def get_positive_int(param, errors, default=None):
+    """
+    Reads a positive integer query parameter.
+    :return: int
+    """
+    value = request.args.get(param)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+        assert value > 0
+    except (ValueError, AssertionError):
+        errors[param] = 'Must be a positive integer'
+    return value
+
+
+class ThroughputAPI(ProtectedView):
+    def get(self):
+        """Gets the current up and down speeds of the network connections
+
+        :return: string JSON representation of the speeds by connection
+        """
+        return jsonify(get_throughput())
+
+
+class StatsAPI(ProtectedView):
+    def get(self, metric):
+        """Gets the recorded history of a metric
+
+        Accepts the optional `from` and `to` query parameters as timestamps
+        (e.g. `2018-02-28T00:00:00+0000`) or seconds since the epoch, and
+        `step`, the seconds wanted between records. Defaults to the last
+        24 hours at a step that gives a few hundred records.
+
+        With `agg` (a comma separated list of `min`, `max`, `avg` and
+        `p95`) the history is aggregated over windows of `step` seconds
+        and returned as columns instead. The range then spans at most
+        `stats.MAX_POINTS` steps.
+
+        :return: string JSON representation of a stat listing
+        """
+        if metric not in stats.SERIES:
+            raise APIError('Not Found', {'metric': 'Unknown metric'}, 404)
+        errors = {}
+        start, end = get_time_range(errors)
+        step = get_positive_int('step', errors)
+        aggregates = request.args.get('agg')
+        if aggregates is not None:
+            aggregates = aggregates.split(',')
+            if not set(aggregates) <= set(stats.AGGREGATES):
+                errors['agg'] = 'Must be some of: %s' % ', '.join(
+                    stats.AGGREGATES)
+        if errors:
+            raise APIError('Invalid Data', errors, 422)
+        if aggregates is None:
+            records = stats.get_records(metric, start, end, step)
+            return jsonify(dict(records=records))
+        if end is None:
+            end = int(time.time())
+        # the fewest seconds a window can cover, rounded up
+        min_step = max(1, -(-(end - start) // stats.MAX_POINTS))
+        if step is None:
+            step = min_step
+        elif step < min_step:
+            raise APIError('Invalid Data', {
+                'step': 'Must be at least %d for this range' % min_step}, 422)
+        return jsonify(
+            stats.get_aggregates(metric, start, end, step, aggregates))
+
+
+class AlertsAPI(ProtectedView):
+    def get(self):
+        """Gets the alerts currently raised (e.g. the CPU running hot)
+
+        :return: string JSON representation of the active alerts
+        """
+        return jsonify(dict(alerts=alerts.ALERTS.get_active()))
+
+
+class StatsExportAPI(ProtectedView):
+    def get(self):
+        """Streams the history of several metrics as a gzip compressed file
+
+        Takes `metrics`, a comma separated list, the range of `StatsAPI`
+        (`to` defaulting to now), `step` to pick a coarser tier than the
+        finest one covering the range and `format`, `csv` (the default)
+        or `binary`. The range ends at the newest records written out
+        (see `export.resolve`). Supports single byte ranges to resume a
+        download, `Content-Location` giving the range the export was made
+        for and the ETag what it contains.
+
+        :return: Response streaming the export
+        """
+        errors = {}
+        start, end = get_time_range(errors)
+        step = get_positive_int('step', errors)
+        names = [n for n in request.args.get('metrics', '').split(',') if n]
+        if not names:
+            errors['metrics'] = 'Required'
+        elif not set(names) <= set(stats.SERIES):
+            errors['metrics'] = 'Unknown metric'
+        file_format = request.args.get('format', 'csv')
+        if file_format not in export.FORMATS:
+            errors['format'] = 'Must be one of: %s' % ', '.join(
+                export.FORMATS)
+        if errors:
+            raise APIError('Invalid Data', errors, 422)
+        if end is None:
+            end = int(time.time())
+        end, sources = export.resolve(names, start, end, step)
+        params = [('metrics', ','.join(names)), ('from', start),
+                  ('to', end), ('format', file_format)]
+        if step is not None:
+            params.append(('step', step))
+        query = '&'.join('%s=%s' % param for param in params)
+        etag = hashlib.sha1(
+            '%s|%s' % (query, export.fingerprint(sources))).hexdigest()
+
+        def stream():
+            return export.export(sources, start, end, file_format)
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Location': '%s?%s' % (request.path, query),
+            'Content-Disposition': 'attachment; filename="stats-%d-%d.%s.gz"'
+                                   % (start, end, file_format),
+            'ETag': '"%s"' % etag,
+        }
+        byte_range = request.range
+        if_range = request.if_range
+        if (byte_range is None or len(byte_range.ranges) != 1 or
+                (if_range.etag is not None and if_range.etag != etag)):
+            return Response(stream(), headers=headers,
+                            mimetype='application/gzip')
+        size = export.get_size(etag, stream)
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response(status=416, headers=headers)
+        begin, stop = bounds
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (begin, stop - 1, size)
+        headers['Content-Length'] = str(stop - begin)
+        return Response(export.byte_range(stream(), begin, stop), status=206,
+                        headers=headers, mimetype='application/gzip')
+
+
+class ClientUsageAPI(ProtectedView):
+    def get(self, mac_address):
+        """
+        Gets the traffic of the connected clients
+
+        Without a MAC address, the clients that transferred the most bytes
+        over the range (see `StatsAPI`), at most `limit` of them. With one,
+        that client's traffic by hour.
+        :return: string JSON representation of client usage
+        """
+        errors = {}
+        start, end = get_time_range(errors)
+        limit = get_positive_int('limit', errors, default=10)
+        if errors:
+            raise APIError('Invalid Data', errors, 422)
+        if mac_address is None:
+            clients = ledger.LEDGER.top_talkers(start, end, limit)
+            return jsonify(dict(clients=clients))
+        hours = ledger.LEDGER.client_usage(mac_address, start, end)
+        return jsonify(dict(mac_address=mac_address.lower(), usage=hours))
+
+
 class FTPConfigurationAPI(ProtectedView):
     """FTP Configuration views.
     """
@@ -362,10 +581,8 @@ class WIFIAPI(ProtectedView):
 
 
 class ModemAPI(ProtectedView):
-    def get_config(self, **kwargs):
-        if 'live' in request.args:
-            kwargs['no_cache'] = True
-        config = get_modem_status(**kwargs)
+    def get_config(self):
+        config = get_modem_status()
         return config
 
     def get(self):
@@ -378,6 +595,25 @@ class ModemAPI(ProtectedView):
         return jsonify(get_modem_status())
 
 
+class ModemHistoryAPI(ProtectedView):
+    def get(self):
+        """Gets the signal of the WAN modem over time and its handovers
+
+        Accepts the range and `step` of `StatsAPI`. Handovers start with
+        the cell served at the start of the range.
+
+        :return: string JSON representation of the modem history
+        """
+        errors = {}
+        start, end = get_time_range(errors)
+        step = get_positive_int('step', errors)
+        if errors:
+            raise APIError('Invalid Data', errors, 422)
+        return jsonify(dict(
+            signal=stats.get_records('wan_rssi', start, end, step),
+            handovers=cellular.CELLS.get_transitions(start, end)))
+
+
 class DevicesAPI(ProtectedView):
     def get(self):
         """
@@ -437,6 +673,22 @@ api_blueprint.add_url_rule(
     '/system/diagnostics',
     view_func=DiagnosticsAPI.as_view('diagnostics_api'),
     methods=[GET])
+api_blueprint.add_url_rule(
+    '/system/throughput',
+    view_func=ThroughputAPI.as_view('throughput_api'),
+    methods=[GET])
+api_blueprint.add_url_rule(
+    '/system/alerts',
+    view_func=AlertsAPI.as_view('alerts_api'),
+    methods=[GET])
+api_blueprint.add_url_rule(
+    '/system/stats/export',
+    view_func=StatsExportAPI.as_view('stats_export_api'),
+    methods=[GET])
+api_blueprint.add_url_rule(
+    '/system/stats/<string:metric>',
+    view_func=StatsAPI.as_view('stats_api'),
+    methods=[GET])
 api_blueprint.add_url_rule(
     '/power', view_func=PowerAPI.as_view('power_api'), methods=[GET, PATCH])
 api_blueprint.add_url_rule(
@@ -453,10 +705,24 @@ api_blueprint.add_url_rule(
     methods=[GET, POST])
 api_blueprint.add_url_rule(
     '/clients', view_func=DevicesAPI.as_view('devices_api'), methods=[GET])
+usage_view = ClientUsageAPI.as_view('client_usage_api')
+api_blueprint.add_url_rule(
+    '/clients/usage',
+    defaults={'mac_address': None},
+    view_func=usage_view,
+    methods=[GET])
+api_blueprint.add_url_rule(
+    '/clients/<string(length=17):mac_address>/usage',
+    view_func=usage_view,
+    methods=[GET])
 api_blueprint.add_url_rule(
     '/packages', view_func=PackagesAPI.as_view('packages_api'), methods=[GET])
 api_blueprint.add_url_rule(
     '/modem', view_func=ModemAPI.as_view('modem_api'), methods=[GET])
+api_blueprint.add_url_rule(
+    '/modem/history',
+    view_func=ModemHistoryAPI.as_view('modem_history_api'),
+    methods=[GET])
 api_blueprint.add_url_rule(
     '/firmware', view_func=FirmwareAPI.as_view('firmware_api'), methods=[GET])
 api_blueprint.add_url_rule(
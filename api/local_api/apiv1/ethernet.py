@@ -6,19 +6,15 @@ At the moment, the SupaBRCK only supports one ethernet connection.
 """
 
 import os
-import time
 import socket
 import psutil
+import eventlet
 
-from brck.utils import (
-    uci_get,
-    uci_set,
-    uci_delete,
-    uci_commit,
-    run_command,
-    LOG
-)
+from brck.utils import LOG
 
+from . import event
+from . import uci
+from .process import run_command
 from .errors import APIError
 from .utils import get_uci_state
 from .schema import Validator
@@ -50,11 +46,11 @@ def get_ethernet_networks(net_id=None):
     """
     networks = [net_id] if (net_id is not None) else NETWORKS
     networks_info = []
+    uci_state = get_uci_state('network')
     for net in networks:
         interface = CONNECTION_MAP.get(net, None)
         if interface is None:
             raise APIError(status_code=404, errors=[dict(network="not found")])
-        uci_state = get_uci_state('network')
         _interface = INTERFACE_MAP.get(net, 'eth0')
         connected = uci_state.get('network.{}.connected'.format(interface)) == '1'
         if not connected:
@@ -79,8 +75,8 @@ def get_ethernet_networks(net_id=None):
                     )
                 )
         # get uci dns/routing configuration
-        net_info['dns'] = uci_get('network.{}.dns'.format(interface)) or ''
-        net_info['gateway'] = uci_get('network.{}.gateway'.format(interface)) or ''
+        net_info['dns'] = uci_state.get('network.{}.dns'.format(interface), '')
+        net_info['gateway'] = uci_state.get('network.{}.gateway'.format(interface), '')
         ip_info = dict(dhcp_enabled=dhcp_enabled,
                        network=net_info)
         net_data['info'] = ip_info        
@@ -94,26 +90,27 @@ def configure_ip(net_id, dhcp_enabled, net_info):
     Reloads the network.
     """
     interface = CONNECTION_MAP.get(net_id)
-    if dhcp_enabled:
-        LOG.warn('Configuring interface [%s] proto to DHCP', interface)
-        uci_set('network.{}.proto'.format(interface), 'dhcp')
-        for static_key in ['ipaddr', 'netmask', 'gateway', 'dns']:
-            uci_option = 'network.{}.{}'.format(interface, static_key)
-            LOG.warn('Deleting UCI option:[%s]', uci_option)
-            uci_delete(uci_option)
-    else:
-        net_info['proto'] = 'static'
-        for k,v in net_info.iteritems():
-            if v:
-                uci_option = 'network.{}.{}'.format(interface, k)
-                LOG.warn('Configuring network: [%s = %s]', uci_option, v)
-                uci_set(uci_option, v)
-    uci_commit('network.{}'.format(interface))
+    with uci.Transaction() as txn:
+        if dhcp_enabled:
+            LOG.warn('Configuring interface [%s] proto to DHCP', interface)
+            txn.set('network.{}.proto'.format(interface), 'dhcp')
+            for static_key in ['ipaddr', 'netmask', 'gateway', 'dns']:
+                uci_option = 'network.{}.{}'.format(interface, static_key)
+                LOG.warn('Deleting UCI option:[%s]', uci_option)
+                txn.delete(uci_option)
+        else:
+            net_info['proto'] = 'static'
+            for k,v in net_info.iteritems():
+                if v:
+                    uci_option = 'network.{}.{}'.format(interface, k)
+                    LOG.warn('Configuring network: [%s = %s]', uci_option, v)
+                    txn.set(uci_option, v)
     run_command(['iptables', '--flush'])
     run_command(['/etc/init.d/network', 'reload'])
     run_command(['iptables', '--flush'])
     LOG.warn('Sleeping for five (5) seconds to see if interface connection comes up.')
-    time.sleep(NETWORK_CONFIG_WAIT_TIME)
+    eventlet.sleep(NETWORK_CONFIG_WAIT_TIME)
+    event.publish(event.ETHERNET_CHANGED, net_id=net_id)
     return (200, 'OK')
 
 
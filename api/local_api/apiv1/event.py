@@ -1 +1,57 @@
+# -*- coding: utf-8 -*-
 
+"""
+In-process publish/subscribe of device configuration changes.
+
+Configuration writers publish an event once a change has been applied;
+subscribers (e.g. cached readers, see `cache.cached(invalidate_on=...)`)
+react to it. Handlers run synchronously in the publishing greenlet.
+"""
+
+from collections import defaultdict
+
+LOG = __import__('logging').getLogger()
+
+POWER_CHANGED = 'power_changed'
+WIFI_CHANGED = 'wifi_changed'
+ETHERNET_CHANGED = 'ethernet_changed'
+SIM_CHANGED = 'sim_changed'
+STORAGE_CHANGED = 'storage_changed'
+NETWORK_CHANGES = [WIFI_CHANGED, ETHERNET_CHANGED, SIM_CHANGED]
+ALERT_RAISED = 'alert_raised'
+ALERT_CLEARED = 'alert_cleared'
+
+_SUBSCRIBERS = defaultdict(list)
+
+
+def subscribe(event, handler):
+    """Calls `handler(event, **data)` whenever `event` is published
+
+    :param str event: event name e.g. `POWER_CHANGED`
+    :param callable handler: the handler
+    """
+    if handler not in _SUBSCRIBERS[event]:
+        _SUBSCRIBERS[event].append(handler)
+
+
+def unsubscribe(event, handler):
+    """Stops calling `handler` for `event`
+    """
+    if handler in _SUBSCRIBERS[event]:
+        _SUBSCRIBERS[event].remove(handler)
+
+
+def publish(event, **data):
+    """Notifies the subscribers of `event`
+
+    A failing handler is logged and does not stop the others.
+
+    :param str event: event name e.g. `POWER_CHANGED`
+    :param data: details passed on to the handlers
+    """
+    LOG.debug('Publishing event: %s %r', event, data)
+    for handler in list(_SUBSCRIBERS[event]):
+        try:
+            handler(event, **data)
+        except Exception as e:
+            LOG.error('Event handler failed for %s: %r', event, e)
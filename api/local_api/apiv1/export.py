@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compressed export of metric history.
+
+The history of a few series over a range is streamed as a gzip file,
+built a chunk of records at a time from the stats tiers so that memory
+use does not depend on the size of the range. Records follow the
+`StatRecord` schema: raw samples only have a `value`, rollup buckets
+their average as `value` plus the `min` and `max`.
+
+Two formats are offered:
+
+- `csv`: a `metric,timestamp,value,min,max` header then one line per
+  record, `min` and `max` left empty for raw samples.
+- `binary`: `MAGIC` then blocks of up to `stats.CHUNK_SIZE` records of
+  one series, each a `BLOCK` header (series name, number of records,
+  number of fields) followed by the columns, all little-endian: the
+  timestamps (uint32 seconds since the epoch) then `value`, `min` and
+  `max` (float32, raw blocks having `value` only).
+
+Only records already written to the tiers' files are exported: pending
+samples and the rollup bucket being filled still change, so `resolve`
+clamps the range to the newest written record of every series and picks
+each series' tier once. An export is then set by the range, the tiers
+and the first and last records it covers, which `fingerprint` sums up
+e.g. for an ETag: the same fingerprint gives the same bytes, which lets
+a download be resumed with an HTTP range (see `get_size`). Records
+overwritten since, or a different tier, change the fingerprint.
+"""
+
+import struct
+import sys
+import zlib
+from collections import OrderedDict, namedtuple
+
+from . import stats
+
+LOG = __import__('logging').getLogger()
+
+FORMATS = ('csv', 'binary')
+CSV_HEADER = 'metric,timestamp,value,min,max\n'
+MAGIC = 'LDSX\x01'
+# series name, number of records, number of fields
+BLOCK = struct.Struct('<32sIB')
+COMPRESSION_LEVEL = 6
+# sizes of the recent exports, for range requests
+MAX_SIZES = 16
+_SIZES = OrderedDict()
+
+# a series to export, from `tier`, and the timestamps of its first and last
+# records in the range (None without any)
+Source = namedtuple('Source', ['name', 'tier', 'first', 'last'])
+
+
+def resolve(names, start, end, resolution=None):
+    """Pins down what an export of the series `names` contains
+
+    :param int resolution: seconds between records, the finest tier still
+        covering `start` if None
+    :return: (int, list(Source)) `end` clamped to the newest record
+        written by every series, and the series
+    """
+    tiers = []
+    for name in names:
+        try:
+            tier = stats.get_series(name).select(start, end, resolution or 0)
+            tiers.append((name, tier, tier.store.span(start, end)[1]))
+        except EnvironmentError as e:
+            LOG.error('Failed to export %s: %r', name, e)
+    written = [last for _, _, last in tiers if last is not None]
+    if written:
+        end = min([end] + written)
+    sources = []
+    for name, tier, _ in tiers:
+        first, last = tier.store.span(start, end)
+        sources.append(Source(name, tier, first, last))
+    return (end, sources)
+
+
+def fingerprint(sources):
+    """Sums up what an export of `sources` contains
+
+    :return: str e.g. `battery:30:1519776000-1519778970`
+    """
+    return ','.join('%s:%d:%s-%s' % (source.name, source.tier.width,
+                                     source.first, source.last)
+                    for source in sources)
+
+
+def iter_chunks(sources, start, end):
+    """Reads the written records of `sources`, one after the other
+
+    :param list(Source) sources: as `resolve`
+    :return: iterator of (str, array, list(array)) the series name,
+        timestamps and the `value`, `min` and `max` columns (only `value`
+        for raw samples)
+    """
+    for source in sources:
+        try:
+            chunks = source.tier.store.iter_read(
+                start, end, stats.CHUNK_SIZE, pending=False)
+            for timestamps, columns in chunks:
+                if 'value' in columns:
+                    yield (source.name, timestamps, [columns['value']])
+                else:
+                    yield (source.name, timestamps, [
+                        columns['avg'], columns['min'], columns['max']])
+        except EnvironmentError as e:
+            LOG.error('Failed to export %s: %r', source.name, e)
+
+
+def iter_csv(chunks):
+    """Formats chunks of `iter_chunks` as CSV
+
+    :return: iterator of str
+    """
+    yield CSV_HEADER
+    for name, timestamps, columns in chunks:
+        lines = []
+        for record in zip(timestamps, *columns):
+            values = ['%.7g' % value for value in record[1:]]
+            values += [''] * (3 - len(values))
+            lines.append('%s,%s,%s\n' % (
+                name, stats.format_timestamp(record[0]), ','.join(values)))
+        yield ''.join(lines)
+
+
+def iter_binary(chunks):
+    """Formats chunks of `iter_chunks` as binary columns
+
+    :return: iterator of str
+    """
+    yield MAGIC
+    for name, timestamps, columns in chunks:
+        parts = [BLOCK.pack(name[:32], len(timestamps), len(columns))]
+        for column in [timestamps] + columns:
+            if sys.byteorder == 'big':
+                column = column[:]
+                column.byteswap()
+            parts.append(column.tostring())
+        yield ''.join(parts)
+
+
+def compress(parts, level=COMPRESSION_LEVEL):
+    """Compresses a stream into the gzip format, part by part
+
+    The gzip header has no timestamp so that the output only depends on
+    the input.
+
+    :return: iterator of str
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(sources, start, end, file_format='csv'):
+    """Streams the gzip compressed history of `sources`
+
+    :param list(Source) sources: as `resolve`, with the clamped `end`
+    :param str file_format: one of `FORMATS`
+    :return: iterator of str
+    """
+    chunks = iter_chunks(sources, start, end)
+    if file_format == 'binary':
+        return compress(iter_binary(chunks))
+    return compress(iter_csv(chunks))
+
+
+def get_size(key, stream):
+    """Gets the size of an export by running through it, once per `key`
+
+    :param str key: identifies the export e.g. its ETag, see `fingerprint`
+    :param callable stream: makes the export stream
+    :return: int bytes
+    """
+    if key in _SIZES:
+        return _SIZES[key]
+    size = sum(len(data) for data in stream())
+    _SIZES[key] = size
+    while len(_SIZES) > MAX_SIZES:
+        _SIZES.popitem(last=False)
+    return size
+
+
+def byte_range(data, begin, end):
+    """Slices a stream to the bytes from `begin` to `end` (exclusive)
+
+    :return: iterator of str
+    """
+    position = 0
+    for part in data:
+        following = position + len(part)
+        if following > begin:
+            yield part[max(0, begin - position):end - position]
+        position = following
+        if position >= end:
+            break
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Linear trends of metrics over a sliding window.
+
+`Trend` fits a least squares line through the samples of the last
+`window` seconds. It keeps the running sums the fit is computed from,
+adding each sample as it arrives and subtracting those leaving the
+window, so a fit costs the same however many samples the window holds.
+"""
+
+from collections import deque
+
+from . import stats
+
+LOG = __import__('logging').getLogger()
+
+# samples needed before a trend is worth reporting
+MIN_SAMPLES = 6
+
+
+class Trend(object):
+    """Least squares line through the samples of a sliding window
+
+    :param int window: seconds of samples fitted
+    :param int min_samples: samples needed for a fit
+    """
+
+    def __init__(self, window, min_samples=MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = deque()
+        # timestamps are taken relative to the origin to keep the sums of
+        # squares small enough for doubles
+        self._origin = None
+        self._sums = [0.0, 0.0, 0.0, 0.0]  # x, y, x * x, x * y
+
+    def _update(self, x, y, sign):
+        x -= self._origin
+        sums = self._sums
+        sums[0] += sign * x
+        sums[1] += sign * y
+        sums[2] += sign * x * x
+        sums[3] += sign * x * y
+
+    def _rebase(self):
+        self._origin = self.samples[0][0] if self.samples else None
+        self._sums = [0.0, 0.0, 0.0, 0.0]
+        for x, y in self.samples:
+            self._update(x, y, 1)
+
+    def add(self, timestamp, value):
+        """Adds a sample, dropping those now out of the window
+        """
+        timestamp, value = float(timestamp), float(value)
+        if self.samples and timestamp <= self.samples[-1][0]:
+            return
+        if self._origin is None:
+            self._origin = timestamp
+        self.samples.append((timestamp, value))
+        self._update(timestamp, value, 1)
+        while self.samples[0][0] <= timestamp - self.window:
+            self._update(*self.samples.popleft(), sign=-1)
+        if self.samples[0][0] - self._origin > self.window:
+            self._rebase()
+
+    @property
+    def slope(self):
+        """Change of the value per second, None without enough samples
+        """
+        count = len(self.samples)
+        if count < self.min_samples:
+            return None
+        sum_x, sum_y, sum_xx, sum_xy = self._sums
+        spread = count * sum_xx - sum_x * sum_x
+        if spread <= 0:
+            return None
+        return (count * sum_xy - sum_x * sum_y) / spread
+
+    def time_to(self, limit):
+        """Estimates the seconds until the trend reaches `limit`, from the
+        fitted value at the latest sample
+
+        :return: float, None if the trend is not heading there
+        """
+        slope = self.slope
+        if not slope:
+            return None
+        count = len(self.samples)
+        sum_x, sum_y = self._sums[:2]
+        latest = self.samples[-1][0] - self._origin
+        fitted = (sum_y + slope * (count * latest - sum_x)) / count
+        remaining = (limit - fitted) / slope
+        return remaining if remaining >= 0 else None
+
+
+def load(trend, name, now):
+    """Feeds `trend` the window of history of stats series `name` before
+    `now`, e.g. after a restart
+
+    :return: int number of samples loaded
+    """
+    try:
+        _tier, timestamps, columns = stats.get_series(name).read(
+            now - trend.window + 1, now)
+    except EnvironmentError as e:
+        LOG.error('Failed to load the history of %s: %r', name, e)
+        return 0
+    values = columns.get('value', columns.get('avg'))
+    for timestamp, value in zip(timestamps, values):
+        trend.add(timestamp, value)
+    return len(timestamps)
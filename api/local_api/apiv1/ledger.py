@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Traffic accounting of the clients connected to the access point.
+
+The byte counters of every client (see `utils.get_client_list`) are
+compared with the previous sample and the difference added to the
+client's hourly bucket. A new session or a counter going backwards means
+the client reconnected, in which case its counters are taken as the
+bytes of the new session.
+
+Closed hourly buckets are appended to one file per day as fixed-size
+records of (hour, MAC, rx bytes, tx bytes) and files older than
+`RETENTION` are deleted; nothing is ever rewritten. Every process keeps
+its own ledger from the same samples, but only the first one to lock the
+directory stores it.
+"""
+
+import atexit
+import binascii
+import errno
+import fcntl
+import os
+import struct
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from . import stats
+
+LOG = __import__('logging').getLogger()
+
+HOUR = 60 * 60
+DAY = HOUR * 24
+RETENTION = DAY * 7
+RECORD = struct.Struct('<I6sQQ')  # hour, mac, rx bytes, tx bytes
+FILE_FORMAT = '%Y-%m-%d.ledger'
+
+LEDGER_DIR = None
+if stats.STATS_DIR:
+    LEDGER_DIR = os.path.join(stats.STATS_DIR, 'ledger')
+
+
+def pack_mac(mac):
+    return binascii.unhexlify(mac.replace(':', '').replace('-', ''))
+
+
+def unpack_mac(packed):
+    hexed = binascii.hexlify(packed)
+    return ':'.join(hexed[i:i + 2] for i in range(0, 12, 2))
+
+
+class Ledger(object):
+    """Bytes transferred by each client per hour
+
+    :param str directory: where closed buckets are stored, in memory only
+        if None
+    :param int retention: seconds buckets are kept for
+    """
+
+    def __init__(self, directory=None, retention=RETENTION):
+        self.directory = directory
+        self.retention = retention
+        # hour -> mac -> [rx bytes, tx bytes]
+        self.buckets = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        # mac -> (session id, rx bytes, tx bytes) of the last sample
+        self._counters = {}
+        self._sampled = False
+        self._hour = None
+        # (hour, mac -> [rx bytes, tx bytes]) part of a bucket already
+        # stored, e.g. at exit
+        self._stored = (None, {})
+        self._lock = None
+        if directory is not None:
+            self.load()
+            self._lock = self._acquire()
+
+    def _acquire(self):
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            lock = open(os.path.join(self.directory, '.lock'), 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except EnvironmentError as e:
+            LOG.info('Ledger stored by another process: %r', e)
+            return None
+
+    def _path(self, hour):
+        return os.path.join(
+            self.directory, datetime.utcfromtimestamp(hour).strftime(
+                FILE_FORMAT))
+
+    def load(self):
+        """Reads the stored buckets still within the retention period
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        oldest = time.time() - self.retention
+        for name in sorted(names):
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    data = f.read()
+            except IOError as e:
+                LOG.error('Failed to read ledger %s: %r', name, e)
+                continue
+            whole = len(data) - len(data) % RECORD.size
+            for offset in xrange(0, whole, RECORD.size):
+                hour, mac, rx, tx = RECORD.unpack_from(data, offset)
+                if hour >= oldest:
+                    usage = self.buckets[hour][unpack_mac(mac)]
+                    usage[0] += rx
+                    usage[1] += tx
+        if self.buckets:
+            latest = max(self.buckets)
+            self._stored = (latest, dict(
+                (mac, tuple(usage))
+                for mac, usage in self.buckets[latest].items()))
+
+    def store(self, hour, usage):
+        """Appends the (unstored part of the) bucket of `hour` to its file
+        """
+        stored_hour, stored = self._stored
+        if stored_hour != hour:
+            stored = {}
+        records = []
+        for mac, (rx, tx) in usage.items():
+            rx0, tx0 = stored.get(mac, (0, 0))
+            if rx > rx0 or tx > tx0:
+                records.append(
+                    RECORD.pack(hour, pack_mac(mac), rx - rx0, tx - tx0))
+            stored[mac] = (rx, tx)
+        self._stored = (hour, stored)
+        if self._lock is None or not records:
+            return
+        try:
+            with open(self._path(hour), 'ab') as f:
+                f.write(''.join(records))
+        except EnvironmentError as e:
+            LOG.error('Failed to store ledger: %r', e)
+
+    def expire(self, now):
+        """Drops the buckets and files older than the retention period
+        """
+        oldest = now - self.retention
+        for hour in [h for h in self.buckets if h < oldest]:
+            del self.buckets[hour]
+        if self._lock is None:
+            return
+        keep = datetime.utcfromtimestamp(oldest).strftime(FILE_FORMAT)
+        try:
+            for name in os.listdir(self.directory):
+                if name.endswith('.ledger') and name < keep:
+                    os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            LOG.error('Failed to expire ledger: %r', e)
+
+    def account(self, clients, now=None):
+        """Adds the traffic of `clients` since the previous sample
+
+        :param list(dict) clients: as `utils.get_client_list`
+        :param float now: seconds since the epoch of the sample
+        """
+        if now is None:
+            now = time.time()
+        hour = int(now) - int(now) % HOUR
+        if self._hour is not None and hour != self._hour:
+            self.store(self._hour, self.buckets[self._hour])
+            self.expire(now)
+        self._hour = hour
+        counters = {}
+        for client in clients:
+            try:
+                mac = client['mac_address'].lower()
+                rx, tx = int(client['rx_bytes']), int(client['tx_bytes'])
+            except (KeyError, ValueError, AttributeError) as e:
+                LOG.error('Unexpected client counters: %r', e)
+                continue
+            session = client.get('session_id')
+            counters[mac] = (session, rx, tx)
+            previous = self._counters.get(mac)
+            if previous is None:
+                # a new client, unless there is no baseline yet (e.g. just
+                # after a restart)
+                if self._sampled:
+                    self._add(hour, mac, rx, tx)
+                continue
+            session0, rx0, tx0 = previous
+            if session != session0 or rx < rx0 or tx < tx0:
+                self._add(hour, mac, rx, tx)
+            else:
+                self._add(hour, mac, rx - rx0, tx - tx0)
+        self._counters = counters
+        self._sampled = True
+
+    def _add(self, hour, mac, rx, tx):
+        usage = self.buckets[hour][mac]
+        usage[0] += rx
+        usage[1] += tx
+
+    def usage(self, start=None, end=None):
+        """Sums the traffic of each client over the hours from `start` to
+        `end`
+
+        :return: dict mac -> [rx bytes, tx bytes]
+        """
+        totals = defaultdict(lambda: [0, 0])
+        for hour, usage in self.buckets.items():
+            if ((start is not None and hour + HOUR <= start) or
+                    (end is not None and hour > end)):
+                continue
+            for mac, (rx, tx) in usage.items():
+                totals[mac][0] += rx
+                totals[mac][1] += tx
+        return totals
+
+    def top_talkers(self, start=None, end=None, limit=10):
+        """Gets the clients that transferred the most bytes
+
+        :return: list(dict) busiest first
+        """
+        totals = sorted(self.usage(start, end).items(),
+                        key=lambda item: sum(item[1]), reverse=True)
+        return [dict(mac_address=mac, rx_bytes=rx, tx_bytes=tx,
+                     total_bytes=rx + tx)
+                for mac, (rx, tx) in totals[:limit]]
+
+    def client_usage(self, mac, start=None, end=None):
+        """Gets the hourly traffic of client `mac`
+
+        :return: list(dict) oldest first
+        """
+        mac = mac.lower()
+        hours = []
+        for hour in sorted(self.buckets):
+            if ((start is not None and hour + HOUR <= start) or
+                    (end is not None and hour > end)):
+                continue
+            if mac in self.buckets[hour]:
+                rx, tx = self.buckets[hour][mac]
+                hours.append(dict(timestamp=stats.format_timestamp(hour),
+                                  rx_bytes=rx, tx_bytes=tx))
+        return hours
+
+    def flush(self):
+        """Stores the traffic of the open bucket so far
+        """
+        if self._hour is not None:
+            self.store(self._hour, self.buckets[self._hour])
+
+
+LEDGER = Ledger(LEDGER_DIR)
+atexit.register(LEDGER.flush)
+
+
+def account(clients, sampled_at):
+    """Accounts a sample of the connected clients (a telemetry listener)
+    """
+    LEDGER.account(clients, sampled_at)
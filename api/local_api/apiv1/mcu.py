@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Access to the SupaBRCK's power management MCU.
+
+Reads go through ``querymcu``: the MCU's serial commands for them are not
+confirmed, and a wrong one would cost every read the port timeout. Writes
+(e.g. the `WRC` config) go straight to the serial port, which is only
+held open for the write so that it is free for ``querymcu`` otherwise. A
+lock serializes reads and writes so that a write never races a read.
+"""
+
+import serial
+from eventlet.semaphore import Semaphore
+
+from .process import run_command
+
+LOG = __import__('logging').getLogger()
+
+DEVICE = '/dev/ttyACM0'
+TIMEOUT = 3
+
+# query name -> querymcu arguments
+QUERIES = {
+    'get_config': ['get_config'],
+    'battery': ['battery'],
+    'battery_extended': ['battery', '--extended'],
+    'version': ['version'],
+}
+
+
+class MCUError(Exception):
+    """Raised when the MCU port fails.
+    """
+
+
+class MCUClient(object):
+    """Serializes access to the MCU.
+    """
+
+    def __init__(self, device=DEVICE, timeout=TIMEOUT):
+        self.device = device
+        self.timeout = timeout
+        self.lock = Semaphore(1)
+
+    def query(self, args):
+        """Runs ``querymcu`` with `args`
+
+        :return: str|False
+        """
+        with self.lock:
+            return run_command(['querymcu'] + args, output=True)
+
+    def write(self, command):
+        """Writes `command` to the port without waiting for a response
+        """
+        with self.lock:
+            try:
+                port = serial.Serial(self.device, timeout=self.timeout)
+                try:
+                    port.write(command.encode('ascii'))
+                finally:
+                    port.close()
+            except (serial.SerialException, OSError) as e:
+                raise MCUError(str(e))
+
+
+_CLIENT = None
+
+
+def get_client():
+    """Gets the process-wide MCU client
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = MCUClient()
+    return _CLIENT
+
+
+def query(name):
+    """Runs a `querymcu` query e.g. ``query('battery')``
+
+    :param str name: query name (see `QUERIES`)
+    :return: str|False
+    """
+    return get_client().query(QUERIES[name])
+
+
+def write(command):
+    """Writes a command (e.g. `WRC...`) to the MCU
+
+    :return: bool
+    """
+    try:
+        get_client().write(command)
+        return True
+    except MCUError as e:
+        LOG.error("Failed to write MCU command: %r", e)
+        return False
@@ -4,6 +4,7 @@ try:
 except ImportError:
     spwd = None
 import crypt
+import hashlib
 
 from datetime import timedelta, datetime
 
@@ -165,16 +166,24 @@ def delete_user(login):
     return completed
 
 
+def _login_attempts_key(login):
+    # the login is hashed so that whatever it is made of, the key stays in
+    # the `login_attempts` cache namespace
+    if isinstance(login, unicode):
+        login = login.encode('utf-8')
+    return 'login_attempts/{}'.format(hashlib.sha1(login).hexdigest())
+
+
 def log_failed_login_attempt(login):
     """
     Log failed login attempts
     Stores failed login attempt in cache for up to one hour.
     :return: None
     """
-    _key = 'login_attempts_{}'.format(login)
-    attempts = CACHE.get(_key) or 0
-    _attempt_count = attempts + 1
-    CACHE.set(_key, _attempt_count, timeout=(MINUTE * 60))
+    _key = _login_attempts_key(login)
+    # add/inc are atomic when the cache is shared between workers
+    if not CACHE.add(_key, 1, timeout=(MINUTE * 60)):
+        CACHE.inc(_key)
 
 
 def check_login_attempt(login):
@@ -184,7 +193,7 @@ def check_login_attempt(login):
     :return: None
     """
     max_attempts = 100
-    _key = 'login_attempts_{}'.format(login)
+    _key = _login_attempts_key(login)
     attempts = CACHE.get(_key) or 0
     LOG.warn('Login: Attempts for [%s] : [%d]', login, attempts)
     if attempts >= max_attempts:
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent AT command channel to the WAN modem.
+
+Keeps the modem's AT port open for the life of the process instead of
+forking ``querymodem`` for every query. Commands are serialized through a
+queue served by a single greenlet, and several queries may share a single
+round-trip (``AT+CGSN;+CIMI;+CSQ``).
+
+When the AT port is unavailable, queries fall back to ``querymodem``.
+"""
+
+import os
+import re
+
+import eventlet
+import serial
+from eventlet.event import Event
+from eventlet.queue import Queue
+
+from .process import run_command
+
+LOG = __import__('logging').getLogger()
+
+DEVICE = '/dev/ttyUSB2'
+BAUDRATE = 115200
+TIMEOUT = 5
+STATE_UNKNOWN = 'UNKNOWN'
+
+REG_FINAL = re.compile(
+    r'^(OK|ERROR|NO CARRIER|COMMAND NOT SUPPORT|\+CM[ES] ERROR.*)$')
+REG_PREFIX = re.compile(r'^([\+\^][\w\-]+):\s*(.*)$')
+REG_QUOTED = re.compile(r'"([^"]*)"')
+
+ACCESS_TECH_MAP = {'0': 'GSM', '2': 'WCDMA', '3': 'EDGE', '4': 'HSDPA',
+                   '5': 'HSUPA', '6': 'HSPA', '7': 'LTE'}
+MOBILE_TECH_MAP = {'0': 'GSM (EDGE)', '2': 'UMTS (3G)', '5': 'LTE (4G)'}
+
+
+class ModemError(Exception):
+    """Raised when the AT port fails or times out.
+    """
+
+
+def _parse_pin_state(value):
+    return value.strip()
+
+
+def _parse_carrier(value):
+    names = REG_QUOTED.findall(value)
+    return names[0] if names else value.split(',')[0]
+
+
+def _parse_signal(value):
+    return value.split(',')[0].strip()
+
+
+def _parse_temperature(value):
+    try:
+        return str(int(value.split(',')[0]) / 10.0)
+    except ValueError:
+        return value
+
+
+def _parse_network_mode(value):
+    fields = value.split(',')
+    if len(fields) < 4:
+        return 'NO SERVICE'
+    return ACCESS_TECH_MAP.get(fields[3].strip(), STATE_UNKNOWN)
+
+
+def parse_cell_info(value):
+    """Parses an `AT+XCELLINFO?` response into the serving cell
+
+    :return: dict with `mnc`, `lac`, `cell_id` and `net_type`
+    :raises ValueError: on an unexpected response
+    """
+    cell_data = value.split(',')
+    if len(cell_data) < 6:
+        raise ValueError('Unexpected cell information: %r' % value)
+    _mode, cell_type, _mcc, mnc, lac, cell_id = cell_data[:6]
+    return dict(
+        mnc=mnc,
+        lac=int('0x{}'.format(lac), 16),
+        cell_id=int('0x{}'.format(cell_id), 16),
+        net_type=MOBILE_TECH_MAP.get(cell_type, 'Unknown'))
+
+
+# querymodem sub-command -> (AT command, response parser)
+QUERIES = {
+    'check_pin': ('+CPIN?', _parse_pin_state),
+    'carrier': ('+COPS?', _parse_carrier),
+    'imei': ('+CGSN', None),
+    'imsi': ('+CIMI', None),
+    'signal': ('+CSQ', _parse_signal),
+    'model_id': ('+CGMM', None),
+    'temp': ('^CHIPTEMP?', _parse_temperature),
+    'temperature': ('^CHIPTEMP?', _parse_temperature),
+    'network_mode': ('+COPS?', _parse_network_mode),
+}
+
+
+def _prefix(command):
+    """Gets the response prefix of an AT command e.g. `+CSQ` for `+CSQ?`
+
+    Commands answering with bare values (e.g. `+CGSN`) have no prefix.
+    """
+    name = re.split(r'[?=]', command)[0]
+    if name in ('+CGSN', '+CIMI', '+CGMM', '+CGMI', '+CGMR'):
+        return None
+    return name
+
+
+class ModemSession(object):
+    """A long-lived connection to the modem's AT port.
+
+    All port access happens in one worker greenlet which serves queued
+    commands in order, so callers never interleave on the port.
+    """
+
+    def __init__(self, device=DEVICE, timeout=TIMEOUT):
+        self.device = device
+        self.timeout = timeout
+        self.port = None
+        self.jobs = Queue()
+        self.worker = None
+
+    @property
+    def available(self):
+        return self.port is not None or os.path.exists(self.device)
+
+    def _open(self):
+        self.port = serial.Serial(
+            self.device, baudrate=BAUDRATE, timeout=self.timeout)
+        # disable command echo
+        self._transact(['E0'])
+
+    def close(self):
+        if self.port is not None:
+            try:
+                self.port.close()
+            except Exception as e:
+                LOG.error('Failed to close modem port: %r', e)
+        self.port = None
+
+    def _readline(self):
+        line = self.port.readline()
+        if not line:
+            raise ModemError('Timed out waiting for modem response')
+        return line.decode('ascii', 'ignore').strip()
+
+    def _transact(self, commands):
+        """Sends `commands` on one AT command line and reads the response.
+
+        :param list(str) commands: commands without the `AT` prefix
+        :return: (list(list(str)), str) info lines per command and the final result code
+        """
+        line = 'AT' + ';'.join(commands)
+        self.port.reset_input_buffer()
+        self.port.write((line + '\r').encode('ascii'))
+        prefixes = [_prefix(c) for c in commands]
+        bare = [i for (i, p) in enumerate(prefixes) if p is None]
+        results = [[] for _ in commands]
+        while True:
+            resp = self._readline()
+            if not resp or resp == line:
+                continue
+            if REG_FINAL.match(resp):
+                return (results, resp)
+            match = REG_PREFIX.match(resp)
+            if match:
+                prefix = match.group(1)
+                if prefix in prefixes:
+                    results[prefixes.index(prefix)].append(match.group(2))
+                else:
+                    LOG.debug('Ignoring unsolicited modem result: %s', resp)
+            elif bare:
+                results[bare[0]].append(resp)
+                if len(bare) > 1:
+                    bare.pop(0)
+
+    def _serve(self):
+        while True:
+            commands, event = self.jobs.get()
+            try:
+                if self.port is None:
+                    self._open()
+                event.send(self._transact(commands))
+            except Exception as e:
+                LOG.error('Modem command failed: %r | %r', commands, e)
+                self.close()
+                event.send_exception(ModemError(str(e)))
+
+    def execute(self, commands):
+        """Queues `commands` for a single round-trip and waits for the response.
+
+        :return: (list(list(str)), str)
+        """
+        if self.worker is None or self.worker.dead:
+            self.worker = eventlet.spawn(self._serve)
+        event = Event()
+        self.jobs.put((commands, event))
+        return event.wait()
+
+
+_SESSION = None
+
+
+def get_session():
+    """Gets the process-wide modem session
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = ModemSession()
+    return _SESSION
+
+
+def _format(lines, final, parser=None):
+    if not lines:
+        return final
+    value = '\n'.join(lines)
+    return parser(value) if parser else value
+
+
+def query_many(*names):
+    """Runs several `querymodem` style queries in one round-trip.
+
+    :param str names: query names e.g. `imei`, `signal` (see `QUERIES`)
+    :return: dict (query name -> response string or `False` on failure)
+    """
+    session = get_session()
+    commands = []
+    for name in names:
+        command = QUERIES[name][0]
+        if command not in commands:
+            commands.append(command)
+    if session.available:
+        try:
+            results, final = session.execute(commands)
+            if final != 'OK' and len(commands) > 1:
+                # one failing command fails the whole line, retry separately
+                responses = [session.execute([c]) for c in commands]
+            else:
+                responses = [([lines], final) for lines in results]
+            resp = {}
+            for name in names:
+                command, parser = QUERIES[name]
+                lines, final = responses[commands.index(command)]
+                resp[name] = _format(lines[0], final, parser)
+            return resp
+        except ModemError as e:
+            LOG.error('Falling back to querymodem: %r', e)
+    return dict(
+        (n, run_command(['querymodem', n], output=True, shared=True))
+        for n in names)
+
+
+def query(name):
+    """Runs a single `querymodem` style query e.g. ``query('imei')``
+
+    :return: str|False
+    """
+    return query_many(name)[name]
+
+
+def run(command):
+    """Runs a raw AT command e.g. ``run('AT+XCELLINFO?')``
+
+    The response prefix is stripped from information lines. Commands with
+    no information response return the final result code (e.g. `OK`).
+
+    :return: str|False
+    """
+    session = get_session()
+    if session.available:
+        at_command = re.sub(r'^AT', '', command, flags=re.IGNORECASE)
+        try:
+            results, final = session.execute([at_command])
+            return _format(results[0], final)
+        except ModemError as e:
+            LOG.error('Falling back to querymodem: %r', e)
+    return run_command(['querymodem', 'run', command], output=True)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cooperative execution of external commands.
+
+Commands run through eventlet's green subprocess so that waiting on a
+child process yields to the hub instead of stalling the (single) worker.
+Every command has a timeout after which it is killed, and at most
+`MAX_PROCESSES` run at any one time. Blocking calls with no green
+equivalent (e.g. sysfs writes) can be pushed to a thread with
+`run_in_thread`.
+
+Read-only commands may be run with ``shared=True`` so that identical
+commands issued at the same time share one child process.
+"""
+
+import eventlet
+from eventlet import tpool
+from eventlet.green import subprocess
+from eventlet.semaphore import Semaphore
+
+from .cache import SingleFlight
+
+LOG = __import__('logging').getLogger()
+
+TIMEOUT = 30
+MAX_PROCESSES = 4
+
+_SLOTS = Semaphore(MAX_PROCESSES)
+_FLIGHTS = SingleFlight()
+
+
+def _kill(process):
+    try:
+        process.kill()
+        process.wait()
+    except OSError:
+        pass
+
+
+def execute(command, data=None, timeout=TIMEOUT):
+    """Runs `command` to completion without blocking other greenlets.
+
+    :param list(str) command: the command and its arguments
+    :param str data: input written to the command's stdin
+    :param int timeout: seconds after which the command is killed
+    :return: (int|None, str, str) exit code (None if the command could not
+        be run or timed out), stdout and stderr
+    """
+    with _SLOTS:
+        try:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE if data is not None else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except OSError as e:
+            LOG.error('Failed to run command: %r | %r', command, e)
+            return (None, '', '')
+        try:
+            with eventlet.Timeout(timeout):
+                out, err = process.communicate(data)
+        except eventlet.Timeout:
+            LOG.error('Command timed out after %ss: %r', timeout, command)
+            _kill(process)
+            return (None, '', '')
+    return (process.returncode, out, err)
+
+
+def run_command(command, output=False, timeout=TIMEOUT, shared=False):
+    """Runs a command, a drop-in for `brck.utils.run_command`
+
+    :param list(str) command: the command and its arguments
+    :param bool output: whether to return the command's output
+    :param int timeout: seconds after which the command is killed
+    :param bool shared: whether to share the result with identical
+        commands already in flight (only for commands without side effects)
+    :return: str|bool the output stripped of surrounding whitespace (if
+        `output`) or whether the command succeeded; `False` on failure in
+        either case
+    """
+    if shared:
+        returncode, out, err = _FLIGHTS.do(
+            tuple(command), execute, command, timeout=timeout)
+    else:
+        returncode, out, err = execute(command, timeout=timeout)
+    if returncode != 0:
+        if returncode is not None:
+            LOG.error('Command failed [%s]: %r | %s', returncode, command,
+                      err.strip())
+        return False
+    if output:
+        return out.strip()
+    return True
+
+
+def run_in_thread(func, *args, **kwargs):
+    """Runs a blocking function in the thread pool and waits for it
+
+    :return: the function's return value
+    """
+    return tpool.execute(func, *args, **kwargs)
@@ -2,9 +2,10 @@
 
 import re
 
-from brck.utils import run_command
 from brck.utils import uci_get
 
+from . import event
+from . import modem
 from .utils import read_file
 from .utils import get_signal_strength
 
@@ -30,28 +31,19 @@ REG_PIN = re.compile(r'^\d{4,8}$')
 REG_PUK = re.compile(r'^\d{8}$')
 REG_APN = re.compile(r'[\w\.\-]{1,64}')
 
-MOBILE_TECH_MAP = {'0': 'GSM (EDGE)', '2': 'UMTS (3G)', '5': 'LTE (4G)'}
 
-
-@cached(timeout=(MINUTE * 10), ignore=[{}])
+@cached(timeout=(MINUTE * 10), ignore=[{}],
+        invalidate_on=[event.SIM_CHANGED])
 def get_modem_network_info(*args):
     """Gets network information.
     """
     net_info = {}
     try:
-        info_str = run_command(
-            ['querymodem', 'run', 'AT+XCELLINFO?'], output=True)
+        info_str = modem.run('AT+XCELLINFO?')
         if not info_str:
-            info_str = run_command(
-                ['querymodem', 'run', 'AT+XCELLINFO?'], output=True)
+            info_str = modem.run('AT+XCELLINFO?')
         LOG.debug("XCELL_INFO INFO: %r", info_str)
-        cell_data = info_str.split(',')
-        _mode, cell_type, _mcc, mnc, lac, cell_id = cell_data[:6]
-        net_info = dict(
-            mnc=mnc,
-            lac=int('0x{}'.format(lac), 16),
-            cell_id=int('0x{}'.format(cell_id), 16),
-            net_type=MOBILE_TECH_MAP.get(cell_type, 'Unknown'))
+        net_info = modem.parse_cell_info(info_str)
     except Exception as e:
         LOG.error("Failed to load modem network information: %r", e)
     return net_info
@@ -114,8 +106,7 @@ def get_wan_connections(sim_id=None):
             is_active_sim = (active_sims == 1
                              and net_connected) or (str(key) == active_sim)
             if is_active_sim and (not net_connected):
-                sim_status = run_command(
-                    ['querymodem', 'check_pin'], output=True) or ''
+                sim_status = modem.query('check_pin') or ''
                 if REG_PIN_LOCK.match(sim_status):
                     info['pin_locked'] = True
                 else:
@@ -131,10 +122,10 @@ def get_wan_connections(sim_id=None):
                     ex_net_info = {}
                     connected = True
                     signal_strength = get_signal_strength('wan')
-                    operator = run_command(
-                        ['querymodem', 'carrier'], output=True)
-                    imei = run_command(['querymodem', 'imei'], output=True)
-                    imsi = run_command(['querymodem', 'imsi'], output=True)
+                    modem_info = modem.query_many('carrier', 'imei', 'imsi')
+                    operator = modem_info['carrier']
+                    imei = modem_info['imei']
+                    imsi = modem_info['imsi']
                     if REG_ERROR.match(operator) or operator == "0":
                         operator = 'Unknown'
                         connected = False
@@ -211,6 +202,7 @@ def configure_sim(sim_id, big_payload):
             password=net_config.get('password', ''))
         validator.add_errors(errors)
     if validator.is_valid:
+        event.publish(event.SIM_CHANGED, sim_id=sim_id)
         return (200, 'OK')
     else:
         return (422, validator.errors)
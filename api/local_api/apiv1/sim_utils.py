@@ -4,20 +4,22 @@
 """
 
 import re
-from subprocess import call
 
 import eventlet
 
 from brck.utils import (
-    run_command,
     is_service_running,
     uci_get,
-    uci_set,
     uci_delete,
     uci_commit
 )
 
-from .utils import read_file, get_uci_state
+from . import event
+from . import modem
+from . import process
+from . import uci
+from .process import run_command
+from .utils import read_file, get_uci_state, PING_TIMEOUT
 
 
 LOG = __import__('logging').getLogger()
@@ -148,10 +150,17 @@ def start_service(name):
     run_command(['/etc/init.d/{}'.format(name), 'start'])
 
 
+def _write_value(path, value):
+    with open(path, 'w') as f:
+        f.write('{}\n'.format(value))
+
+
 def run_call(path, value):
-    command = 'echo {} > {}'.format(value, path)
-    LOG.debug('Running: %s', command)
-    call(command, shell=True)
+    LOG.debug('Writing %s to %s', value, path)
+    try:
+        process.run_in_thread(_write_value, path, value)
+    except IOError as e:
+        LOG.error('Failed to write %s to %s: %r', value, path, e)
 
 
 def get_connection_status():
@@ -160,7 +169,7 @@ def get_connection_status():
     :return bool:
     """
     command = ['ping', '-c', '2', '-I', '3g-wan', '-W', '1', '8.8.8.8']
-    return run_command(command)
+    return run_command(command, timeout=PING_TIMEOUT, shared=True)
 
 def get_sim_state(sim_id):
     """Gets SIM state as stored in UCI
@@ -179,6 +188,12 @@ def get_sim_state(sim_id):
 
 
 def set_sim_state(sim_id, pin=None, puk=None, apn=None, username=None, password=None, active=False):
+    """Saves SIM configuration (and the active SIM's WAN settings) to UCI
+
+    All changes are applied in a single UCI transaction.
+
+    :return: bool
+    """
     assert sim_id in [1, 2, 3]
     _params = dict(pin=pin,
                    puk=puk,
@@ -186,34 +201,26 @@ def set_sim_state(sim_id, pin=None, puk=None, apn=None, username=None, password=
                    username=username,
                    password=password,
                    active=int(active))
-    change_count = 0
+    txn = uci.Transaction()
     state_path = 'brck.sim%d' % sim_id
-    if not uci_get(state_path):
+    if not uci.get(state_path, with_state=False):
         LOG.debug("Initializing SIM section in uci: %s", state_path)
-        uci_set(state_path, 'sims')
-        uci_commit(state_path)
+        txn.set(state_path, 'sims')
     for name, value in _params.iteritems():
         if value:
             _path = 'brck.sim%d.%s' % (sim_id, name)
             LOG.debug("Setting UCI value: %s | %r", _path, value)
-            uci_set(_path, str(value))
-            change_count += 1
+            txn.set(_path, str(value))
     # configure active_sim
     if active:
-        uci_set('brck.active_sim', str(sim_id))
+        txn.set('brck.active_sim', str(sim_id))
         if apn:
-            uci_set('network.wan.apn', apn)
-            change_count += 1
+            txn.set('network.wan.apn', apn)
         if username:
-            uci_set('network.wan.username', username)
-            change_count += 1
+            txn.set('network.wan.username', username)
         if password:
-            uci_set('network.wan.password', password)
-            change_count += 1
-        change_count += 1
-    if change_count > 0:
-        uci_commit('brck')
-        uci_commit('network.wan')
+            txn.set('network.wan.password', password)
+    return txn.commit()
 
 
 def get_modems():
@@ -223,7 +230,7 @@ def get_modems():
     m1 = False
     m2 = False
     _path = '/sys/class/tty'
-    _paths_str = run_command(['ls', '-l', _path], output=True)
+    _paths_str = run_command(['ls', '-l', _path], output=True, shared=True)
     _paths = _paths_str.splitlines()
     matches1 = [p for p in _paths
                 if MODEM1_PATTERN.match(p)]
@@ -240,15 +247,15 @@ def restart_modem():
     """Restarts the current modem
     """
     LOG.warn("Restarting modem")
-    s0 = run_command(['querymodem', 'run', 'AT+CFUN=4'])
-    s1 = run_command(['querymodem', 'run', 'AT+CFUN=6'])
+    s0 = modem.run('AT+CFUN=4')
+    s1 = modem.run('AT+CFUN=6')
     LOG.warn("Restart modem status|%r|%r", s0, s1)
 
 
 def disable_pin(pin):
     """Disable PIN
     """
-    s0 = run_command(['querymodem', 'run', "AT+CLCK=SC,0,{}".format(pin)])
+    s0 = modem.run("AT+CLCK=SC,0,{}".format(pin))
     LOG.warn("Disable PIN status|%r", s0)
 
 
@@ -272,12 +279,11 @@ def restore_sim(sim_id):
     :param str sim_id: SIM ID (1, 2 or 3)
     """
     LOG.warn("Restoring previous SIM to|%r", sim_id)
-    if sim_id in ['1', '2', '3']:
-        uci_set('brck.active_sim', sim_id)
-        uci_commit('brck')
-    else:
-        uci_delete('brck.active_sim')
-    uci_commit('brck')
+    with uci.Transaction() as txn:
+        if sim_id in ['1', '2', '3']:
+            txn.set('brck.active_sim', sim_id)
+        else:
+            txn.delete('brck.active_sim')
 
 
 def emit_event(io, event, namespace):
@@ -321,17 +327,17 @@ def connect_sim_actual(sim_id, modem_id, previous_sim):
                 run_call(modem_flag_path, '1')
             eventlet.sleep(5)
             emit_event(io, CHECK_SIM, ns)
-            check_imei_status = run_command(['querymodem', 'imei'], output=True)
+            check_imei_status = modem.query('imei')
             LOG.warn("SIM|IMEI STATUS|%s", check_imei_status)
             requires_input = False
             wan_up_done = False
             if not REG_ERROR.match(check_imei_status):
                 emit_event(io, SIM_DETECTED, ns)
                 emit_event(io, CHECK_PIN, ns)
-                pin_status = run_command(['querymodem', 'check_pin'], output=True)
+                pin_status = modem.query('check_pin')
                 if not pin_status:
                     eventlet.sleep(2)
-                    pin_status = run_command(['querymodem', 'check_pin'], output=True)
+                    pin_status = modem.query('check_pin')
                 LOG.warn("SIM|PIN STATUS|%s", pin_status)
                 puk_path = 'brck.sim{}.puk'.format(sim_id)
                 pin_path = 'brck.sim{}.pin'.format(sim_id)
@@ -342,7 +348,7 @@ def connect_sim_actual(sim_id, modem_id, previous_sim):
                     if puk:
                         emit_event(io, SET_PUK, ns)
                         pin = pin or DEFAULT_PIN
-                        set_puk_status = run_command(['querymodem', 'run', 'AT+CPIN={},{}'.format(puk, pin)], output=True)
+                        set_puk_status = modem.run('AT+CPIN={},{}'.format(puk, pin))
                         LOG.warn("SIM|SET PUK STATUS|%s", set_puk_status)
                         if REG_OK.match(set_puk_status):
                             emit_event(io, DISABLE_PIN, ns)
@@ -351,7 +357,7 @@ def connect_sim_actual(sim_id, modem_id, previous_sim):
                             emit_event(io, PUK_OK, ns)
                             emit_event(io, CHECK_READY, ns)
                             eventlet.sleep(5)
-                            check_sim_ready_status = run_command(['querymodem', 'check_pin'], output=True)
+                            check_sim_ready_status = modem.query('check_pin')
                             if REG_READY.match(check_sim_ready_status):
                                 emit_event(io, SIM_READY, ns)
                                 ready = True
@@ -374,17 +380,17 @@ def connect_sim_actual(sim_id, modem_id, previous_sim):
                     pin = uci_get(pin_path)
                     if pin:
                         emit_event(io, SET_PIN, ns)
-                        set_pin_status = run_command(['querymodem', 'run','AT+CPIN={}'.format(pin)], output=True)
+                        set_pin_status = modem.run('AT+CPIN={}'.format(pin))
                         LOG.warn("SIM|SET PIN STATUS|%s", set_pin_status)
                         eventlet.sleep(5)
-                        sim_status = run_command(['querymodem', 'check_pin'], output=True)
+                        sim_status = modem.query('check_pin')
                         if REG_OK.match(set_pin_status) or REG_READY.match(sim_status):
                             emit_event(io, PIN_OK, ns)
                             emit_event(io, DISABLE_PIN, ns)
                             disable_pin(pin)
                             emit_event(io, CHECK_READY, ns)
                             eventlet.sleep(5)
-                            check_sim_ready_status = run_command(['querymodem', 'check_pin'], output=True)
+                            check_sim_ready_status = modem.query('check_pin')
                             if REG_READY.match(check_sim_ready_status):
                                 emit_event(io, SIM_READY, ns)
                                 ready = True
@@ -415,7 +421,7 @@ def connect_sim_actual(sim_id, modem_id, previous_sim):
                         emit_event(io, WAIT_CARRIER, ns)
                         eventlet.sleep(10)
                         emit_event(io, CHECK_CARRIER, ns)
-                        carrier_resp = run_command(['querymodem', 'carrier'], output=True)
+                        carrier_resp = modem.query('carrier')
                         LOG.warn("SIM|CHECK CARRIER STATUS|%s", carrier_resp)
                         if REG_ERROR.match(carrier_resp) or carrier_resp == "0":
                             emit_event(io, NO_CARRIER, ns)
@@ -466,6 +472,7 @@ def connect_sim_actual(sim_id, modem_id, previous_sim):
         LOG.warn('Enabling 3G Monitor')
         enable_service(THREEG_MONITOR_SERVICE)
         start_service(THREEG_MONITOR_SERVICE)
+    event.publish(event.SIM_CHANGED, sim_id=sim_id)
         
 
 def connect_sim(sim_id, pin='', puk='', apn='', username='', password=''):
@@ -1,16 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import os
-import serial
 import re
 import json
 from datetime import datetime
 
-from brck.utils import uci_set
 from brck.utils import uci_get
-from brck.utils import uci_commit
-from brck.utils import run_command
 
+from . import event
+from . import mcu
+from . import telemetry
+from . import uci
 from .schema import Validator
 from .cache import cached, MINUTE
 """
@@ -28,8 +27,6 @@ from .cache import cached, MINUTE
 """
 
 LOG = __import__('logging').getLogger()
-DEVICE = '/dev/ttyACM0'
-TIMEOUT = 3
 TIME_FORMAT = '%H:%M'
 REGEX_TIME = re.compile('^(0[0-9]|1[0-9]|2[0-3]):(0[0-9]|[1-5][0-9])$')
 REGEX_BAT_TEMP = re.compile(r'temperature\"\:([\d\.]+)')
@@ -57,30 +54,6 @@ MODE_DEFAULTS = {
 }
 
 
-def read_serial(command):
-    """Read SOC configuration via serial
-
-    :return: string
-    """
-    response = []
-    if os.path.exists(DEVICE):
-        port = serial.Serial(DEVICE, timeout=TIMEOUT)
-        loop = True
-        port.write(command)
-        while loop:
-            line = port.readline()
-            if line:
-                response.append(line.decode())
-            else:
-                loop = False
-        port.close()
-    else:
-        LOG.error("Port does not exist found at: %s", DEVICE)
-    _resp = ''.join(response)
-    _final = _resp.replace('\n', '')
-    return _final
-
-
 def parse_serial(raw_content, to_type=int):
     """Parses Serial Response into a dictionary
     :return: dict
@@ -92,15 +65,25 @@ def parse_serial(raw_content, to_type=int):
     return dict([(k.strip(), to_type(v.strip())) for k, v in tuples])
 
 
-@cached(timeout=(MINUTE * 10))
-def get_soc_settings(no_cache=False):
-    """Gets SOC settings in API-compatible format.
+def get_soc_settings():
+    """Gets the latest SOC settings sampled (see `read_soc_settings`)
+
+    :return: dict
+    """
+    return telemetry.read('power')
+
+
+def read_soc_settings():
+    """Reads SOC settings in API-compatible format from the MCU.
+
+    Not cached: it is sampled by the `power` telemetry metric, which is
+    resampled on `event.POWER_CHANGED`.
 
     :return: dict
     """
     soc_settings = {}
     try:
-        resp = run_command(['querymcu', 'get_config'], output=True) or ''
+        resp = mcu.query('get_config') or ''
         parsed = json.loads(resp)
         soc_settings[
             'on_time'] = '{d[AlarmPwrOnHour]:02d}:{d[AlarmPwrOnMinute]:02d}'.format(
@@ -122,7 +105,7 @@ def get_soc_settings(no_cache=False):
     return soc_settings
 
 
-@cached(timeout=(MINUTE * 60))
+@cached(timeout=(MINUTE * 60), stale_ttl=(MINUTE * 60 * 24), persist=True)
 def get_firmware_version():
     """Gets the firmware version
 
@@ -130,7 +113,7 @@ def get_firmware_version():
     """
     version = STATE_UNKNOWN
     try:
-        resp = run_command(['querymcu', 'version'], output=True) or ''
+        resp = mcu.query('version') or ''
         parsed = parse_serial(resp, to_type=str)
         version = '{d[Firmware Version]} : {d[Build]}'.format(d=parsed)
     except Exception as e:
@@ -138,15 +121,15 @@ def get_firmware_version():
     return version
 
 
-@cached(timeout=(MINUTE * 10), ignore=[STATE_UNKNOWN])
-def get_battery_temperature():
-    """
-    Gets the current battery temperature
+def read_battery_temperature():
+    """Reads the current battery temperature from the MCU.
+
+    Not cached: it is sampled every `TEMPERATURE_INTERVAL` by the
+    `battery_temperature` telemetry metric.
     """
     bat_temp = STATE_UNKNOWN
     try:
-        resp = run_command(
-            ['querymcu', 'battery', '--extended'], output=True) or ''
+        resp = mcu.query('battery_extended') or ''
         matches = re.findall(REGEX_BAT_TEMP, resp)
         if len(matches) == 1:
             bat_temp = float(matches[0])
@@ -215,20 +198,7 @@ def set_soc(payload):
     :return: bool
     """
     command = payload_to_command(payload)
-    status = False
-    port = None
-    try:
-        port = serial.Serial(DEVICE, timeout=TIMEOUT)
-        port.write(command)
-        status = True
-    except serial.serialutil.SerialException as exc:
-        LOG.error("Failed to connect to serial port: %r", exc)
-    except Exception as exc:
-        LOG.error("Failed to write port configuration with error: %r", exc)
-    finally:
-        if isinstance(port, serial.Serial):
-            port.close()
-    return status
+    return mcu.write(command)
 
 
 def configure_power(payload):
@@ -236,11 +206,12 @@ def configure_power(payload):
     """
     validator, payload_actual = validate_payload(payload)
     if validator.is_valid:
-        uci_set('brck.power', 'power')
-        uci_set('brck.power.mode', payload_actual['mode'])
-        uci_commit('brck.power')
+        with uci.Transaction() as txn:
+            txn.set('brck.power', 'power')
+            txn.set('brck.power.mode', payload_actual['mode'])
         status = set_soc(payload_actual)
         if status:
+            event.publish(event.POWER_CHANGED, mode=payload_actual['mode'])
             return (200, 'OK')
         else:
             return (422, {'soc': 'Command Error'})
@@ -248,7 +219,7 @@ def configure_power(payload):
         return (422, validator.errors)
 
 
-def get_power_config(**kwargs):
+def get_power_config():
     """
     Gets the current power configuraition of the device
     """
@@ -259,6 +230,6 @@ def get_power_config(**kwargs):
     else:
         mode = None
     config = dict(configured=configured, mode=mode)
-    soc_settings = get_soc_settings(**kwargs)
+    soc_settings = get_soc_settings()
     config.update(soc_settings)
     return config
\ No newline at end of file
@@ -0,0 +1,696 @@
+# -*- coding: utf-8 -*-
+
+"""
+History of device metrics in fixed-size ring buffer files.
+
+Each series (e.g. `battery`) is kept in tiers of decreasing resolution:
+the raw samples for a day, 1-minute min/max/avg buckets for a week and
+1-hour buckets for five years. The buckets are updated as samples
+arrive, and a query reads from the coarsest tier that still meets the
+requested resolution.
+
+Every tier is a memory-mapped file laid out as a header followed by
+`capacity` timestamps (uint32 seconds) and, for each field, `capacity`
+values (float32). Once full, the oldest records are overwritten so a
+tier never grows past its initial size.
+
+To spare the flash, new records are kept in memory and written out
+together every `FLUSH_INTERVAL` seconds (and on exit); a crash loses at
+most that many seconds of history, and a restart the buckets still
+open. Only one process (the first one to lock a file) records to a
+tier, the others read what it has flushed.
+"""
+
+import atexit
+import bisect
+import math
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import time
+from array import array
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime
+from operator import mul
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOG = __import__('logging').getLogger()
+
+MINUTE = 60
+HOUR = MINUTE * 60
+DAY = HOUR * 24
+
+MAGIC = 'LDRB'
+HEADER = struct.Struct('<4sIIII')  # magic, capacity, fields, head, count
+TIMESTAMP_TYPE = 'I'
+VALUE_TYPE = 'f'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S+0000'
+FLUSH_INTERVAL = MINUTE * 10
+RAW_FIELDS = ('value',)
+ROLLUP_FIELDS = ('min', 'max', 'avg', 'count')
+RAW_RETENTION = DAY
+# (file suffix, bucket width, retention) of the rollup tiers
+ROLLUPS = [('1m', MINUTE, DAY * 7), ('1h', HOUR, DAY * 365 * 5)]
+# queries without a resolution get about this many records, aggregates at
+# most this many windows
+MAX_POINTS = 500
+# records read at a time when iterating over a range
+CHUNK_SIZE = 1024
+AGGREGATES = ('min', 'max', 'avg', 'p95')
+
+STATS_DIR = os.getenv('STATS_DIR', '/storage/data/.stats')
+if os.getenv('FLASK_TESTING'):
+    STATS_DIR = None
+
+# series name -> seconds between samples
+SERIES = {}
+_HISTORIES = {}
+
+Tier = namedtuple('Tier', ['width', 'retention', 'store'])
+
+
+class RingBuffer(object):
+    """A fixed number of timestamped records, oldest overwritten first
+
+    :param str path: file backing the buffer, in memory only if None
+    :param int capacity: number of records kept
+    :param tuple(str) fields: names of the values of a record
+    :param int flush_interval: seconds between writes to the file
+    """
+
+    def __init__(self, path, capacity, fields=RAW_FIELDS,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.capacity = capacity
+        self.fields = fields
+        self.flush_interval = flush_interval
+        self._item_size = array(TIMESTAMP_TYPE).itemsize
+        self._column_size = capacity * self._item_size
+        self._size = HEADER.size + self._column_size * (len(fields) + 1)
+        self._pending = self._empty()
+        self._flushed_at = time.time()
+        self._file = None
+        self.writable = True
+        if path is None:
+            self._map = mmap.mmap(-1, self._size)
+            self._write_header(0, 0)
+        else:
+            self._map = self._open(path)
+
+    def _empty(self):
+        return (array(TIMESTAMP_TYPE),
+                [array(VALUE_TYPE) for _ in self.fields])
+
+    def _open(self, path):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT), 'r+b')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            LOG.info('Stats file in use by another process: %s', path)
+            self.writable = False
+        self._file.seek(0)
+        header = self._file.read(HEADER.size)
+        valid = (len(header) == HEADER.size and
+                 HEADER.unpack(header)[:3] == (MAGIC, self.capacity,
+                                               len(self.fields)) and
+                 os.fstat(self._file.fileno()).st_size == self._size)
+        if not valid and self.writable:
+            if header:
+                LOG.warning('Discarding stats file of another layout: %s',
+                            path)
+            self._file.truncate(0)
+            self._file.truncate(self._size)
+            self._file.seek(0)
+            self._file.write(HEADER.pack(MAGIC, self.capacity,
+                                         len(self.fields), 0, 0))
+            self._file.flush()
+        elif not valid:
+            raise IOError('Stats file not ready: %s' % path)
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        return mmap.mmap(self._file.fileno(), self._size, access=access)
+
+    def _read_header(self):
+        return HEADER.unpack(self._map[:HEADER.size])[3:]
+
+    def _write_header(self, head, count):
+        self._map[:HEADER.size] = HEADER.pack(MAGIC, self.capacity,
+                                              len(self.fields), head, count)
+
+    def _offset(self, column, index):
+        return (HEADER.size + column * self._column_size +
+                index * self._item_size)
+
+    def _column(self, column, typecode, start, end):
+        values = array(typecode)
+        values.fromstring(
+            self._map[self._offset(column, start):self._offset(column, end)])
+        return values
+
+    def append(self, timestamp, *values):
+        """Adds a record, writing the pending ones out if they are due
+        """
+        if not self.writable:
+            return
+        timestamps, columns = self._pending
+        timestamps.append(int(timestamp))
+        for column, value in zip(columns, values):
+            column.append(value)
+        if (len(timestamps) >= self.capacity or
+                time.time() - self._flushed_at >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes the pending records to the file
+        """
+        self._flushed_at = time.time()
+        timestamps, columns = self._pending
+        if not self.writable or not timestamps:
+            return
+        head, count = self._read_header()
+        # only the newest `capacity` records would survive anyway
+        columns = [c[-self.capacity:]
+                   for c in [timestamps] + columns]
+        total = len(columns[0])
+        written = 0
+        while written < total:
+            chunk = min(total - written, self.capacity - head)
+            for index, column in enumerate(columns):
+                start = self._offset(index, head)
+                self._map[start:start + chunk * self._item_size] = (
+                    column[written:written + chunk].tostring())
+            written += chunk
+            head = (head + chunk) % self.capacity
+        count = min(self.capacity, count + written)
+        self._write_header(head, count)
+        if self._file is not None:
+            self._map.flush()
+        self._pending = self._empty()
+
+    def read(self, start=None, end=None):
+        """Gets the records between `start` and `end` (inclusive)
+
+        :param int start: seconds since the epoch, from the oldest if None
+        :param int end: seconds since the epoch, up to the newest if None
+        :return: (array, dict) timestamps and the values of each field,
+            oldest first
+        """
+        head, count = self._read_header()
+        first = (head - count) % self.capacity
+        ranges = [(first, min(first + count, self.capacity))]
+        if first + count > self.capacity:
+            ranges.append((0, head))
+        timestamps, columns = self._empty()
+        for begin, stop in ranges:
+            timestamps.extend(self._column(0, TIMESTAMP_TYPE, begin, stop))
+            for index, column in enumerate(columns):
+                column.extend(
+                    self._column(index + 1, VALUE_TYPE, begin, stop))
+        timestamps.extend(self._pending[0])
+        for column, pending in zip(columns, self._pending[1]):
+            column.extend(pending)
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = (len(timestamps) if end is None
+              else bisect.bisect_right(timestamps, end))
+        return (timestamps[lo:hi],
+                dict((field, column[lo:hi])
+                     for field, column in zip(self.fields, columns)))
+
+    def _timestamp(self, index):
+        offset = self._offset(0, index % self.capacity)
+        return struct.unpack_from('<' + TIMESTAMP_TYPE, self._map, offset)[0]
+
+    def _bisect(self, first, count, timestamp, right=False):
+        # binary search on the mapped timestamps, without reading them all
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._timestamp(first + mid)
+            if value < timestamp or (right and value == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _locate(self, start, end):
+        # index of the oldest written record, and the positions from it of
+        # the records between `start` and `end`
+        head, count = self._read_header()
+        first = (head - count) % self.capacity
+        lo = 0 if start is None else self._bisect(first, count, start)
+        hi = (count if end is None
+              else self._bisect(first, count, end, right=True))
+        return (first, lo, hi)
+
+    def span(self, start=None, end=None):
+        """Gets the timestamps of the first and last records written to the
+        file between `start` and `end`, pending ones left out
+
+        :return: (int, int) (None, None) if there are none
+        """
+        first, lo, hi = self._locate(start, end)
+        if lo >= hi:
+            return (None, None)
+        return (self._timestamp(first + lo), self._timestamp(first + hi - 1))
+
+    def iter_read(self, start=None, end=None, size=CHUNK_SIZE, pending=True):
+        """Gets the records between `start` and `end` like `read`, at most
+        `size` of them at a time
+
+        :param bool pending: whether to include the records not written to
+            the file yet
+        :return: iterator of (array, dict) as `read`
+        """
+        first, lo, hi = self._locate(start, end)
+        while lo < hi:
+            begin = (first + lo) % self.capacity
+            stop = min(begin + min(size, hi - lo), self.capacity)
+            yield (self._column(0, TIMESTAMP_TYPE, begin, stop),
+                   dict((field, self._column(index + 1, VALUE_TYPE, begin,
+                                             stop))
+                        for index, field in enumerate(self.fields)))
+            lo += stop - begin
+        if not pending:
+            return
+        timestamps, columns = self._pending
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = (len(timestamps) if end is None
+              else bisect.bisect_right(timestamps, end))
+        for begin in xrange(lo, hi, size):
+            stop = min(begin + size, hi)
+            yield (timestamps[begin:stop],
+                   dict((field, column[begin:stop])
+                        for field, column in zip(self.fields, columns)))
+
+    def close(self):
+        self.flush()
+        self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+
+class Rollup(object):
+    """Min, max and average of samples in buckets of `width` seconds
+
+    The bucket being filled is kept in memory and stored once a sample
+    of a later bucket arrives.
+
+    :param RingBuffer buffer: stores the buckets, with `ROLLUP_FIELDS`
+    :param int width: seconds covered by a bucket
+    """
+
+    def __init__(self, buffer, width):
+        self.buffer = buffer
+        self.width = width
+        # [start, min, max, total, count]
+        self._bucket = None
+
+    def add(self, timestamp, value):
+        value = float(value)
+        start = int(timestamp) - int(timestamp) % self.width
+        bucket = self._bucket
+        if bucket is not None and bucket[0] != start:
+            self.close_bucket()
+            bucket = None
+        if bucket is None:
+            self._bucket = [start, value, value, value, 1]
+        else:
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+            bucket[4] += 1
+
+    def close_bucket(self):
+        if self._bucket is not None:
+            start, low, high, total, count = self._bucket
+            self.buffer.append(start, low, high, total / count, count)
+            self._bucket = None
+
+    def read(self, start=None, end=None):
+        """Gets the buckets starting between `start` and `end`, including
+        the one being filled
+
+        :return: (array, dict) as `RingBuffer.read`
+        """
+        timestamps, columns = self.buffer.read(start, end)
+        bucket = self._bucket
+        if (bucket is not None and (start is None or bucket[0] >= start) and
+                (end is None or bucket[0] <= end)):
+            timestamps.append(bucket[0])
+            columns['min'].append(bucket[1])
+            columns['max'].append(bucket[2])
+            columns['avg'].append(bucket[3] / bucket[4])
+            columns['count'].append(bucket[4])
+        return (timestamps, columns)
+
+    def span(self, start=None, end=None):
+        """Gets the start of the first and last closed buckets written to the
+        file between `start` and `end`, as `RingBuffer.span`
+        """
+        return self.buffer.span(start, end)
+
+    def iter_read(self, start=None, end=None, size=CHUNK_SIZE, pending=True):
+        """Gets the buckets like `read`, at most `size` of them at a time
+
+        :param bool pending: whether to include the bucket being filled and
+            the buckets not written to the file yet
+        :return: iterator of (array, dict) as `RingBuffer.read`
+        """
+        for chunk in self.buffer.iter_read(start, end, size, pending):
+            yield chunk
+        bucket = self._bucket
+        if (pending and bucket is not None and (start is None or bucket[0] >= start) and
+                (end is None or bucket[0] <= end)):
+            yield (array(TIMESTAMP_TYPE, [bucket[0]]),
+                   dict(min=array(VALUE_TYPE, [bucket[1]]),
+                        max=array(VALUE_TYPE, [bucket[2]]),
+                        avg=array(VALUE_TYPE, [bucket[3] / bucket[4]]),
+                        count=array(VALUE_TYPE, [bucket[4]])))
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.buffer.close()
+
+
+class History(object):
+    """The raw samples and rollups of a series
+
+    :param str name: series name e.g. `battery`
+    :param int interval: seconds between samples
+    :param str directory: where the tiers are stored, in memory if None
+    """
+
+    def __init__(self, name, interval, directory=None):
+        self.name = name
+
+        def path(suffix):
+            if directory is None:
+                return None
+            return os.path.join(directory, '%s%s.ring' % (name, suffix))
+
+        raw = RingBuffer(path(''), int(RAW_RETENTION // interval))
+        self.tiers = [Tier(interval, RAW_RETENTION, raw)]
+        for suffix, width, retention in ROLLUPS:
+            buffer = RingBuffer(path('.' + suffix), retention // width,
+                                fields=ROLLUP_FIELDS)
+            self.tiers.append(Tier(width, retention, Rollup(buffer, width)))
+
+    def add(self, timestamp, value):
+        """Records a sample in every tier
+        """
+        self.tiers[0].store.append(timestamp, value)
+        for tier in self.tiers[1:]:
+            tier.store.add(timestamp, value)
+
+    def select(self, start=None, end=None, resolution=None):
+        """Picks the coarsest tier that still has records from `start` on
+        at `resolution` seconds or finer
+
+        :param int resolution: seconds between records, defaults to what
+            gives about `MAX_POINTS` records
+        :return: Tier
+        """
+        now = time.time()
+        if resolution is None:
+            resolution = 0
+            if start is not None:
+                resolution = ((end or now) - start) / MAX_POINTS
+        covering = [
+            tier for tier in self.tiers
+            if start is None or start >= now - tier.retention
+        ] or self.tiers[-1:]
+        candidates = [t for t in covering if t.width <= resolution]
+        if candidates:
+            return candidates[-1]
+        return covering[0]
+
+    def read(self, start=None, end=None, resolution=None):
+        """Gets the records of the tier picked by `select`
+
+        :return: (Tier, array, dict) the tier, timestamps and values of
+            each field
+        """
+        tier = self.select(start, end, resolution)
+        timestamps, columns = tier.store.read(start, end)
+        return (tier, timestamps, columns)
+
+    def flush(self):
+        for tier in self.tiers:
+            tier.store.flush()
+
+    def close(self):
+        for tier in self.tiers:
+            tier.store.close()
+
+
+def register(name, interval):
+    """Declares series `name`, sampled every `interval` seconds
+
+    The interval sizes the raw tier so that it holds `RAW_RETENTION`
+    seconds of samples.
+    """
+    SERIES[name] = interval
+
+
+def get_series(name):
+    """Gets the history of series `name`, opening it if needed
+
+    :return: History
+    :raises KeyError: if the series was not registered
+    """
+    if name not in _HISTORIES:
+        _HISTORIES[name] = History(name, SERIES[name], STATS_DIR)
+    return _HISTORIES[name]
+
+
+def record(name, value, timestamp=None):
+    """Adds a sample to series `name`
+
+    Failures are logged; history is never worth failing the caller for.
+
+    :param str name: series name e.g. `battery`
+    :param float value: the sample
+    :param float timestamp: seconds since the epoch, now if None
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    try:
+        get_series(name).add(timestamp, value)
+    except (EnvironmentError, ValueError) as e:
+        LOG.error('Failed to record %s: %r', name, e)
+
+
+@atexit.register
+def flush_all():
+    """Writes the pending samples of every series to disk
+    """
+    for history in _HISTORIES.values():
+        try:
+            history.flush()
+        except (EnvironmentError, ValueError) as e:
+            LOG.error('Failed to flush stats: %r', e)
+
+
+def format_timestamp(timestamp):
+    """Formats seconds since the epoch as in the `StatRecord` schema
+
+    :return: str e.g. `2018-02-28T00:00:00+0000`
+    """
+    return datetime.utcfromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_timestamp(text):
+    """Parses a `StatRecord` timestamp or seconds since the epoch
+
+    :return: int seconds since the epoch
+    :raises ValueError: if `text` is neither
+    """
+    try:
+        return int(text)
+    except ValueError:
+        parsed = datetime.strptime(text, TIMESTAMP_FORMAT)
+        return timegm(parsed.utctimetuple())
+
+
+def _round(value):
+    # values are stored as float32, drop the digits that adds
+    return float('%.7g' % value)
+
+
+def get_records(name, start=None, end=None, resolution=None):
+    """Gets the history of series `name` in the `StatRecord` format
+
+    Records of a rollup tier carry the bucket average as their `value`
+    and its `min` and `max` too.
+
+    :param str name: series name e.g. `battery`
+    :param int start: seconds since the epoch
+    :param int end: seconds since the epoch
+    :param int resolution: seconds between records, see `History.select`
+    :return: list(dict)
+    """
+    try:
+        tier, timestamps, columns = get_series(name).read(
+            start, end, resolution)
+    except EnvironmentError as e:
+        LOG.error('Failed to read %s: %r', name, e)
+        return []
+    if 'value' in columns:
+        return [dict(timestamp=format_timestamp(t), value=_round(v))
+                for t, v in zip(timestamps, columns['value'])]
+    return [
+        dict(timestamp=format_timestamp(t), value=_round(avg),
+             min=_round(low), max=_round(high))
+        for t, avg, low, high in zip(timestamps, columns['avg'],
+                                     columns['min'], columns['max'])
+    ]
+
+
+def _sources(columns):
+    # rollups aggregate their own min/max and count-weighted averages;
+    # percentiles of bucket averages are an approximation
+    if 'value' in columns:
+        values = columns['value']
+        return (dict(min=values, max=values, avg=values, p95=values), None)
+    return (dict(min=columns['min'], max=columns['max'], avg=columns['avg'],
+                 p95=columns['avg']), columns['count'])
+
+
+def _rank(count, percent):
+    # nearest-rank percentile
+    return int(math.ceil(count * percent / 100.0)) - 1
+
+
+def _aggregate_numpy(timestamps, columns, start, step, windows, aggregates):
+    sources, weights = _sources(columns)
+    stamps = numpy.frombuffer(timestamps, dtype=numpy.uint32)
+    bounds = start + step * numpy.arange(windows + 1, dtype=numpy.int64)
+    edges = numpy.searchsorted(stamps, bounds)
+    counts = numpy.diff(edges)
+    filled = numpy.flatnonzero(counts)
+    counts = counts[filled]
+    if not len(filled):
+        return ([], dict((agg, []) for agg in aggregates))
+    offset, stop = edges[0], edges[-1]
+    starts = edges[:-1][filled] - offset
+
+    def column(values):
+        return numpy.frombuffer(values, dtype=numpy.float32)[
+            offset:stop].astype(numpy.float64)
+
+    results = {}
+    for agg in aggregates:
+        values = column(sources[agg])
+        if agg == 'min':
+            results[agg] = numpy.minimum.reduceat(values, starts)
+        elif agg == 'max':
+            results[agg] = numpy.maximum.reduceat(values, starts)
+        elif agg == 'avg':
+            if weights is None:
+                results[agg] = numpy.add.reduceat(values, starts) / counts
+            else:
+                weight = column(weights)
+                results[agg] = (numpy.add.reduceat(values * weight, starts) /
+                                numpy.add.reduceat(weight, starts))
+        elif agg == 'p95':
+            windows_of = numpy.repeat(numpy.arange(len(filled)), counts)
+            ordered = values[numpy.lexsort((values, windows_of))]
+            ranks = numpy.ceil(counts * 0.95).astype(numpy.int64) - 1
+            results[agg] = ordered[starts + ranks]
+    return (filled.tolist(),
+            dict((agg, result.tolist()) for agg, result in results.items()))
+
+
+def _aggregate_array(timestamps, columns, start, step, windows, aggregates):
+    sources, weights = _sources(columns)
+    edges = [bisect.bisect_left(timestamps, start + step * index)
+             for index in xrange(windows + 1)]
+    filled = []
+    results = dict((agg, []) for agg in aggregates)
+    for index in xrange(windows):
+        lo, hi = edges[index], edges[index + 1]
+        if lo == hi:
+            continue
+        filled.append(index)
+        for agg in aggregates:
+            values = sources[agg][lo:hi]
+            if agg == 'min':
+                results[agg].append(min(values))
+            elif agg == 'max':
+                results[agg].append(max(values))
+            elif agg == 'avg':
+                if weights is None:
+                    results[agg].append(sum(values) / len(values))
+                else:
+                    weight = weights[lo:hi]
+                    results[agg].append(
+                        sum(map(mul, values, weight)) / sum(weight))
+            elif agg == 'p95':
+                results[agg].append(
+                    sorted(values)[_rank(len(values), 95)])
+    return (filled, results)
+
+
+def aggregate(timestamps, columns, start, end, step, aggregates=AGGREGATES):
+    """Aggregates records over consecutive windows of `step` seconds
+
+    Works on whole columns at a time, with numpy when it is installed.
+
+    :param array timestamps: record timestamps, oldest first
+    :param dict columns: record values by field, as `RingBuffer.read`
+    :param int start: seconds since the epoch the first window starts at
+    :param int end: seconds since the epoch the last window ends at
+    :param int step: seconds covered by a window
+    :param list(str) aggregates: some of `AGGREGATES`
+    :return: (list, dict) the indexes of the windows with records and
+        each aggregate's value for them
+    """
+    windows = (end - start) // step + 1
+    if numpy is not None:
+        return _aggregate_numpy(timestamps, columns, start, step, windows,
+                                aggregates)
+    return _aggregate_array(timestamps, columns, start, step, windows,
+                            aggregates)
+
+
+def get_aggregates(name, start, end, step, aggregates=AGGREGATES):
+    """Gets aggregates of series `name` as columns
+
+    Windows without records are left out.
+
+    :param str name: series name e.g. `battery`
+    :param int start: seconds since the epoch
+    :param int end: seconds since the epoch
+    :param int step: seconds covered by a window, also the resolution of
+        the tier aggregated (see `History.select`)
+    :param list(str) aggregates: some of `AGGREGATES`
+    :return: dict e.g. `{'step': 60, 'timestamps': [...], 'avg': [...]}`
+    """
+    try:
+        _, timestamps, columns = get_series(name).read(start, end, step)
+    except EnvironmentError as e:
+        LOG.error('Failed to read %s: %r', name, e)
+        timestamps, columns = array(TIMESTAMP_TYPE), None
+    filled, results = ([], dict((agg, []) for agg in aggregates))
+    if timestamps:
+        filled, results = aggregate(timestamps, columns, start, end, step,
+                                    aggregates)
+    payload = dict(
+        step=step,
+        timestamps=[format_timestamp(start + step * i) for i in filled])
+    for agg in aggregates:
+        payload[agg] = [_round(value) for value in results[agg]]
+    return payload
@@ -3,17 +3,19 @@
 """FTP Configuration
 """
 
-import subprocess
 try:
     import spwd
 except ImportError:
     spwd = None
 import pwd
 
-from brck.utils import run_command
-
+from . import event
+from . import process
+from .process import run_command
 from .schema import Validator
 
+LOG = __import__('logging').getLogger()
+
 FTP_DIRECTORY = '/storage/data/ftp'
 
 
@@ -38,19 +40,13 @@ def set_user_password(login, password):
     :param password: the password to assign to the login
     :rtype boolean
     """
-    process = subprocess.Popen(['passwd', login],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    process.stdin.write('{}\n'.format(password))
-    process.stdin.write(password)
-    process.stdin.flush()
-
-    _, err = process.communicate()
-
-    if err is None or len(err) == 0:
-        return True
-    return False
+    code, _, err = process.execute(
+        ['passwd', login], data='{}\n{}'.format(password, password))
+    # None if passwd could not be run or timed out
+    if code != 0:
+        LOG.error('Failed to set the password of %s: %s', login, err)
+        return False
+    return True
 
 
 def create_user(login, password):
@@ -82,6 +78,7 @@ def configure_ftp(config):
             if not set_user_password(_login, _password):
                 v.add_error('password', 'Failed to set user password')
     if v.is_valid:
+        event.publish(event.STORAGE_CHANGED, login=config['login'])
         return (200, 'OK')
     else:
         return (422, v.errors)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background sampling of device telemetry.
+
+A single greenlet reads each registered metric (battery, storage, network
+...) on its own interval and keeps the latest reading in a shared,
+versioned snapshot. Request handlers and websocket pushes read from the
+snapshot so that the load on the hardware stays the same however many
+clients are connected.
+
+A metric can also be tied to configuration change events (see `event`):
+its reading is dropped when one is published, so that the next read
+samples it afresh rather than serving a value from before the change.
+
+Until the sampler is started (e.g. in tests or scripts) `read` calls the
+metric's reader directly.
+"""
+
+import time
+from collections import namedtuple
+
+import eventlet
+
+from . import event
+from .cache import record_age
+
+LOG = __import__('logging').getLogger()
+
+IDLE_INTERVAL = 1
+
+Metric = namedtuple('Metric', ['name', 'reader', 'interval'])
+Reading = namedtuple('Reading', ['value', 'sampled_at'])
+
+
+class Snapshot(object):
+    """Latest reading of every metric
+
+    `version` is bumped on every update so that consumers can tell
+    whether anything changed since they last looked.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._readings = {}
+
+    def __contains__(self, name):
+        return name in self._readings
+
+    def get(self, name):
+        """Gets the latest reading of `name`
+
+        :return: Reading|None
+        """
+        return self._readings.get(name)
+
+    def update(self, name, value, sampled_at=None):
+        """Stores a new reading of `name`
+        """
+        if sampled_at is None:
+            sampled_at = time.time()
+        self._readings[name] = Reading(value, sampled_at)
+        self.version += 1
+
+    def discard(self, name):
+        """Drops the reading of `name`, if any
+        """
+        if self._readings.pop(name, None) is not None:
+            self.version += 1
+
+    def as_dict(self):
+        """Gets the latest values keyed by metric name
+
+        :return: dict
+        """
+        return dict((name, reading.value)
+                    for name, reading in self._readings.iteritems())
+
+    def clear(self):
+        self._readings.clear()
+        self.version += 1
+
+
+class Sampler(object):
+    """Samples registered metrics into a `Snapshot` from one greenlet
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.snapshot = Snapshot()
+        self._due = {}
+        self._listeners = {}
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def register(self, name, reader, interval):
+        """Samples `reader()` into the snapshot every `interval` seconds
+
+        :param str name: metric name
+        :param callable reader: reads the metric from the device
+        :param float interval: seconds between samples
+        """
+        self.metrics[name] = Metric(name, reader, interval)
+        self._due[name] = 0
+
+    def listen(self, name, listener):
+        """Calls `listener(value, sampled_at)` with every sample of `name`
+
+        A failing listener is logged and does not affect the snapshot.
+        """
+        self._listeners.setdefault(name, []).append(listener)
+
+    def resample_on(self, name, *events):
+        """Drops the reading of `name` whenever one of `events` is published
+
+        :param str name: metric name
+        :param str events: event names e.g. `event.POWER_CHANGED`
+        """
+        def on_change(event_name, **data):
+            LOG.debug('Resampling %s on %s', name, event_name)
+            self.snapshot.discard(name)
+            self._due[name] = 0
+        for event_name in events:
+            event.subscribe(event_name, on_change)
+
+    def sample(self, name):
+        """Reads metric `name` now and stores it in the snapshot
+
+        :return: the value read
+        """
+        metric = self.metrics[name]
+        self._due[name] = time.time() + metric.interval
+        value = metric.reader()
+        self.snapshot.update(name, value)
+        sampled_at = self.snapshot.get(name).sampled_at
+        for listener in self._listeners.get(name, []):
+            try:
+                listener(value, sampled_at)
+            except Exception as e:
+                LOG.error('Telemetry listener failed for %s: %r', name, e)
+        return value
+
+    def resample(self, name):
+        """Samples metric `name` now if the sampler runs, e.g. when a
+        client asks for a live reading (`read` reads the device anyway
+        otherwise)
+        """
+        if self.running:
+            self.sample(name)
+
+    def sample_due(self):
+        """Samples every metric whose interval has elapsed
+
+        :return: float seconds until the next metric is due
+        """
+        for name in sorted(self.metrics):
+            if self._due[name] <= time.time():
+                try:
+                    self.sample(name)
+                except Exception as e:
+                    LOG.error('Failed to sample %s: %r', name, e)
+        if not self._due:
+            return IDLE_INTERVAL
+        return max(0, min(self._due.values()) - time.time())
+
+    def run(self):
+        while True:
+            eventlet.sleep(self.sample_due())
+
+    def start(self):
+        """Starts the sampling greenlet (once)
+        """
+        if self._thread is None:
+            self._thread = eventlet.spawn(self.run)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+        self.snapshot.clear()
+        for name in self._due:
+            self._due[name] = 0
+
+    def read(self, name):
+        """Gets the latest value of metric `name`
+
+        Served from the snapshot while the sampler runs (sampling it first
+        if it has not been read yet), otherwise read from the device.
+        """
+        reading = self.snapshot.get(name) if self.running else None
+        if reading is None:
+            # read from the device now
+            record_age(0)
+            if not self.running:
+                return self.metrics[name].reader()
+            return self.sample(name)
+        record_age(time.time() - reading.sampled_at)
+        return reading.value
+
+
+SAMPLER = Sampler()
+
+
+def register(name, reader, interval):
+    SAMPLER.register(name, reader, interval)
+
+
+def listen(name, listener):
+    SAMPLER.listen(name, listener)
+
+
+def resample_on(name, *events):
+    SAMPLER.resample_on(name, *events)
+
+
+def resample(name):
+    SAMPLER.resample(name)
+
+
+def read(name):
+    return SAMPLER.read(name)
+
+
+def start():
+    SAMPLER.start()
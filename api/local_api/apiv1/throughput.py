@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of the network connections from the kernel's byte counters.
+
+`sample` reads `/proc/net/dev` once for all interfaces and turns the
+change in each connection's counters since the previous sample into
+rates, smoothed with an exponentially weighted moving average. It is
+meant to run at a fixed cadence (see `telemetry`) so that the rates do
+not depend on how often they are asked for. Every sample is also
+recorded to the `<connection>_down` and `<connection>_up` stats series.
+"""
+
+import time
+
+from . import event
+from . import stats
+from . import uci
+
+LOG = __import__('logging').getLogger()
+
+PROC_NET_DEV = '/proc/net/dev'
+CONNECTIONS = ('wan', 'wan2', 'lan', 'wwan')
+INTERVAL = 5
+# weight of the newest rate in the moving average
+SMOOTHING = 0.3
+
+
+class Meter(object):
+    """Smoothed receive (down) and transmit (up) rates of an interface
+
+    :param str interface: the interface e.g. `eth0`
+    """
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.down = self.up = None
+        self._previous = None
+
+    def update(self, rx_bytes, tx_bytes, now):
+        """Updates the rates from the interface's counters
+
+        A counter going backwards (reset or wrapped) restarts the
+        measurement.
+
+        :return: (float, float) the new down and up rates in bytes per
+            second, None until two samples have been taken
+        """
+        previous, self._previous = self._previous, (rx_bytes, tx_bytes, now)
+        if previous is None:
+            return None
+        rx0, tx0, then = previous
+        elapsed = float(now - then)
+        if elapsed <= 0 or rx_bytes < rx0 or tx_bytes < tx0:
+            LOG.info('Restarting throughput measurement of %s',
+                     self.interface)
+            return None
+        down = (rx_bytes - rx0) / elapsed
+        up = (tx_bytes - tx0) / elapsed
+        if self.down is None:
+            self.down, self.up = down, up
+        else:
+            self.down += SMOOTHING * (down - self.down)
+            self.up += SMOOTHING * (up - self.up)
+        return (down, up)
+
+
+_METERS = {}
+
+
+def parse_net_dev(text):
+    """Parses the contents of `/proc/net/dev`
+
+    :return: dict interface -> (rx_bytes, tx_bytes)
+    """
+    counters = {}
+    for line in text.splitlines()[2:]:
+        if ':' not in line:
+            continue
+        interface, data = line.split(':', 1)
+        fields = data.split()
+        try:
+            counters[interface.strip()] = (int(fields[0]), int(fields[8]))
+        except (IndexError, ValueError):
+            LOG.error('Unexpected interface statistics: %r', line)
+    return counters
+
+
+def read_counters(path=PROC_NET_DEV):
+    """Reads the byte counters of every interface
+
+    :return: dict interface -> (rx_bytes, tx_bytes)
+    """
+    try:
+        with open(path) as f:
+            return parse_net_dev(f.read())
+    except IOError as e:
+        LOG.error('Failed to read interface statistics: %r', e)
+        return {}
+
+
+def sample():
+    """Updates the rates of every connection from the kernel's counters
+
+    :return: dict connection -> (int, int) smoothed up and down speeds in
+        bytes per second
+    """
+    now = time.time()
+    counters = read_counters()
+    speeds = {}
+    for connection in CONNECTIONS:
+        interface = uci.get('network.%s.ifname' % connection)
+        if interface not in counters:
+            _METERS.pop(connection, None)
+            continue
+        meter = _METERS.get(connection)
+        if meter is None or meter.interface != interface:
+            meter = _METERS[connection] = Meter(interface)
+        if meter.update(counters[interface][0], counters[interface][1],
+                        now) is not None:
+            stats.record('%s_down' % connection, meter.down, now)
+            stats.record('%s_up' % connection, meter.up, now)
+            speeds[connection] = (int(meter.up), int(meter.down))
+    return speeds
+
+
+def reset(name=None, **data):
+    """Restarts the measurements, e.g. after a network change
+    """
+    _METERS.clear()
+
+
+for _connection in CONNECTIONS:
+    stats.register('%s_down' % _connection, INTERVAL)
+    stats.register('%s_up' % _connection, INTERVAL)
+
+for _event in event.NETWORK_CHANGES:
+    event.subscribe(_event, reset)
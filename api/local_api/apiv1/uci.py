@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+"""
+Native reader and batched writer for UCI configuration and state.
+
+Parses ``/etc/config/<package>`` and its ``/var/state/<package>`` overlay in
+process instead of forking ``uci -P /var/state``. Each parsed package is kept
+until the mtime, inode or size of either file changes.
+
+Writes are queued on a `Transaction` and flushed through ``uci batch``.
+"""
+
+import os
+import shlex
+from collections import OrderedDict
+
+from . import process
+
+LOG = __import__('logging').getLogger()
+
+CONFIG_DIR = '/etc/config'
+STATE_DIR = '/var/state'
+
+# parsed packages keyed by (config path, state path)
+_PACKAGES = {}
+
+
+class Section(object):
+    """A UCI section: its type and ordered options.
+
+    List options are stored as python lists.
+    """
+
+    def __init__(self, section_type):
+        self.type = section_type
+        self.options = OrderedDict()
+
+
+def _stamp(path):
+    """Returns a tuple identifying the current version of the file at `path`
+
+    :return: tuple|None
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_ino, st.st_size)
+
+
+def _unquote(raw):
+    """Unquotes a UCI value, joining list values with spaces.
+
+    :return: str
+    """
+    try:
+        return ' '.join(shlex.split(raw))
+    except ValueError:
+        return raw.replace("'", "")
+
+
+def _parse_config(path, sections):
+    """Parses a UCI configuration file into `sections`
+
+    Anonymous sections are named ``@type[index]`` as in ``uci show``.
+    """
+    counters = {}
+    current = None
+    with open(path) as f:
+        for line in f:
+            try:
+                tokens = shlex.split(line, comments=True)
+            except ValueError:
+                LOG.error('Failed to parse UCI line in %s: %r', path, line)
+                continue
+            if not tokens:
+                continue
+            keyword = tokens[0]
+            if keyword == 'config' and len(tokens) >= 2:
+                section_type = tokens[1]
+                index = counters.get(section_type, 0)
+                counters[section_type] = index + 1
+                if len(tokens) >= 3:
+                    name = tokens[2]
+                else:
+                    name = '@{}[{}]'.format(section_type, index)
+                current = sections.get(name)
+                if current is None:
+                    current = sections[name] = Section(section_type)
+            elif keyword == 'option' and current and len(tokens) >= 3:
+                current.options[tokens[1]] = tokens[2]
+            elif keyword == 'list' and current and len(tokens) >= 3:
+                values = current.options.setdefault(tokens[1], [])
+                if isinstance(values, list):
+                    values.append(tokens[2])
+
+
+def _apply_state(path, sections):
+    """Applies the change lines of a ``/var/state`` file onto `sections`
+
+    Lines look like ``network.lan.up='1'``, optionally prefixed with one
+    of the uci delta markers (``-`` delete, ``+`` add, ``|`` list add,
+    ``~`` list delete, ``@`` rename, ``^`` reorder).
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            marker = ''
+            if line[0] in '-+|~@^':
+                marker, line = line[0], line[1:]
+            key, _, raw = line.partition('=')
+            parts = key.split('.', 2)
+            if len(parts) < 2:
+                continue
+            value = _unquote(raw)
+            section_name = parts[1]
+            section = sections.get(section_name)
+            if len(parts) == 2:
+                if marker == '-':
+                    sections.pop(section_name, None)
+                elif marker == '@':
+                    if section is not None:
+                        sections[value] = sections.pop(section_name)
+                elif marker != '^':
+                    if section is None:
+                        sections[section_name] = Section(value)
+                    else:
+                        section.type = value
+                continue
+            option = parts[2]
+            if marker == '-':
+                if section is not None:
+                    section.options.pop(option, None)
+                continue
+            if section is None:
+                section = sections[section_name] = Section(None)
+            if marker == '|':
+                values = section.options.get(option)
+                if not isinstance(values, list):
+                    values = [values] if values else []
+                values.append(value)
+                section.options[option] = values
+            elif marker == '~':
+                values = section.options.get(option)
+                if isinstance(values, list) and value in values:
+                    values.remove(value)
+            elif marker == '@':
+                if option in section.options:
+                    section.options[value] = section.options.pop(option)
+            else:
+                section.options[option] = value
+
+
+def load_package(package, with_state=True):
+    """Loads the parsed sections of a UCI package.
+
+    The parsed tree is reused for as long as the underlying files are
+    unchanged.
+
+    :param str package: the package name e.g. `network`
+    :param bool with_state: whether to apply the `/var/state` overlay
+    :return: OrderedDict|None (None if the package does not exist)
+    """
+    config_path = os.path.join(CONFIG_DIR, package)
+    state_path = os.path.join(STATE_DIR, package) if with_state else None
+    stamp = (_stamp(config_path), _stamp(state_path) if state_path else None)
+    cache_key = (config_path, state_path)
+    cached = _PACKAGES.get(cache_key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    if stamp == (None, None):
+        _PACKAGES.pop(cache_key, None)
+        return None
+    sections = OrderedDict()
+    try:
+        if stamp[0] is not None:
+            _parse_config(config_path, sections)
+        if stamp[1] is not None:
+            _apply_state(state_path, sections)
+    except IOError as e:
+        LOG.error('Failed to read UCI package %s: %r', package, e)
+        return None
+    _PACKAGES[cache_key] = (stamp, sections)
+    return sections
+
+
+def clear_cache(package=None):
+    """Drops parsed packages (all packages if `package` is None)
+    """
+    if package is None:
+        _PACKAGES.clear()
+        return
+    for key in list(_PACKAGES):
+        if os.path.basename(key[0]) == package:
+            _PACKAGES.pop(key, None)
+
+
+def _format(value):
+    if isinstance(value, list):
+        return ' '.join(value)
+    return value
+
+
+def show(path, with_state=True):
+    """Lists the ``(key, value)`` pairs under `path` like ``uci show``
+
+    Section entries map to the section type.
+
+    :param str path: `package`, `package.section` or `package.section.option`
+    :return: list(tuple)|None (None if nothing exists at `path`)
+    """
+    parts = path.split('.', 2)
+    sections = load_package(parts[0], with_state=with_state)
+    if sections is None:
+        return None
+    if len(parts) > 1:
+        section = sections.get(parts[1])
+        if section is None:
+            return None
+        selected = [(parts[1], section)]
+    else:
+        selected = sections.items()
+    entries = []
+    for name, section in selected:
+        base = '{}.{}'.format(parts[0], name)
+        if len(parts) == 3:
+            if parts[2] not in section.options:
+                return None
+            entries.append(('{}.{}'.format(base, parts[2]),
+                            _format(section.options[parts[2]])))
+            continue
+        if section.type is not None:
+            entries.append((base, section.type))
+        for option, value in section.options.items():
+            entries.append(('{}.{}'.format(base, option), _format(value)))
+    return entries
+
+
+def get(path, with_state=True):
+    """Gets a single value like ``uci get``
+
+    :param str path: `package.section` or `package.section.option`
+    :return: str|False
+    """
+    parts = path.split('.', 2)
+    if len(parts) < 2:
+        return False
+    sections = load_package(parts[0], with_state=with_state)
+    section = sections.get(parts[1]) if sections else None
+    if section is None:
+        return False
+    if len(parts) == 2:
+        return section.type or False
+    value = section.options.get(parts[2])
+    if value is None:
+        return False
+    return _format(value)
+
+
+def get_state(option, command='show', as_dict=True):
+    """Reads UCI state with the semantics of ``uci -P /var/state <command>``
+
+    :param str option: the uci path to read
+    :param str command: `show` or `get`
+    :param bool as_dict: whether to return `show` output as a dict
+    :return: dict|str|bool
+    """
+    if command == 'get':
+        value = get(option)
+        if value is False:
+            LOG.warn("No UCI state found at: %s", option)
+            return {} if as_dict else False
+        if as_dict:
+            return {option: value}
+        return value
+    entries = show(option)
+    if entries is None:
+        LOG.warn("No UCI state found at: %s", option)
+        return {} if as_dict else False
+    if as_dict:
+        return dict(entries)
+    return '\n'.join("{}='{}'".format(k, v) if k.count('.') > 1
+                     else '{}={}'.format(k, v) for k, v in entries)
+
+
+def _quote(value):
+    """Quotes a value for a ``uci batch`` script
+    """
+    return "'{}'".format(str(value).replace("'", "'\\''"))
+
+
+def run_batch(lines):
+    """Runs UCI commands through a single ``uci batch`` process.
+
+    :param list(str) lines: batch commands e.g. ``set network.lan.proto='dhcp'``
+    :return: bool (``True`` if every command succeeded)
+    """
+    script = '\n'.join(lines) + '\n'
+    returncode, out, err = process.execute(['uci', 'batch'], data=script)
+    if returncode != 0 or err.strip():
+        LOG.error('uci batch failed [%s]: %s %s', returncode,
+                  out.strip(), err.strip())
+        return False
+    return True
+
+
+class Transaction(object):
+    """Queues UCI changes and applies them in one ``uci batch`` run.
+
+    Changes are staged in one process and committed with one ``commit``
+    per package in a second one. If staging fails, the staged changes of
+    every touched package are reverted and nothing is committed.
+
+    May be used as a context manager, committing on a clean exit:
+
+        with Transaction() as txn:
+            txn.set('network.lan.proto', 'dhcp')
+            txn.delete('network.lan.ipaddr')
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.packages = []
+        self.committed = False
+
+    def _queue(self, command, path):
+        package = path.split('.', 1)[0]
+        if package not in self.packages:
+            self.packages.append(package)
+        self.commands.append(command)
+
+    def set(self, path, value):
+        """Queues ``uci set path=value``
+        """
+        self._queue('set {}={}'.format(path, _quote(value)), path)
+
+    def delete(self, path):
+        """Queues ``uci delete path``
+
+        Paths missing from the configuration are skipped since deleting
+        them would fail the batch.
+        """
+        if get(path, with_state=False) is False:
+            LOG.debug('Skipping delete of missing UCI option: %s', path)
+            return
+        self._queue('delete {}'.format(path), path)
+
+    def revert(self):
+        """Drops staged (uncommitted) changes of the touched packages
+        """
+        if self.packages:
+            run_batch(['revert {}'.format(p) for p in self.packages])
+
+    def commit(self):
+        """Applies and commits the queued changes.
+
+        :return: bool
+        """
+        if not self.commands:
+            self.committed = True
+            return True
+        if not run_batch(self.commands):
+            LOG.error('Rolling back UCI changes to: %s',
+                      ', '.join(self.packages))
+            self.revert()
+            return False
+        if not run_batch(['commit {}'.format(p) for p in self.packages]):
+            self.revert()
+            return False
+        for package in self.packages:
+            clear_cache(package)
+        self.committed = True
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
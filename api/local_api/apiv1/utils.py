@@ -4,8 +4,8 @@ Utilities for interacting with the filesystem.
 """
 
 import os
-import time
 import psutil
+from functools import partial
 import hashlib
 import hmac
 try:
@@ -13,13 +13,24 @@ try:
 except ImportError:
     import json
 
-from brck.utils import run_command
 from brck.utils import uci_get, uci_set, uci_commit
 from brck.utils import uci_show_config
 
-from .soc import (get_soc_settings, get_firmware_version,
-                  get_battery_temperature)
-from .cache import cached, MINUTE, CACHE
+from . import alerts
+from . import cellular
+from . import event
+from . import forecast
+from . import ledger
+from . import mcu
+from . import modem
+from . import stats
+from . import telemetry
+from . import throughput
+from . import uci
+from .process import run_command
+from .soc import (read_soc_settings, get_firmware_version,
+                  read_battery_temperature)
+from .cache import cached, warm_up, MINUTE
 
 LOG = __import__('logging').getLogger()
 
@@ -34,6 +45,14 @@ BRCK_PACKAGES = [
     'scan_wifi', 'supabrck-core'
 ]
 INTERFACE_MAP = {'lan': 'eth0', 'wan': '3g-wan'}
+PING_TIMEOUT = 5
+TEMPERATURE_INTERVAL = int(os.getenv('TEMPERATURE_INTERVAL', 60))
+TEMPERATURES = ['cpu_temperature', 'modem_temperature', 'battery_temperature']
+STORAGE_MOUNT_POINT = '/storage/data'
+STORAGE_INTERVAL = MINUTE * 10
+# usage fitted for the fill rate
+STORAGE_WINDOW = MINUTE * 60 * 24 * 3
+STORAGE_TREND = forecast.Trend(STORAGE_WINDOW)
 
 
 def get_request_log(r):
@@ -51,28 +70,14 @@ def get_uci_state(option, command='show', as_dict=True):
     """
     Gets the uci state stored at `option`
 
+    Reads the configuration and `/var/state` overlay in process (see `.uci`).
+
     :param str option: the name of the uci option
     :param str command: the command to run on state (`show` or `get`)
-    :param bool expand_options: whether the response should be expanded
+    :param bool as_dict: whether the response should be expanded
     :return: dict|string
     """
-    cmd_list = ['uci', '-P']
-    cmd_list.append('/var/state')
-
-    cmd_list.append(command)
-    cmd_list.append(option)
-
-    response = run_command(cmd_list, output=True) or ''
-    if response is False:
-        LOG.warn("No UCI state found at: %s", option)
-        return {} if as_dict else False
-    out = response
-    if as_dict:
-        out = dict()
-        if not (response is False) and len(response):
-            out.update(
-                [l.replace("'", "").split('=') for l in response.splitlines()])
-    return out
+    return uci.get_state(option, command=command, as_dict=as_dict)
 
 
 def get_signal_strength(net_type):
@@ -82,8 +87,9 @@ def get_signal_strength(net_type):
     """
     if net_type == 'wan':
         signal_strength = 0
-        model_id = run_command(['querymodem', 'model_id'], output=True)
-        resp = run_command(['querymodem', 'signal'], output=True)
+        modem_info = modem.query_many('model_id', 'signal')
+        model_id = modem_info['model_id']
+        resp = modem_info['signal']
         try:
             rssi = int(resp or '')
             if model_id == 'MU736' or not model_id:
@@ -135,9 +141,34 @@ def get_device_mode():
     return mode
 
 
-@cached(timeout=(MINUTE * 60))
-def get_storage_status(mount_point='/storage/data'):
-    """Gets the disk storage status of a BRCK device in bytes.
+def get_storage_status(mount_point=STORAGE_MOUNT_POINT):
+    """Gets the disk storage status of a BRCK device in bytes, with the
+    rate it is filling up at (bytes per second) and the seconds left until
+    it is full, both None until enough has been sampled.
+
+    Only the default mountpoint `/storage/data` is sampled, others are
+    read as they are without a fill rate.
+
+    :return: dict
+    """
+    if mount_point != STORAGE_MOUNT_POINT:
+        state = read_storage_status(mount_point)
+        state.update(fill_rate=None, time_to_full=None)
+        return state
+    state = dict(telemetry.read('storage'))
+    fill_rate = STORAGE_TREND.slope
+    time_to_full = None
+    if state['total_space']:
+        time_to_full = STORAGE_TREND.time_to(
+            state['used_space'] + state['available_space'])
+    state.update(
+        fill_rate=None if fill_rate is None else round(fill_rate, 3),
+        time_to_full=None if time_to_full is None else int(time_to_full))
+    return state
+
+
+def read_storage_status(mount_point=STORAGE_MOUNT_POINT):
+    """Reads the disk storage status of a BRCK device in bytes.
 
     The default mountpoint `/storage/data`.
 
@@ -146,20 +177,29 @@ def get_storage_status(mount_point='/storage/data'):
     """
     state = dict(total_space=0, used_space=0, available_space=0)
     try:
-        stats = os.statvfs(mount_point)
+        disk = os.statvfs(mount_point)
         state = dict(
-            total_space=stats.f_blocks * stats.f_frsize,
-            used_space=(stats.f_blocks - stats.f_bfree) * stats.f_frsize,
-            available_space=stats.f_bavail * stats.f_frsize)
+            total_space=disk.f_blocks * disk.f_frsize,
+            used_space=(disk.f_blocks - disk.f_bfree) * disk.f_frsize,
+            available_space=disk.f_bavail * disk.f_frsize)
     except OSError:
         LOG.error('Failed to get storage status for mountpoint at: %s',
                   mount_point)
     return state
 
 
-@cached(timeout=(MINUTE / 2))
-def get_battery_status(no_cache=False):
-    """Gets the battery status of the BRCK device.
+def get_battery_status():
+    """Gets the latest battery status sampled (see `read_battery_status`)
+
+    :return: dict
+    """
+    return telemetry.read('battery')
+
+
+def read_battery_status():
+    """Reads the battery status of the BRCK device.
+
+    Not cached: it is sampled by the `battery` telemetry metric.
         Sample Response:
         {
             'state': 'CHARGING',
@@ -171,7 +211,7 @@ def get_battery_status(no_cache=False):
     state = STATE_UNKNOWN
     battery_level = 0
     try:
-        raw = run_command(['querymcu', 'battery'], output=True)
+        raw = mcu.query('battery')
         bat_info = json.loads(raw)
         battery_level = bat_info['soc']
         state = 'charging' if bat_info['charging'] == 1 else 'discharging'
@@ -197,38 +237,27 @@ def get_battery_status(no_cache=False):
 
 
 def get_interface_speed(conn_name):
-    """Calculates the up/down speed in bytes of a connection
+    """Gets the smoothed up/down speed in bytes per second of a connection
+
+    See `.throughput`.
+
     :return: tuple
     """
-    up = down = 0
-    if conn_name:
-        state_path = 'network.%s.ifname' % (conn_name)
-        cache_key = 'interface_speed_{}'.format(conn_name)
-        previous_speed = CACHE.get(cache_key)
-        iface_name = get_uci_state(state_path, command='get', as_dict=False)
-        if iface_name != False:
-            rx_path = '/sys/class/net/%s/statistics/rx_bytes' % (iface_name)
-            tx_path = '/sys/class/net/%s/statistics/tx_bytes' % (iface_name)
-            rx0 = read_file(rx_path)
-            tx0 = read_file(tx_path)
-            up1, down1, delta1 = new_speed = (int(rx0), int(tx0), time.time())
-            if previous_speed:
-                up0, down0, delta0 = previous_speed
-                delta = delta1 - delta0
-                up = int((up1 - up0) / delta)
-                down = int((down1 - down0) / delta)
-            CACHE.set(cache_key, new_speed)
-    return (up, down)
-
-
-def read_network_state_file(net_state):
-    try:
-        with open('/var/state/network') as f:
-            lines = f.read().splitlines()
-            net_state.update([l.replace("'", "").split('=') for l in lines])
-    except IOError:
-        pass
-    return net_state
+    speeds = telemetry.read('throughput')
+    return speeds.get(conn_name, (0, 0))
+
+
+def get_throughput():
+    """Gets the smoothed up/down speeds of every active connection
+
+    Their history is recorded to the `<connection>_down` and
+    `<connection>_up` stats series.
+
+    :return: dict
+    """
+    speeds = telemetry.read('throughput')
+    return dict((connection, dict(up_speed=up, down_speed=down))
+                for connection, (up, down) in speeds.items())
 
 
 def get_network_status():
@@ -253,7 +282,8 @@ def get_network_status():
     num_clients = 0
     connected = False
     net_type = STATE_NO_CONNECTION
-    chilli_list = run_command(['connected_clients', 'list'], output=True)
+    chilli_list = run_command(
+        ['connected_clients', 'list'], output=True, shared=True)
     if chilli_list:
         num_clients = (chilli_list.splitlines().__len__() - 1)
     net_order = get_uci_state(
@@ -262,7 +292,6 @@ def get_network_status():
     if net_order:
         nets = [n.strip() for n in net_order.split(' ')]
         net_state = get_uci_state('network')
-        net_state = read_network_state_file(net_state)
         for net in nets:
             mapped_net = INTERFACE_MAP.get(net, '')
             conn_state = net_state.get('network.{}.connected'.format(net), '')
@@ -302,9 +331,9 @@ def get_system_state():
     :return: dict
     """
     storage_state = get_storage_status()
-    power_state = get_soc_settings()
-    network_state = get_network_status()
-    battery_state = get_battery_status()
+    power_state = telemetry.read('power')
+    network_state = telemetry.read('network')
+    battery_state = telemetry.read('battery')
     state = dict(
         storage=storage_state,
         battery=battery_state,
@@ -313,6 +342,7 @@ def get_system_state():
     return state
 
 
+@cached(timeout=(MINUTE * 60), stale_ttl=(MINUTE * 60 * 24), persist=True)
 def get_software():
     """Gets the versions of the installed software on the system.
     
@@ -320,10 +350,11 @@ def get_software():
         See the REST API documentation for payload schema.
     :return: dict
     """
-    os_version = run_command(
-        ['uname', '-s', '-r', '-v', '-o'], output=True) or STATE_UNKNOWN
+    os_version = run_command(['uname', '-s', '-r', '-v', '-o'],
+                             output=True, shared=True) or STATE_UNKNOWN
     firmware_version = get_firmware_version()
-    packages_text = run_command(['opkg', 'list-installed'], output=True) or ''
+    packages_text = run_command(
+        ['opkg', 'list-installed'], output=True, shared=True) or ''
     package_data = dict(
         [p.split(' - ') for p in packages_text.splitlines() if p])
     # we're only interested in a subset of packages
@@ -351,11 +382,49 @@ def get_os():
     returns the os version
     :return:dict
     """
-    os_version = run_command(['uname', '-v'], output=True) or STATE_UNKNOWN
+    os_version = run_command(
+        ['uname', '-v'], output=True, shared=True) or STATE_UNKNOWN
 
     return dict(os=os_version)
 
 
+def get_client_list():
+    """Gets the clients connected to the device's access point
+
+    :return: list
+    """
+    client_data = run_command(
+        ['connected_clients'], output=True, shared=True) or '{}'
+    try:
+        _data = json.loads(client_data)
+        return _data.get('clients', [])
+    except ValueError as exc:
+        LOG.error('Failed to load connected_clients: %r', exc)
+    return []
+
+
+def get_modem_temperature():
+    """Gets the modem temperature
+
+    :return: list
+    """
+    modem_temp = modem.query('temp')
+    try:
+        return [float(modem_temp)]
+    except (ValueError, TypeError) as e:
+        LOG.error('Failed to get modem temperature: %r', e)
+        return [STATE_UNKNOWN]
+
+
+def get_cpu_temperature():
+    """Gets the temperatures of the CPU cores
+
+    :return: list
+    """
+    sensors_temp = psutil.sensors_temperatures() or {}
+    return [t.current for t in sensors_temp.get('coretemp', [])]
+
+
 def get_diagnostics_data():
     """Gets diagnostics data on the SupaBRCK
     
@@ -367,39 +436,48 @@ def get_diagnostics_data():
     :return: dict
     """
     status = {}
-    client_data = run_command(['connected_clients'], output=True) or '{}'
-    try:
-        _data = json.loads(client_data)
-        status['clients'] = _data.get('clients', [])
-    except ValueError as exc:
-        LOG.error('Failed to load connected_clients: %r', exc)
-    modem_temp = run_command(['querymodem', 'temp'], output=True)
-    try:
-        status['modem'] = dict(temperature=[float(modem_temp)])
-    except (ValueError, TypeError) as e:
-        LOG.error('Failed to get modem temperature: %r', e)
-        status['modem'] = dict(temperature=[STATE_UNKNOWN])
-    bat_temp = get_battery_temperature()
-    # cpu temperatures
-    sensors_temp = psutil.sensors_temperatures() or {}
-    cpu_temps = [t.current for t in sensors_temp.get('coretemp', [])]
-    status['cpu'] = dict(temperature=cpu_temps)
-    status['battery'] = dict(temperature=[bat_temp])
+    status['clients'] = telemetry.read('clients')
+    status['modem'] = dict(temperature=telemetry.read('modem_temperature'))
+    status['cpu'] = dict(temperature=telemetry.read('cpu_temperature'))
+    status['battery'] = dict(
+        temperature=[telemetry.read('battery_temperature')])
+    return status
+
+
+def get_diagnostics_state():
+    """Gets the diagnostics data pushed to the `/diagnostics` websocket
+
+    As `get_diagnostics_data` with the clients keyed by MAC address, so that
+    the changing byte counters of a client are pushed as a patch of that
+    client (see `broadcast.make_patch`) rather than the whole list.
+
+    :return: dict
+    """
+    status = get_diagnostics_data()
+    status['clients'] = dict(
+        (client.get('mac_address') or str(index), client)
+        for index, client in enumerate(status['clients']))
     return status
 
 
 def get_modem_status():
     """
     get modem data
+    :return: dict
+    """
+    return telemetry.read('modem')
+
+
+def read_modem_status():
+    """Reads the modem temperature, signal and network mode
+
     :return: dict
     """
     modem_status = {}
-    modem_temp = run_command(
-        ['querymodem', 'temperature'], output=True) or STATE_UNKNOWN
-    modem_signal = run_command(
-        ['querymodem', 'signal'], output=True) or STATE_UNKNOWN
-    network_mode = run_command(
-        ['querymodem', 'network_mode'], output=True) or STATE_UNKNOWN
+    modem_info = modem.query_many('temperature', 'signal', 'network_mode')
+    modem_temp = modem_info['temperature'] or STATE_UNKNOWN
+    modem_signal = modem_info['signal'] or STATE_UNKNOWN
+    network_mode = modem_info['network_mode'] or STATE_UNKNOWN
 
     modem_status['temperature'] = modem_temp
     modem_status['signal'] = modem_signal
@@ -423,8 +501,8 @@ def get_power_data():
 
     return: dict
     """
-    status = dict(get_battery_status())
-    bat_temp = get_battery_temperature()
+    status = dict(telemetry.read('battery'))
+    bat_temp = telemetry.read('battery_temperature')
 
     power = dict(
         battery_percentage=status['battery_level'],
@@ -457,20 +535,12 @@ def get_connected_clients():
 
     """
 
-    status = {}
-    client_data = run_command(['connected_clients'], output=True) or '{}'
-    try:
-        _data = json.loads(client_data)
-        status['clients'] = _data.get('clients', [])
-    except ValueError as exc:
-        LOG.error('Failed to load connected_clients: %r', exc)
-
-    return status
+    return dict(clients=telemetry.read('clients'))
 
 
 def get_device_setup_data():
     login = uci_get("brck.mqtt.username")
-    output = run_command(['ifconfig', 'wlan0'], output=True)
+    output = run_command(['ifconfig', 'wlan0'], output=True, shared=True)
     if output:
         mac_addr = output.split("\n")[0].split("HWaddr")[1].strip()
     else:
@@ -478,10 +548,11 @@ def get_device_setup_data():
     return login, mac_addr
 
 
-@cached(timeout=(MINUTE * 1))
+@cached(timeout=(MINUTE * 1), negative_ttl=(MINUTE / 4),
+        invalidate_on=event.NETWORK_CHANGES)
 def get_connection_state():
     command = ['ping', '-c', '2', '-W', '1', '8.8.8.8']
-    return run_command(command)
+    return run_command(command, timeout=PING_TIMEOUT, shared=True)
 
 
 @cached(timeout=(MINUTE * 60))
@@ -529,3 +600,78 @@ def set_retail_device_registered():
 def get_device_id():
     resp = uci_get('brck.auth.uuid')
     return resp
+
+
+def warm_up_cache():
+    """Computes the slow, long-lived readings ahead of the first request
+    """
+    warm_up(get_firmware_version, get_software,
+            get_retail_registration_config)
+
+
+# Readers are looked up when sampled so that they can be patched in tests.
+TELEMETRY = [
+    ('battery', lambda: read_battery_status(), MINUTE / 2),
+    ('battery_temperature', lambda: read_battery_temperature(),
+     TEMPERATURE_INTERVAL),
+    ('power', lambda: read_soc_settings(), MINUTE * 10),
+    ('storage', lambda: read_storage_status(), STORAGE_INTERVAL),
+    ('throughput', lambda: throughput.sample(), throughput.INTERVAL),
+    ('network', lambda: get_network_status(), 5),
+    ('modem', lambda: read_modem_status(), MINUTE / 2),
+    ('cell', lambda: cellular.sample(), cellular.INTERVAL),
+    ('modem_temperature', lambda: get_modem_temperature(),
+     TEMPERATURE_INTERVAL),
+    ('cpu_temperature', lambda: get_cpu_temperature(), TEMPERATURE_INTERVAL),
+    ('clients', lambda: get_client_list(), 10),
+]
+
+for _metric in TELEMETRY:
+    telemetry.register(*_metric)
+telemetry.resample_on('power', event.POWER_CHANGED)
+telemetry.resample_on('storage', event.STORAGE_CHANGED)
+telemetry.resample_on('network', *event.NETWORK_CHANGES)
+
+
+def record_battery(battery, sampled_at):
+    """Records the level and charging current of a battery sample
+    """
+    if battery.get('state') != STATE_UNKNOWN:
+        stats.record('battery', battery['battery_level'], sampled_at)
+    current = battery.get('charging_current')
+    if isinstance(current, (int, long, float)):
+        stats.record('charging_current', current, sampled_at)
+
+
+def record_storage(storage, sampled_at):
+    """Records the used space of a storage sample and updates the fill rate
+    """
+    if not storage['total_space']:
+        return
+    if not STORAGE_TREND.samples:
+        forecast.load(STORAGE_TREND, 'storage_used', sampled_at)
+    stats.record('storage_used', storage['used_space'], sampled_at)
+    STORAGE_TREND.add(sampled_at, storage['used_space'])
+
+
+def record_temperature(metric, temperatures, sampled_at):
+    """Records the hottest of a sample's temperatures and checks it against
+    the alert rules
+    """
+    if not isinstance(temperatures, list):
+        temperatures = [temperatures]
+    readings = [t for t in temperatures if isinstance(t, (int, long, float))]
+    if readings:
+        stats.record(metric, max(readings), sampled_at)
+        alerts.evaluate(metric, max(readings), sampled_at)
+
+
+stats.register('battery', MINUTE / 2)
+stats.register('charging_current', MINUTE / 2)
+telemetry.listen('battery', record_battery)
+stats.register('storage_used', STORAGE_INTERVAL)
+telemetry.listen('storage', record_storage)
+for _metric in TEMPERATURES:
+    stats.register(_metric, TEMPERATURE_INTERVAL)
+    telemetry.listen(_metric, partial(record_temperature, _metric))
+telemetry.listen('clients', ledger.account)
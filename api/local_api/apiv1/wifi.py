@@ -4,12 +4,11 @@
 WiFi bridge/ap connection management utilities.
 """
 
-from brck.utils import (
-    uci_get,
-    uci_set,
-    uci_commit,
-    run_command
-)
+from brck.utils import uci_get
+
+from . import event
+from . import uci
+from .process import run_command
 from .utils import get_uci_state
 from .schema import Validator
 from .errors import APIError
@@ -82,10 +81,10 @@ def apply_wifi_configuration(config):
 
     :return: None
     """
+    txn = uci.Transaction()
     if uci_get('mwan3.wwan.enabled') != '1':
         LOG.warn('Enabling wwan interface')
-        uci_set('mwan3.wwan.enabled', '1')
-        uci_commit('mwan3')
+        txn.set('mwan3.wwan.enabled', '1')
     base_bridge_path = 'wireless.wifibridge.{}'
     base_radio_path = 'wireless.radio1.{}'
     mode = config['mode']
@@ -99,8 +98,8 @@ def apply_wifi_configuration(config):
                 base_bridge_path.format(k)
             )
             LOG.warn('configuring wireless [%s] | [%s]', uci_path, v)
-            uci_set(uci_path, v)
-    uci_commit('wireless')
+            txn.set(uci_path, v)
+    txn.commit()
     LOG.warn('Reloading Network')
     run_command(['wifi', 'reload'])
 
@@ -131,6 +130,7 @@ def configure_wifi(wifi_id, payload):
     v.ensure_inclusion('hwmode', ['11a', '11b', '11g'], required=False)
     if v.is_valid:
         apply_wifi_configuration(config)
+        event.publish(event.WIFI_CHANGED, wifi_id=wifi_id)
         return (200, 'OK')
     else:
         return (422, v.errors)
\ No newline at end of file
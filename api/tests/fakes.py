@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pseudo-terminal stand-ins for the serial devices on a SupaBRCK.
+"""
+
+import os
+import pty
+import re
+import threading
+import tty
+
+
+class FakeSerialDevice(object):
+    """Serves requests written to a pty from a background thread.
+
+    Subclasses implement `handle(line)` returning the bytes to write back
+    for each request line. `device` is the path to open with pyserial.
+    """
+
+    terminator = b'\r'
+
+    def __init__(self):
+        self.lines = []
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def serve(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while self.terminator in buf:
+                line, buf = buf.split(self.terminator, 1)
+                line = line.strip().decode('ascii')
+                if not line:
+                    continue
+                self.lines.append(line)
+                reply = self.handle(line)
+                if reply:
+                    os.write(self.master, reply)
+
+    def handle(self, line):
+        raise NotImplementedError()
+
+
+class FakeModem(FakeSerialDevice):
+    """Answers AT commands like the modem's AT port.
+
+    `responses` maps commands (without `AT`) to their information lines.
+    Unknown commands fail the whole command line with `ERROR`.
+    """
+
+    def __init__(self, responses):
+        super(FakeModem, self).__init__()
+        self.responses = responses
+
+    def handle(self, line):
+        info = []
+        for command in re.sub(r'^AT', '', line).split(';'):
+            if command in ('', 'E0'):
+                continue
+            if command not in self.responses:
+                return b'\r\nERROR\r\n'
+            info.extend(self.responses[command])
+        out = ''.join('\r\n{}\r\n'.format(l) for l in info) + '\r\nOK\r\n'
+        return out.encode('ascii')
+
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import mock
+
+from local_api.apiv1 import alerts
+from local_api.apiv1 import event
+
+NOW = 1519776000  # 2018-02-28T00:00:00+0000
+
+
+def test_raise_and_clear_with_hysteresis():
+    published = []
+
+    def handler(name, **alert):
+        published.append((name, alert))
+
+    book = alerts.Alerts()
+    event.subscribe(event.ALERT_RAISED, handler)
+    event.subscribe(event.ALERT_CLEARED, handler)
+    try:
+        assert book.evaluate('cpu_temperature', 79.5, NOW) == []
+        raised = book.evaluate('cpu_temperature', 81, NOW + 60)
+        assert raised == [dict(
+            metric='cpu_temperature', level=alerts.WARNING, threshold=80,
+            value=81, raised_at='2018-02-28T00:01:00+0000', active=True)]
+        # hovering around the threshold does not clear it
+        assert book.evaluate('cpu_temperature', 78, NOW + 120) == []
+        assert book.get_active()[0]['value'] == 78
+        cleared = book.evaluate('cpu_temperature', 76.5, NOW + 180)
+        assert cleared[0]['active'] is False
+        assert cleared[0]['cleared_at'] == '2018-02-28T00:03:00+0000'
+        assert book.get_active() == []
+    finally:
+        event.unsubscribe(event.ALERT_RAISED, handler)
+        event.unsubscribe(event.ALERT_CLEARED, handler)
+    assert [name for name, _ in published] == [
+        event.ALERT_RAISED, event.ALERT_CLEARED]
+
+
+def test_levels_are_independent():
+    book = alerts.Alerts()
+    with mock.patch('local_api.apiv1.alerts.event.publish'):
+        changes = book.evaluate('modem_temperature', 90, NOW)
+        assert [a['level'] for a in changes] == [
+            alerts.WARNING, alerts.CRITICAL]
+        changes = book.evaluate('modem_temperature', 80, NOW + 60)
+        assert [a['level'] for a in changes] == [alerts.CRITICAL]
+        assert [a['level'] for a in book.get_active()] == [alerts.WARNING]
+        # metrics without rules are ignored
+        assert book.evaluate('battery', 100, NOW) == []
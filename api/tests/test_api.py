@@ -5,11 +5,17 @@ import os
 import json
 import pytest
 import mock
+import zlib
 from datetime import datetime
 from psutil._common import shwtemp, snic
 
 import local_api
+from local_api.apiv1 import alerts
+from local_api.apiv1 import cellular
+from local_api.apiv1 import forecast
+from local_api.apiv1 import ledger
 from local_api.apiv1 import models
+from local_api.apiv1 import stats
 
 # inject syspath
 file_dir = os.path.dirname(os.path.abspath(__file__))
@@ -29,6 +35,7 @@ DUMMY_CHILLY_RESP = """Station                Connected time 	Signal         	In
 34:13:e8:3e:d0:7d      1044           	-27            	10             	680540         	1229742"""
 
 DUMMY_NETWORK_ORDER = 'wan lan'
+DUMMY_NETWORK_ORDER_STATE = "brck.network.order='wan lan'"
 DUMMY_SIGNAL_RESP = "24"
 DUMMY_STATE = [
     DUMMY_CHILLY_RESP, DUMMY_NETWORK_ORDER, DUMMY_WAN_STATE_RESP,
@@ -221,6 +228,19 @@ def expired_headers():
     return {'X-Auth-Token-Key': _token.token}
 
 
+@pytest.fixture
+def uci_state(tmpdir):
+    """Points the native UCI reader at temporary config/state directories.
+
+    Returns a function giving the `/var/state` file of a package.
+    """
+    config_dir = tmpdir.mkdir('config')
+    state_dir = tmpdir.mkdir('state')
+    with mock.patch('local_api.apiv1.uci.CONFIG_DIR', str(config_dir)):
+        with mock.patch('local_api.apiv1.uci.STATE_DIR', str(state_dir)):
+            yield state_dir.join
+
+
 def load_json(response):
     """Load JSON from response"""
     return json.loads(response.data.decode('utf8'))
@@ -305,7 +325,7 @@ def test_system_battery_api(client, headers):
                     'local_api.apiv1.utils.run_command',
                     side_effect=DUMMY_STATE):
                 with mock.patch(
-                        'local_api.apiv1.utils.get_battery_status',
+                        'local_api.apiv1.utils.read_battery_status',
                         side_effect=[EXPECTED_BATTERY]):
                     resp = client.get('/api/v1/system', headers=headers)
                     assert (resp.status_code == 200)
@@ -314,19 +334,18 @@ def test_system_battery_api(client, headers):
                     assert payload['battery'] == EXPECTED_BATTERY
 
 
-def test_network_status_api(client, headers):
+def test_network_status_api(client, headers, uci_state):
+    uci_state('brck').write(DUMMY_NETWORK_ORDER_STATE)
+    uci_state('network').write(DUMMY_WAN_STATE_RESP)
     with mock.patch(
             'local_api.apiv1.utils.get_interface_speed', side_effect=[(0, 0)]):
         with mock.patch(
                 'local_api.apiv1.utils.uci_get', side_effects=['ALWAYS_ON']):
             with mock.patch(
                     'local_api.apiv1.utils.run_command',
-                    side_effect=[
-                        DUMMY_CHILLY_RESP, DUMMY_NETWORK_ORDER,
-                        DUMMY_WAN_STATE_RESP, '31', BAT_SIDE_EFFECT
-                    ]):
+                    side_effect=[DUMMY_CHILLY_RESP, BAT_SIDE_EFFECT]):
                 with mock.patch(
-                        'local_api.apiv1.utils.get_battery_status',
+                        'local_api.apiv1.utils.read_battery_status',
                         side_effect=[EXPECTED_BATTERY]):
                     resp = client.get('/api/v1/system', headers=headers)
                     assert resp.status_code == 200
@@ -352,12 +371,18 @@ def test_patch_system_ok(client, headers):
         assert resp.status_code == 200
 
 
+def querymcu(command, **kwargs):
+    # answers the battery query only, as an MCU without a power config
+    if command == ['querymcu', 'battery']:
+        return BAT_SIDE_EFFECT
+    return False
+
+
 def test_get_power_config_not_configured(client, headers):
     not_configured = dict(
         configured=False, mode=None, battery=EXPECTED_BATTERY)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[BAT_SIDE_EFFECT]):
+            'local_api.apiv1.mcu.run_command', querymcu):
         with mock.patch(
                 'local_api.apiv1.soc.get_power_config',
                 side_effect=[not_configured]):
@@ -375,8 +400,7 @@ def test_get_power_config_configured(client, headers):
         configured=True, mode='ALWAYS_ON', battery=EXPECTED_BATTERY)
     with mock.patch('local_api.apiv1.soc.uci_get', side_effect=['ALWAYS_ON']):
         with mock.patch(
-                'local_api.apiv1.utils.run_command',
-                side_effect=[BAT_SIDE_EFFECT]):
+                'local_api.apiv1.mcu.run_command', querymcu):
             resp = client.get(
                 '/api/v1/power',
                 content_type='application/json',
@@ -386,6 +410,28 @@ def test_get_power_config_configured(client, headers):
             assert payload == configured
 
 
+def test_get_power_config_live_resamples(client, headers):
+    with mock.patch('local_api.apiv1.soc.uci_get', return_value=False), \
+            mock.patch('local_api.apiv1.mcu.run_command', querymcu), \
+            mock.patch('local_api.apiv1.controllers.telemetry.resample') \
+            as resample:
+        resp = client.get('/api/v1/power?live', headers=headers)
+        assert resp.status_code == 200
+        assert resample.call_args_list == [
+            mock.call('power'), mock.call('battery')]
+
+
+def test_response_reports_data_age(client, headers):
+    with mock.patch('local_api.apiv1.soc.uci_get', side_effect=['ALWAYS_ON']):
+        with mock.patch(
+                'local_api.apiv1.mcu.run_command', querymcu):
+            resp = client.get('/api/v1/power', headers=headers)
+            assert resp.status_code == 200
+            assert resp.headers['Age'] == '0'
+    resp = client.get('/api/v1/ping')
+    assert 'Age' not in resp.headers
+
+
 def test_patch_system_not_ok(client, headers):
     test_payload = dict(
         power=dict(
@@ -427,7 +473,7 @@ def test_get_sim_network(client, headers):
 def test_patch_sim(client, headers):
     test_payload = dict(
         configuration=dict(pin="1234", network=dict(apn="internet")))
-    with mock.patch('local_api.apiv1.sim.run_command', side_effect=['OK']):
+    with mock.patch('local_api.apiv1.modem.run_command', side_effect=['OK']):
         with mock.patch('local_api.apiv1.sim.connect_sim', side_effect=[{}]):
             resp = client.patch(
                 '/api/v1/networks/sim/SIM1',
@@ -438,76 +484,66 @@ def test_patch_sim(client, headers):
             assert load_json(resp)
 
 
-def test_get_ethernet_networks(client, headers):
+def test_get_ethernet_networks(client, headers, uci_state):
+    uci_state('network').write(DISCONNECTED_UCI_STATE)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[DISCONNECTED_UCI_STATE]):
-        with mock.patch(
-                'local_api.apiv1.ethernet.psutil.net_if_addrs',
-                side_effect=[{}]):
-            resp = client.get('/api/v1/networks/ethernet/', headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload[0] == EXPECTED_ETHERNET1_DISCONNECTED
+            'local_api.apiv1.ethernet.psutil.net_if_addrs',
+            side_effect=[{}]):
+        resp = client.get('/api/v1/networks/ethernet/', headers=headers)
+        assert resp.status_code == 200
+        payload = load_json(resp)
+        assert payload[0] == EXPECTED_ETHERNET1_DISCONNECTED
 
 
-def test_get_ethernet_networks_single(client, headers):
+def test_get_ethernet_networks_single(client, headers, uci_state):
+    uci_state('network').write(DISCONNECTED_UCI_STATE)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[DISCONNECTED_UCI_STATE]):
-        with mock.patch(
-                'local_api.apiv1.ethernet.psutil.net_if_addrs',
-                side_effect=[{}]):
-            resp = client.get(
-                '/api/v1/networks/ethernet/ETHERNET1', headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload == EXPECTED_ETHERNET1_DISCONNECTED
+            'local_api.apiv1.ethernet.psutil.net_if_addrs',
+            side_effect=[{}]):
+        resp = client.get(
+            '/api/v1/networks/ethernet/ETHERNET1', headers=headers)
+        assert resp.status_code == 200
+        payload = load_json(resp)
+        assert payload == EXPECTED_ETHERNET1_DISCONNECTED
 
 
-def test_get_ethernet_networks_connected(client, headers):
+def test_get_ethernet_networks_connected(client, headers, uci_state):
+    uci_state('network').write(CONNECTED_UCI_STATE)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[CONNECTED_UCI_STATE]):
-        with mock.patch(
-                'local_api.apiv1.ethernet.psutil.net_if_addrs',
-                side_effect=[DUMMY_PSUTIL_IF_ADDR]):
-            resp = client.get(
-                '/api/v1/networks/ethernet/ETHERNET1', headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload == EXPECTED_ETHERNET1_CONNECTED
+            'local_api.apiv1.ethernet.psutil.net_if_addrs',
+            side_effect=[DUMMY_PSUTIL_IF_ADDR]):
+        resp = client.get(
+            '/api/v1/networks/ethernet/ETHERNET1', headers=headers)
+        assert resp.status_code == 200
+        payload = load_json(resp)
+        assert payload == EXPECTED_ETHERNET1_CONNECTED
 
 
-def test_get_ethernet_networks_unknown(client, headers):
-    with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[DISCONNECTED_UCI_STATE]):
-        resp = client.get(
-            '/api/v1/networks/ethernet/ETHERNET9', headers=headers)
-        assert resp.status_code == 404
-        assert load_json(resp)
+def test_get_ethernet_networks_unknown(client, headers, uci_state):
+    uci_state('network').write(DISCONNECTED_UCI_STATE)
+    resp = client.get(
+        '/api/v1/networks/ethernet/ETHERNET9', headers=headers)
+    assert resp.status_code == 404
+    assert load_json(resp)
 
 
-def test_patch_ethernet_dhcp(client, headers):
+def test_patch_ethernet_dhcp(client, headers, uci_state):
     test_payload = dict(configuration=dict(dhcp_enabled=True))
+    uci_state('network').write(DISCONNECTED_UCI_STATE)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[DISCONNECTED_UCI_STATE]):
-        with mock.patch(
-                'local_api.apiv1.ethernet.psutil.net_if_addrs',
-                side_effect=[{}]):
-            resp = client.patch(
-                '/api/v1/networks/ethernet/ETHERNET1',
-                content_type='application/json',
-                data=json.dumps(test_payload),
-                headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload == EXPECTED_ETHERNET1_DISCONNECTED
+            'local_api.apiv1.ethernet.psutil.net_if_addrs',
+            side_effect=[{}]):
+        resp = client.patch(
+            '/api/v1/networks/ethernet/ETHERNET1',
+            content_type='application/json',
+            data=json.dumps(test_payload),
+            headers=headers)
+        assert resp.status_code == 200
+        payload = load_json(resp)
+        assert payload == EXPECTED_ETHERNET1_DISCONNECTED
 
 
-def test_patch_ethernet_static(client, headers):
+def test_patch_ethernet_static(client, headers, uci_state):
     test_payload = dict(
         configuration=dict(
             dhcp_enabled=False,
@@ -516,42 +552,38 @@ def test_patch_ethernet_static(client, headers):
                 netmask='255.255.255.0',
                 gateway='192.168.0.1',
                 dns='8.8.8.8,localhost')))
+    uci_state('network').write(DISCONNECTED_UCI_STATE)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[DISCONNECTED_UCI_STATE]):
-        with mock.patch(
-                'local_api.apiv1.ethernet.psutil.net_if_addrs',
-                side_effect=[{}]):
-            resp = client.patch(
-                '/api/v1/networks/ethernet/ETHERNET1',
-                content_type='application/json',
-                data=json.dumps(test_payload),
-                headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload == EXPECTED_ETHERNET1_DISCONNECTED
-
-
-def test_patch_ethernet_static_invalids(client, headers):
-    test_payload = dict(
-        configuration=dict(
-            dhcp_enabled=False,
-            network=dict(ipaddr='x', netmask='y', dns='8.8.8.8 localhost')))
-    with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[DISCONNECTED_UCI_STATE]):
+            'local_api.apiv1.ethernet.psutil.net_if_addrs',
+            side_effect=[{}]):
         resp = client.patch(
             '/api/v1/networks/ethernet/ETHERNET1',
             content_type='application/json',
             data=json.dumps(test_payload),
             headers=headers)
-        assert resp.status_code == 422
+        assert resp.status_code == 200
         payload = load_json(resp)
-        errors = payload['errors']
-        # assert 'dns' in errors (TODO - This is unpredictable - need better hostname resolution)
-        assert 'ipaddr' in errors
-        assert 'netmask' in errors
-        assert 'gateway' not in errors
+        assert payload == EXPECTED_ETHERNET1_DISCONNECTED
+
+
+def test_patch_ethernet_static_invalids(client, headers, uci_state):
+    test_payload = dict(
+        configuration=dict(
+            dhcp_enabled=False,
+            network=dict(ipaddr='x', netmask='y', dns='8.8.8.8 localhost')))
+    uci_state('network').write(DISCONNECTED_UCI_STATE)
+    resp = client.patch(
+        '/api/v1/networks/ethernet/ETHERNET1',
+        content_type='application/json',
+        data=json.dumps(test_payload),
+        headers=headers)
+    assert resp.status_code == 422
+    payload = load_json(resp)
+    errors = payload['errors']
+    # assert 'dns' in errors (TODO - This is unpredictable - need better hostname resolution)
+    assert 'ipaddr' in errors
+    assert 'netmask' in errors
+    assert 'gateway' not in errors
 
 
 def test_get_wifi_networks_no_conf(client, headers):
@@ -561,7 +593,7 @@ def test_get_wifi_networks_no_conf(client, headers):
     assert payload[0] == EXPECTED_WIFI_UNCOFIGURED
 
 
-def test_patch_wifi_ap_mode(client, headers):
+def test_patch_wifi_ap_mode(client, headers, uci_state):
     test_payload = dict(
         configuration=dict(
             mode='ap',
@@ -577,21 +609,19 @@ def test_patch_wifi_ap_mode(client, headers):
         data=json.dumps(test_payload),
         headers=headers)
     assert resp.status_code == 422
+    uci_state('network').write(WIFI_NET_STATE)
+    uci_state('wireless').write(WIFI_UCI_STATE)
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[WIFI_NET_STATE, WIFI_UCI_STATE]):
-        with mock.patch(
-                'local_api.apiv1.wifi.uci_get',
-                side_effect=['pci0000:00/0000:00:1c.3/0000:04:00.0', '1',
-                             '1']):
-            resp = client.patch(
-                '/api/v1/networks/wifi/WIFI1',
-                content_type='application/json',
-                data=json.dumps(test_payload),
-                headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload == EXPECTED_WIFI_CONFIGURED
+            'local_api.apiv1.wifi.uci_get',
+            side_effect=['pci0000:00/0000:00:1c.3/0000:04:00.0', '1', '1']):
+        resp = client.patch(
+            '/api/v1/networks/wifi/WIFI1',
+            content_type='application/json',
+            data=json.dumps(test_payload),
+            headers=headers)
+        assert resp.status_code == 200
+        payload = load_json(resp)
+        assert payload == EXPECTED_WIFI_CONFIGURED
 
 
 def test_patch_wifi_invalid(client, headers):
@@ -611,15 +641,14 @@ def test_patch_wifi_invalid(client, headers):
     assert resp.status_code == 422
 
 
-def test_get_wifi_networks_available(client, headers):
-    with mock.patch(
-            'local_api.apiv1.utils.run_command',
-            side_effect=[WIFI_NET_STATE, WIFI_UCI_STATE]):
-        with mock.patch('local_api.apiv1.wifi.uci_get', side_effect=['1']):
-            resp = client.get('/api/v1/networks/wifi/', headers=headers)
-            assert resp.status_code == 200
-            payload = load_json(resp)
-            assert payload[0] == EXPECTED_WIFI_CONFIGURED
+def test_get_wifi_networks_available(client, headers, uci_state):
+    uci_state('network').write(WIFI_NET_STATE)
+    uci_state('wireless').write(WIFI_UCI_STATE)
+    with mock.patch('local_api.apiv1.wifi.uci_get', side_effect=['1']):
+        resp = client.get('/api/v1/networks/wifi/', headers=headers)
+        assert resp.status_code == 200
+        payload = load_json(resp)
+        assert payload[0] == EXPECTED_WIFI_CONFIGURED
 
 
 def test_get_software(client, headers):
@@ -638,9 +667,11 @@ def test_get_diagnostics(client, headers):
     expected_temp = 39.2
     with mock.patch(
             'local_api.apiv1.utils.run_command',
-            side_effect=[CONNECTED_CLIENTS_SIDE_EFFECT, expected_temp]):
+            side_effect=[CONNECTED_CLIENTS_SIDE_EFFECT]), mock.patch(
+                'local_api.apiv1.modem.run_command',
+                side_effect=[expected_temp]):
         with mock.patch(
-                'local_api.apiv1.soc.run_command',
+                'local_api.apiv1.mcu.run_command',
                 side_effect=[BAX_SIDE_EFFECT]):
             with mock.patch(
                     'local_api.apiv1.utils.psutil.sensors_temperatures',
@@ -661,6 +692,202 @@ def test_get_diagnostics(client, headers):
                 assert payload['clients'][0] == CONNECTED_CLIENT_PARSED
 
 
+def test_get_battery_stats(client, headers):
+    history = stats.History('battery', 30)
+    history.add(1519776000, 77)
+    history.add(1519776030, 76.5)
+    with mock.patch.dict('local_api.apiv1.stats._HISTORIES', battery=history), \
+            mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = 1519776060
+        resp = client.get(
+            '/api/v1/system/stats/battery'
+            '?from=2018-02-28T00:00:00%2B0000&step=30',
+            headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp) == dict(records=[
+            dict(timestamp='2018-02-28T00:00:00+0000', value=77),
+            dict(timestamp='2018-02-28T00:00:30+0000', value=76.5)
+        ])
+        resp = client.get(
+            '/api/v1/system/stats/battery?from=1519776001&step=30',
+            headers=headers)
+        assert len(load_json(resp)['records']) == 1
+        resp = client.get(
+            '/api/v1/system/stats/battery?from=1519776000&step=60',
+            headers=headers)
+        assert load_json(resp) == dict(records=[
+            dict(timestamp='2018-02-28T00:00:00+0000', value=76.75, min=76.5,
+                 max=77)
+        ])
+        resp = client.get(
+            '/api/v1/system/stats/battery?to=yesterday', headers=headers)
+        assert resp.status_code == 422
+        assert 'to' in load_json(resp)['errors']
+
+
+def test_get_throughput(client, headers):
+    with mock.patch('local_api.apiv1.throughput.sample',
+                    return_value={'wan': (400, 10000)}):
+        resp = client.get('/api/v1/system/throughput', headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp) == {
+            'wan': dict(up_speed=400, down_speed=10000)
+        }
+
+
+def test_get_alerts(client, headers):
+    book = alerts.Alerts()
+    with mock.patch('local_api.apiv1.alerts.ALERTS', book), \
+            mock.patch('local_api.apiv1.alerts.event.publish'):
+        book.evaluate('battery_temperature', 52, 1519776000)
+        resp = client.get('/api/v1/system/alerts', headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp) == dict(alerts=[
+            dict(metric='battery_temperature', level='warning', threshold=50,
+                 value=52, active=True, raised_at='2018-02-28T00:00:00+0000')
+        ])
+
+
+def test_get_storage_forecast(client, headers):
+    gb = 1024 ** 3
+    trend = forecast.Trend(3600)
+    for i in range(6):
+        trend.add(1519776000 + i * 600, 40 * gb + i * 600)
+    storage = dict(total_space=100 * gb, used_space=40 * gb + 3000,
+                   available_space=60 * gb - 3000)
+    with mock.patch('local_api.apiv1.utils.STORAGE_TREND', trend), \
+            mock.patch('local_api.apiv1.utils.read_storage_status',
+                       return_value=storage):
+        resp = client.get('/api/v1/ftp', headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp)['storage'] == dict(
+            storage, fill_rate=1, time_to_full=60 * gb - 3000)
+
+
+def test_get_modem_history(client, headers):
+    log = cellular.CellLog()
+    log.observe(cellular.Cell('LTE', 2, 378, 468785), 1519776000)
+    records = [dict(timestamp='2018-02-28T00:00:00+0000', value=-65)]
+    with mock.patch('local_api.apiv1.cellular.CELLS', log), \
+            mock.patch('local_api.apiv1.stats.get_records',
+                       return_value=records) as get_records:
+        resp = client.get(
+            '/api/v1/modem/history?from=1519776000&to=1519779600',
+            headers=headers)
+        assert resp.status_code == 200
+        get_records.assert_called_once_with(
+            'wan_rssi', 1519776000, 1519779600, None)
+        assert load_json(resp) == dict(signal=records, handovers=[
+            dict(network_type='LTE', mnc=2, lac=378, cell_id=468785,
+                 timestamp='2018-02-28T00:00:00+0000')
+        ])
+
+
+def test_get_client_usage(client, headers):
+    book = ledger.Ledger()
+    book.buckets[1519776000]['dc:a9:04:81:74:4b'] = [100, 10]
+    book.buckets[1519779600]['dc:a9:04:81:74:4b'] = [200, 20]
+    with mock.patch('local_api.apiv1.ledger.LEDGER', book):
+        resp = client.get(
+            '/api/v1/clients/usage?from=1519776000&to=1519779600',
+            headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp) == dict(clients=[
+            dict(mac_address='dc:a9:04:81:74:4b', rx_bytes=300, tx_bytes=30,
+                 total_bytes=330)
+        ])
+        resp = client.get(
+            '/api/v1/clients/DC:A9:04:81:74:4B/usage?from=1519779600',
+            headers=headers)
+        assert load_json(resp) == dict(
+            mac_address='dc:a9:04:81:74:4b',
+            usage=[
+                dict(timestamp='2018-02-28T01:00:00+0000', rx_bytes=200,
+                     tx_bytes=20)
+            ])
+        resp = client.get('/api/v1/clients/usage?limit=0', headers=headers)
+        assert resp.status_code == 422
+
+
+def test_get_stats_aggregates(client, headers):
+    history = stats.History('battery_temperature', 60)
+    for minute, value in enumerate([30, 32, 40, 35]):
+        history.add(1519776000 + minute * 60, value)
+    with mock.patch.dict('local_api.apiv1.stats._HISTORIES',
+                         battery_temperature=history), \
+            mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = 1519776300
+        resp = client.get(
+            '/api/v1/system/stats/battery_temperature'
+            '?from=1519776000&to=1519776239&step=120&agg=max,avg',
+            headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp) == dict(
+            step=120,
+            timestamps=['2018-02-28T00:00:00+0000',
+                        '2018-02-28T00:02:00+0000'],
+            max=[32, 40],
+            avg=[31, 37.5])
+        resp = client.get(
+            '/api/v1/system/stats/battery_temperature?agg=median',
+            headers=headers)
+        assert resp.status_code == 422
+        assert 'agg' in load_json(resp)['errors']
+        # too many windows for the range
+        resp = client.get(
+            '/api/v1/system/stats/battery_temperature'
+            '?from=0&to=1519776239&step=1&agg=max',
+            headers=headers)
+        assert resp.status_code == 422
+        assert 'step' in load_json(resp)['errors']
+        resp = client.get(
+            '/api/v1/system/stats/battery_temperature?agg=max',
+            headers=headers)
+        assert resp.status_code == 200
+        assert load_json(resp)['step'] == 173
+    resp = client.get('/api/v1/system/stats/humidity', headers=headers)
+    assert resp.status_code == 404
+
+
+def test_export_stats(client, headers):
+    history = stats.History('battery', 30)
+    for i in range(100):
+        history.add(1519776000 + i * 30, i % 100)
+    history.flush()
+    with mock.patch.dict('local_api.apiv1.stats._HISTORIES',
+                         battery=history), \
+            mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = 1519779000
+        url = '/api/v1/system/stats/export?metrics=battery&from=1519776000'
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'] == 'application/gzip'
+        whole = resp.get_data()
+        data = zlib.decompress(whole, 16 + zlib.MAX_WBITS)
+        assert len(data.splitlines()) == 101
+        # resume with the range the export was made for, which ends at
+        # the newest record written
+        location = resp.headers['Content-Location']
+        assert 'to=1519778970' in location
+        resumed = dict(headers, Range='bytes=100-',
+                       **{'If-Range': resp.headers['ETag']})
+        resp = client.get(location, headers=resumed)
+        assert resp.status_code == 206
+        assert resp.headers['Content-Range'] == 'bytes 100-%d/%d' % (
+            len(whole) - 1, len(whole))
+        assert resp.get_data() == whole[100:]
+        # records written since are past the range, it still resumes
+        history.add(1519779000, 1)
+        history.flush()
+        resp = client.get(location, headers=resumed)
+        assert resp.status_code == 206
+        assert resp.get_data() == whole[100:]
+        resp = client.get(url + '&format=xml', headers=headers)
+        assert resp.status_code == 422
+        resp = client.get('/api/v1/system/stats/export', headers=headers)
+        assert 'metrics' in load_json(resp)['errors']
+
+
 def test_change_password(client, headers):
     # TODO investigate why this test kills tests following it (fixtures not cleaned up).
     new_password = 'freshpassword'
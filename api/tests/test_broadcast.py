@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import eventlet
+import mock
+
+from local_api.apiv1 import broadcast, utils
+
+STATE = {
+    'battery': {'state': 'CHARGING', 'battery_level': 80},
+    'network': {'connected': True, 'connection': {'connection_type': 'WAN'}},
+    'clients': ['dc:a9:04:81:74:4b'],
+}
+
+
+def make_broadcast(states=None):
+    emit = mock.Mock()
+    payload = mock.Mock(return_value={'battery': 80})
+    if states is not None:
+        payload.side_effect = states
+    return broadcast.Broadcast('/dashboard', 'system', payload, emit,
+                               interval=0.01)
+
+
+def test_make_and_apply_patch():
+    new = {
+        'battery': {'state': 'CHARGING', 'battery_level': 81},
+        'network': {'connected': False},
+        'clients': ['dc:a9:04:81:74:4b', '3c:15:c2:aa:01:02'],
+        'storage': {'used_space': 10},
+    }
+    patch, removed = broadcast.make_patch(STATE, new)
+    assert patch == {
+        'battery': {'battery_level': 81},
+        'network': {'connected': False},
+        'clients': ['dc:a9:04:81:74:4b', '3c:15:c2:aa:01:02'],
+        'storage': {'used_space': 10},
+    }
+    assert removed == [['network', 'connection']]
+    assert broadcast.apply_patch(STATE, patch, removed) == new
+    # the original is left alone
+    assert STATE['network']['connection'] == {'connection_type': 'WAN'}
+    assert broadcast.make_patch(new, new) == ({}, [])
+
+
+def test_keyed_clients_patch_the_client_changed():
+    client = {'mac_address': 'dc:a9:04:81:74:4b', 'rx_bytes': '130425',
+              'tx_bytes': '149626'}
+    other = {'mac_address': '3c:15:c2:aa:01:02', 'rx_bytes': '10',
+             'tx_bytes': '20'}
+    with mock.patch('local_api.apiv1.utils.get_diagnostics_data',
+                    side_effect=[{'clients': [client, other]},
+                                 {'clients': [dict(client, rx_bytes='140000'),
+                                              other]}]):
+        old = utils.get_diagnostics_state()
+        new = utils.get_diagnostics_state()
+    assert broadcast.make_patch(old, new) == (
+        {'clients': {'dc:a9:04:81:74:4b': {'rx_bytes': '140000'}}}, [])
+
+
+def test_one_loop_for_all_subscribers():
+    channel = make_broadcast()
+    channel.subscribe('a')
+    loop = channel._loop
+    channel.subscribe('b')
+    assert channel._loop is loop
+    # each new client gets the whole state
+    assert channel.emit.call_args_list == [
+        mock.call('system', dict(seq=1, state={'battery': 80}),
+                  namespace='/dashboard', room=sid) for sid in 'ab']
+    assert channel.payload.call_count == 1
+    eventlet.sleep(0.035)
+    # computed once per tick, not per client, and nothing sent unchanged
+    assert 3 <= channel.payload.call_count <= 5
+    assert channel.emit.call_count == 2
+    channel.unsubscribe('a')
+    channel.unsubscribe('b')
+    eventlet.sleep(0.03)
+    assert not channel.running
+
+
+def test_restarts_for_a_new_subscriber():
+    channel = make_broadcast()
+    channel.subscribe('a')
+    channel.unsubscribe('a')
+    # a client leaving without having subscribed does not matter
+    channel.unsubscribe('z')
+    eventlet.sleep(0.02)
+    assert not channel.running
+    channel.subscribe('b')
+    assert channel.running
+    # the state is computed afresh
+    assert channel.payload.call_count == 2
+    assert channel.emit.call_args[0][1]['seq'] == 2
+    channel.unsubscribe('b')
+
+
+def test_patches_are_numbered():
+    changed = dict(STATE, clients=[])
+    channel = make_broadcast([STATE, STATE, changed, ValueError('busy')])
+    channel.resync('a')
+    channel.tick()
+    channel.tick()
+    channel.tick()
+    assert channel.emit.call_args_list == [
+        mock.call('system', dict(seq=1, state=STATE),
+                  namespace='/dashboard', room='a'),
+        mock.call('system_patch', dict(seq=2, patch={'clients': []}),
+                  namespace='/dashboard')
+    ]
+    channel.resync('b')
+    channel.emit.assert_called_with(
+        'system', dict(seq=2, state=changed), namespace='/dashboard',
+        room='b')
+
+
+def test_last_state_sent_when_it_cannot_be_computed():
+    channel = make_broadcast([ValueError('busy'), STATE, ValueError('busy')])
+    # nothing to send yet, the loop tries again at its next tick
+    channel.resync('a')
+    assert not channel.emit.called
+    channel.tick()
+    channel.emit.assert_called_with(
+        'system', dict(seq=1, state=STATE), namespace='/dashboard')
+    # a new client after a restart gets the last state computed
+    channel.subscribe('b')
+    channel.emit.assert_called_with(
+        'system', dict(seq=1, state=STATE), namespace='/dashboard',
+        room='b')
+    channel.unsubscribe('b')
+    eventlet.sleep(0.02)
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+
+import json
+import multiprocessing
+
+import eventlet
+import mock
+import pytest
+
+from local_api.apiv1 import cache, event
+
+
+@pytest.fixture
+def clock():
+    now = [1000.0]
+    fake_time = mock.Mock()
+    fake_time.time.side_effect = lambda: now[0]
+    with mock.patch('local_api.apiv1.cache.CACHE', cache.LRUCache()):
+        with mock.patch('local_api.apiv1.cache.time', fake_time):
+            yield now
+
+
+def test_concurrent_calls_share_one_computation():
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_battery(no_cache=False):
+        calls.append(1)
+        eventlet.sleep(0.1)
+        return {'battery_level': 98}
+
+    pool = eventlet.GreenPool()
+    results = list(pool.imap(lambda _: read_battery(), range(5)))
+    assert results == [{'battery_level': 98}] * 5
+    assert len(calls) == 1
+
+
+def test_no_cache_joins_in_flight_call():
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_battery(no_cache=False):
+        calls.append(1)
+        eventlet.sleep(0.1)
+        return len(calls)
+
+    pool = eventlet.GreenPool()
+    results = list(pool.imap(
+        lambda _: read_battery(no_cache=True), range(3)))
+    assert results == [1, 1, 1]
+    # once the call has landed, no_cache computes afresh
+    assert read_battery(no_cache=True) == 2
+
+
+def test_different_keys_do_not_share():
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_interface(name):
+        calls.append(name)
+        eventlet.sleep(0.1)
+        return name
+
+    pool = eventlet.GreenPool()
+    assert list(pool.imap(read_interface, ['lan', 'wan'])) == ['lan', 'wan']
+    assert sorted(calls) == ['lan', 'wan']
+
+
+def test_errors_reach_every_waiter():
+    flights = cache.SingleFlight()
+
+    def fail():
+        eventlet.sleep(0.1)
+        raise ValueError('port busy')
+
+    def call(_):
+        with pytest.raises(ValueError):
+            flights.do('key', fail)
+        return True
+
+    pool = eventlet.GreenPool()
+    assert list(pool.imap(call, range(3))) == [True] * 3
+    assert flights.calls == {}
+
+
+def test_stale_value_served_while_refreshing(clock):
+    calls = []
+
+    @cache.cached(timeout=30, stale_ttl=60)
+    def read_battery(no_cache=False):
+        calls.append(1)
+        eventlet.sleep(0.1)
+        return {'battery_level': 90 + len(calls)}
+
+    assert read_battery() == {'battery_level': 91}
+    clock[0] += 40
+    # stale: served at once, refreshed in the background
+    assert read_battery() == {'battery_level': 91}
+    assert read_battery() == {'battery_level': 91}
+    eventlet.sleep(0.2)
+    assert len(calls) == 2
+    assert read_battery() == {'battery_level': 92}
+    clock[0] += 100
+    # past the stale window the caller waits for a fresh value
+    assert read_battery() == {'battery_level': 93}
+
+
+def test_age_of_served_values(clock):
+    @cache.cached(timeout=30, stale_ttl=60)
+    def read_battery():
+        return {'battery_level': 98}
+
+    @cache.cached(timeout=60)
+    def read_version():
+        return '1.0.1'
+
+    cache.reset_age()
+    assert cache.get_age() is None
+    read_battery()
+    read_version()
+    assert cache.get_age() == 0
+    clock[0] += 20
+    cache.reset_age()
+    read_version()
+    assert cache.get_age() == 20
+    clock[0] += 25
+    read_battery()
+    assert cache.get_age() == 45
+
+
+def test_falsy_values_are_cached(clock):
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_level():
+        calls.append(1)
+        return 0
+
+    assert read_level() == 0
+    assert read_level() == 0
+    assert len(calls) == 1
+    # not for the whole timeout: they are often failed reads
+    clock[0] += cache.DEFAULT_NEGATIVE_TTL + 1
+    assert read_level() == 0
+    assert len(calls) == 2
+
+
+def test_ignored_values_are_not_cached(clock):
+    calls = []
+
+    @cache.cached(timeout=60, ignore=[{}])
+    def read_network_info():
+        calls.append(1)
+        return {}
+
+    assert read_network_info() == {}
+    assert read_network_info() == {}
+    assert len(calls) == 2
+
+
+def test_negative_ttl(clock):
+    results = [False, True]
+
+    @cache.cached(timeout=60, negative_ttl=15)
+    def ping():
+        return results.pop(0)
+
+    assert ping() is False
+    clock[0] += 10
+    assert ping() is False
+    clock[0] += 10
+    assert ping() is True
+    clock[0] += 50
+    assert ping() is True
+    assert results == []
+
+
+def test_errors_cached_for_negative_ttl(clock):
+    calls = []
+
+    @cache.cached(timeout=60, negative_ttl=15)
+    def read_config():
+        calls.append(1)
+        raise IOError('port missing')
+
+    with pytest.raises(IOError):
+        read_config()
+    with pytest.raises(IOError):
+        read_config()
+    assert len(calls) == 1
+    clock[0] += 20
+    with pytest.raises(IOError):
+        read_config()
+    assert len(calls) == 2
+
+
+def test_errors_not_cached_by_default(clock):
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_config():
+        calls.append(1)
+        raise IOError('port missing')
+
+    for _ in range(2):
+        with pytest.raises(IOError):
+            read_config()
+    assert len(calls) == 2
+
+
+def test_lru_drop_in_for_simple_cache():
+    lru = cache.LRUCache()
+    assert lru.get('login_attempts/root') is None
+    assert lru.set('login_attempts/root', 0, timeout=60)
+    assert lru.get('login_attempts/root') == 0
+    lru.set('interface_speed/wan', (10, 20, 1000.0))
+    assert lru.get('interface_speed/wan') == (10, 20, 1000.0)
+    assert lru.delete('interface_speed/wan')
+    assert lru.get('interface_speed/wan') is None
+    assert lru.add('login_attempts/root', 5) is False
+    assert lru.inc('login_attempts/root') == 1
+
+
+def test_lru_expiry():
+    lru = cache.LRUCache()
+    with mock.patch('local_api.apiv1.cache.time') as fake_time:
+        fake_time.time.return_value = 1000.0
+        lru.set('login_attempts/root', 1, timeout=60)
+        fake_time.time.return_value = 1061.0
+        assert lru.get('login_attempts/root') is None
+        assert 'login_attempts' not in lru.get_stats()
+
+
+def test_lru_evicts_least_recently_used_within_namespace():
+    key = 'local_api.apiv1.sim/get_modem_network_info/{}'.format
+    value = 'x' * 100
+    size = len(key(0)) + len(
+        cache.pickle.dumps(value, cache.pickle.HIGHEST_PROTOCOL))
+    lru = cache.LRUCache(budget=size * 3)
+    lru.set('login_attempts/root', 3)
+    for imsi in range(3):
+        lru.set(key(imsi), value)
+    # touch the oldest entry so that the second one is evicted
+    assert lru.get(key(0)) == value
+    lru.set(key(3), value)
+    assert lru.get(key(1)) is None
+    assert lru.get(key(0)) == value
+    assert lru.get(key(3)) == value
+    # other namespaces keep their entries
+    assert lru.get('login_attempts/root') == 3
+    stats = lru.get_stats()['local_api.apiv1.sim/get_modem_network_info']
+    assert stats == dict(hits=3, misses=1, evictions=1, bytes=size * 3,
+                         entries=3)
+
+
+def test_lru_namespaces_only_while_holding_entries():
+    lru = cache.LRUCache()
+    # reads do not create namespaces
+    assert lru.get('login_attempts/root') is None
+    assert not lru.has('interface_speed/wan')
+    assert not lru.delete('interface_speed/wan')
+    assert lru.get_stats() == {}
+    lru.set('login_attempts/root', 1)
+    lru.set('login_attempts/admin', 2)
+    assert lru.get_stats()['login_attempts']['entries'] == 2
+    lru.delete('login_attempts/root')
+    lru.delete('login_attempts/admin')
+    assert lru.get_stats() == {}
+
+
+def test_lru_rejects_values_over_budget():
+    lru = cache.LRUCache(budget=64)
+    assert lru.set('interface_speed/wan', 'x' * 100) is False
+    assert lru.get('interface_speed/wan') is None
+
+
+@pytest.fixture
+def shared_cache(tmpdir):
+    return cache.SQLiteCache(str(tmpdir.join('cache.sqlite3')))
+
+
+def test_shared_cache_get_set(shared_cache):
+    assert shared_cache.get('login_attempts/root') is None
+    assert shared_cache.set('login_attempts/root', 0, timeout=60)
+    assert shared_cache.get('login_attempts/root') == 0
+    assert shared_cache.add('login_attempts/root', 5) is False
+    entry = cache.Entry(1000.0, {'battery_level': 98}, 30, 60, None)
+    shared_cache.set('local_api.apiv1.utils/get_battery_status/', entry)
+    assert shared_cache.get(
+        'local_api.apiv1.utils/get_battery_status/') == entry
+    assert shared_cache.delete('login_attempts/root')
+    assert shared_cache.get('login_attempts/root') is None
+
+
+def test_shared_cache_expiry(shared_cache):
+    with mock.patch('local_api.apiv1.cache.time') as fake_time:
+        fake_time.time.return_value = 1000.0
+        shared_cache.set('interface_speed/wan', (1, 2, 1000.0), timeout=60)
+        assert shared_cache.inc('login_attempts/root') == 1
+        fake_time.time.return_value = 1061.0
+        assert shared_cache.get('interface_speed/wan') is None
+        assert shared_cache.inc('login_attempts/root') == 2
+
+
+def test_shared_cache_budget(tmpdir):
+    shared_cache = cache.SQLiteCache(
+        str(tmpdir.join('cache.sqlite3')), budget=200)
+    for i in range(5):
+        shared_cache.set('interface_speed/{}'.format(i), 'x' * 50)
+    stats = shared_cache.get_stats()['interface_speed']
+    assert stats['bytes'] <= 200
+    assert stats['evictions'] == 5 - stats['entries']
+    assert shared_cache.get('interface_speed/4') == 'x' * 50
+
+
+def _count_logins(path):
+    shared_cache = cache.SQLiteCache(path)
+    for _ in range(50):
+        shared_cache.inc('login_attempts/root')
+
+
+def test_shared_cache_across_processes(tmpdir):
+    path = str(tmpdir.join('cache.sqlite3'))
+    workers = [multiprocessing.Process(target=_count_logins, args=(path,))
+               for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert cache.SQLiteCache(path).get('login_attempts/root') == 200
+
+
+def test_key_covers_kwargs_and_defaults(clock):
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_storage(mount_point='/storage/data', no_cache=False):
+        calls.append(mount_point)
+        return mount_point
+
+    assert read_storage() == '/storage/data'
+    assert read_storage('/storage/data') == '/storage/data'
+    assert read_storage(mount_point='/storage/data') == '/storage/data'
+    assert read_storage(mount_point='/mnt/usb') == '/mnt/usb'
+    assert calls == ['/storage/data', '/mnt/usb']
+    # control kwargs do not change the key
+    assert read_storage.make_key(no_cache=True) == read_storage.make_key()
+    assert read_storage.make_key().startswith(
+        'tests.test_cache/read_storage/')
+
+
+def test_invalidate(clock):
+    calls = []
+
+    @cache.cached(timeout=60)
+    def read_network_info(imsi, imei):
+        calls.append(imsi)
+        return {'imsi': imsi}
+
+    @cache.cached(timeout=60, namespace='power')
+    def read_power():
+        calls.append('power')
+        return {'mode': 'ALWAYS_ON'}
+
+    read_network_info('1', 'a')
+    read_network_info('2', 'a')
+    read_power()
+    cache.invalidate(read_network_info, '1', 'a')
+    read_network_info('1', 'a')
+    read_network_info('2', 'a')
+    assert calls == ['1', '2', 'power', '1']
+    cache.invalidate(read_network_info)
+    read_network_info('2', 'a')
+    read_power()
+    assert calls == ['1', '2', 'power', '1', '2']
+    cache.invalidate('power')
+    read_power()
+    assert calls == ['1', '2', 'power', '1', '2', 'power']
+
+
+def test_shared_cache_delete_namespace(shared_cache):
+    shared_cache.set('interface_speed/wan', 1)
+    shared_cache.set('login_attempts/root', 1)
+    shared_cache.delete_namespace('interface_speed')
+    assert shared_cache.get('interface_speed/wan') is None
+    assert shared_cache.get('login_attempts/root') == 1
+
+
+def test_invalidate_on_event(clock):
+    calls = []
+
+    @cache.cached(timeout=600, invalidate_on=[event.POWER_CHANGED])
+    def read_soc_settings():
+        calls.append(1)
+        return {'soc_on': 15}
+
+    read_soc_settings()
+    read_soc_settings()
+    event.publish(event.WIFI_CHANGED)
+    read_soc_settings()
+    assert len(calls) == 1
+    event.publish(event.POWER_CHANGED, mode='ALWAYS_ON')
+    read_soc_settings()
+    assert len(calls) == 2
+
+
+def test_snapshot_survives_restart(clock, tmpdir):
+    path = str(tmpdir.join('cache.snapshot'))
+    calls = []
+
+    @cache.cached(timeout=3600, persist=True)
+    def read_packages():
+        calls.append(1)
+        return ['moja', 'querymodem']
+
+    @cache.cached(timeout=60)
+    def read_battery():
+        return 98
+
+    with mock.patch('local_api.apiv1.cache.SNAPSHOT_PATH', path), \
+            mock.patch.dict('local_api.apiv1.cache._SNAPSHOT', clear=True):
+        read_packages()
+        read_battery()
+        # restart: empty cache, reload the snapshot 10 minutes later
+        cache._SNAPSHOT.clear()
+        clock[0] += 600
+        with mock.patch('local_api.apiv1.cache.CACHE', cache.LRUCache()):
+            assert cache.load_snapshot() == 1
+            cache.reset_age()
+            assert read_packages() == ['moja', 'querymodem']
+            assert len(calls) == 1
+            assert cache.get_age() == 600
+            # the restored entry keeps its remaining TTL
+            clock[0] += 3000
+            read_packages()
+            assert len(calls) == 2
+
+
+def test_snapshot_skips_expired_and_bad_files(clock, tmpdir):
+    path = tmpdir.join('cache.snapshot')
+    path.write('not json')
+    path.chmod(0o600)
+    assert cache.load_snapshot(str(path)) == 0
+    entry = cache.Entry(clock[0] - 120, 'old', 60, 0, None)
+    with mock.patch.dict('local_api.apiv1.cache._SNAPSHOT',
+                         {'ns/key': entry}, clear=True):
+        cache.save_snapshot(str(path))
+        assert cache._SNAPSHOT == {}
+    assert cache.load_snapshot(str(path)) == 0
+
+
+def test_snapshot_is_private(clock, tmpdir):
+    path = tmpdir.join('local-dashboard', 'cache.snapshot')
+    entry = cache.Entry(clock[0], {'os': 'LATEST'}, 3600, 0, None)
+    with mock.patch.dict('local_api.apiv1.cache._SNAPSHOT',
+                         {'ns/key': entry}, clear=True):
+        cache.save_snapshot(str(path))
+    assert path.dirpath().stat().mode & 0o777 == 0o700
+    assert path.stat().mode & 0o777 == 0o600
+    assert json.loads(path.read()) == {'ns/key': [clock[0], {'os': 'LATEST'},
+                                                  3600, 0]}
+    with mock.patch.dict('local_api.apiv1.cache._SNAPSHOT', clear=True), \
+            mock.patch('local_api.apiv1.cache.CACHE', cache.LRUCache()):
+        path.chmod(0o666)
+        assert cache.load_snapshot(str(path)) == 0
+        path.chmod(0o600)
+        assert cache.load_snapshot(str(path)) == 1
+
+
+def test_warm_up_continues_past_failures():
+    called = []
+
+    def fail():
+        raise KeyError('handshake')
+
+    cache.warm_up(fail, lambda: called.append(1))
+    assert called == [1]
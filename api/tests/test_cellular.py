@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import mock
+
+from local_api.apiv1 import cellular
+
+NOW = 1519776000  # 2018-02-28T00:00:00+0000
+HOME = cellular.Cell('WCDMA', 3, 378, 468785)
+ROAD = cellular.Cell('LTE', 3, 378, 468790)
+
+
+def test_rssi_to_dbm():
+    assert cellular.rssi_to_dbm('0') == -113
+    assert cellular.rssi_to_dbm('24') == -65
+    assert cellular.rssi_to_dbm('99') is None
+    assert cellular.rssi_to_dbm(False) is None
+
+
+def test_only_transitions_are_kept():
+    log = cellular.CellLog()
+    assert log.observe(HOME, NOW)
+    assert not log.observe(HOME, NOW + 30)
+    assert log.observe(ROAD, NOW + 60)
+    assert log.observe(HOME, NOW + 600)
+    assert [t['cell_id'] for t in log.get_transitions()] == [
+        468785, 468790, 468785]
+    # the cell served at the start of the range comes first
+    handovers = log.get_transitions(start=NOW + 90, end=NOW + 600)
+    assert handovers == [
+        dict(network_type='LTE', mnc=3, lac=378, cell_id=468790,
+             timestamp='2018-02-28T00:01:00+0000'),
+        dict(network_type='WCDMA', mnc=3, lac=378, cell_id=468785,
+             timestamp='2018-02-28T00:10:00+0000')
+    ]
+
+
+def test_transitions_are_stored_and_reloaded(tmpdir):
+    directory = str(tmpdir.join('cells'))
+    with mock.patch('local_api.apiv1.cellular.time') as clock:
+        clock.time.return_value = NOW + 60
+        clock.gmtime.side_effect = __import__('time').gmtime
+        log = cellular.CellLog(directory)
+        log.observe(HOME, NOW)
+        log.observe(HOME, NOW + 30)
+        log.observe(ROAD, NOW + 60)
+        path = os.path.join(directory, '2018-02-28.cells')
+        assert os.path.getsize(path) == 2 * cellular.RECORD.size
+        log._lock.close()
+
+        restarted = cellular.CellLog(directory)
+        assert restarted.current == ROAD
+        assert not restarted.observe(ROAD, NOW + 90)
+        restarted._lock.close()
+
+
+def test_sample():
+    log = cellular.CellLog()
+    with mock.patch('local_api.apiv1.cellular.CELLS', log), \
+            mock.patch('local_api.apiv1.cellular.modem.query_many',
+                       return_value=dict(signal='24', network_mode='WCDMA')), \
+            mock.patch('local_api.apiv1.cellular.modem.run',
+                       return_value='0,2,639,  3,017a,72731,306,10637'), \
+            mock.patch('local_api.apiv1.cellular.stats.record') as record:
+        assert cellular.sample() == dict(
+            rssi=-65, network_type='WCDMA', mnc=3, lac=378, cell_id=468785)
+        assert log.current == HOME
+        assert record.call_args[0][:2] == ('wan_rssi', -65)
+
+
+def test_sample_records_loss_of_service():
+    log = cellular.CellLog()
+    log.observe(HOME)
+    with mock.patch('local_api.apiv1.cellular.CELLS', log), \
+            mock.patch('local_api.apiv1.cellular.modem.query_many',
+                       return_value=dict(signal='99', network_mode='')), \
+            mock.patch('local_api.apiv1.cellular.modem.run',
+                       return_value=''), \
+            mock.patch('local_api.apiv1.cellular.stats.record') as record:
+        assert cellular.sample() == dict(rssi=None)
+        assert cellular.sample() == dict(rssi=None)
+        assert not record.called
+    assert [t['network_type'] for t in log.get_transitions()] == [
+        'WCDMA', cellular.STATE_UNKNOWN]
+    assert log.current == cellular.NO_SERVICE
+
+
+def test_failed_queries_are_not_transitions():
+    log = cellular.CellLog()
+    log.observe(HOME)
+    responses = [
+        # the serving cell fails to read
+        (dict(signal='24', network_mode='WCDMA'), False),
+        # the access technology fails to read
+        (dict(signal='24', network_mode=False),
+         '0,2,639,  3,017a,72731,306,10637'),
+        # the whole AT session fails
+        (dict(signal=False, network_mode=False), False),
+    ]
+    for info, cell_info in responses:
+        with mock.patch('local_api.apiv1.cellular.CELLS', log), \
+                mock.patch('local_api.apiv1.cellular.modem.query_many',
+                           return_value=info), \
+                mock.patch('local_api.apiv1.cellular.modem.run',
+                           return_value=cell_info), \
+                mock.patch('local_api.apiv1.cellular.stats.record'):
+            cellular.sample()
+    assert log.current == HOME
+    assert len(log.get_transitions()) == 1
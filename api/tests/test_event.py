@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from local_api.apiv1 import event
+
+
+def test_publish_calls_subscribers():
+    received = []
+
+    def handler(name, **data):
+        received.append((name, data))
+
+    event.subscribe(event.POWER_CHANGED, handler)
+    event.subscribe(event.POWER_CHANGED, handler)
+    try:
+        event.publish(event.POWER_CHANGED, mode='ALWAYS_ON')
+        event.publish(event.WIFI_CHANGED, wifi_id='WIFI1')
+    finally:
+        event.unsubscribe(event.POWER_CHANGED, handler)
+    event.publish(event.POWER_CHANGED, mode='NORMAL')
+    assert received == [(event.POWER_CHANGED, {'mode': 'ALWAYS_ON'})]
+
+
+def test_failing_handler_does_not_stop_others():
+    received = []
+
+    def failing(name, **data):
+        raise ValueError('boom')
+
+    def handler(name, **data):
+        received.append(name)
+
+    event.subscribe(event.SIM_CHANGED, failing)
+    event.subscribe(event.SIM_CHANGED, handler)
+    try:
+        event.publish(event.SIM_CHANGED, sim_id=1)
+    finally:
+        event.unsubscribe(event.SIM_CHANGED, failing)
+        event.unsubscribe(event.SIM_CHANGED, handler)
+    assert received == [event.SIM_CHANGED]
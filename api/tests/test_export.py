@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+from array import array
+
+import mock
+import pytest
+
+from local_api.apiv1 import export
+from local_api.apiv1 import stats
+
+NOW = 1519776000  # 2018-02-28T00:00:00+0000
+
+
+def decompress(parts):
+    return zlib.decompress(''.join(parts), 16 + zlib.MAX_WBITS)
+
+
+def export_series(start, end, resolution=None, file_format='csv'):
+    end, sources = export.resolve(['export_test'], start, end, resolution)
+    return export.export(sources, start, end, file_format)
+
+
+@pytest.fixture
+def series():
+    history = stats.History('export_test', 30)
+    for i in range(6):
+        history.add(NOW + 30 * i, 50 + i)
+    history.flush()
+    with mock.patch.dict('local_api.apiv1.stats._HISTORIES',
+                         {'export_test': history}), \
+            mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = NOW + 180
+        yield history
+
+
+def test_export_csv(series):
+    data = decompress(export_series(NOW, NOW + 60))
+    assert data == (
+        'metric,timestamp,value,min,max\n'
+        'export_test,2018-02-28T00:00:00+0000,50,,\n'
+        'export_test,2018-02-28T00:00:30+0000,51,,\n'
+        'export_test,2018-02-28T00:01:00+0000,52,,\n')
+    # the bucket being filled is left out
+    data = decompress(export_series(NOW, None, resolution=stats.MINUTE))
+    assert data.splitlines()[1:] == [
+        'export_test,2018-02-28T00:00:00+0000,50.5,50,51',
+        'export_test,2018-02-28T00:01:00+0000,52.5,52,53']
+
+
+def test_export_binary(series):
+    with mock.patch('local_api.apiv1.stats.CHUNK_SIZE', 4):
+        data = decompress(export_series(NOW, None, file_format='binary'))
+    assert data.startswith(export.MAGIC)
+    offset = len(export.MAGIC)
+    timestamps = array(stats.TIMESTAMP_TYPE)
+    values = array(stats.VALUE_TYPE)
+    while offset < len(data):
+        name, count, fields = export.BLOCK.unpack_from(data, offset)
+        assert (name.rstrip('\0'), fields) == ('export_test', 1)
+        offset += export.BLOCK.size
+        timestamps.fromstring(data[offset:offset + 4 * count])
+        values.fromstring(data[offset + 4 * count:offset + 8 * count])
+        offset += 8 * count
+    assert list(timestamps) == [NOW + 30 * i for i in range(6)]
+    assert list(values) == [50, 51, 52, 53, 54, 55]
+
+
+def test_byte_range_and_size(series):
+    def stream():
+        return export_series(NOW, None)
+
+    whole = ''.join(stream())
+    assert export.get_size('key', stream) == len(whole)
+    # remembered, not computed again
+    assert export.get_size('key', lambda: iter(['x'])) == len(whole)
+    for begin, end in [(0, 10), (5, len(whole)), (len(whole) - 1, len(whole))]:
+        assert ''.join(export.byte_range(stream(), begin, end)) == \
+            whole[begin:end]
+    parts = export.byte_range(iter(['abc', 'def', 'ghi']), 2, 7)
+    assert list(parts) == ['c', 'def', 'g']
+
+
+def test_resolve_pins_the_export(series):
+    end, sources = export.resolve(['export_test'], NOW, NOW + 600)
+    assert end == NOW + 150
+    assert export.fingerprint(sources) == 'export_test:30:%d-%d' % (
+        NOW, NOW + 150)
+    whole = ''.join(export.export(sources, NOW, end))
+    # pending samples change neither the range nor the bytes
+    series.add(NOW + 180, 56)
+    assert export.resolve(['export_test'], NOW, NOW + 600) == (end, sources)
+    assert ''.join(export.export(sources, NOW, end)) == whole
+    # once written, they change the fingerprint
+    series.flush()
+    end, sources = export.resolve(['export_test'], NOW, NOW + 600)
+    assert end == NOW + 180
+    assert export.fingerprint(sources).endswith('-%d' % (NOW + 180))
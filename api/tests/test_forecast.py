@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+
+from local_api.apiv1 import forecast
+from local_api.apiv1 import stats
+
+NOW = 1519776000  # 2018-02-28T00:00:00+0000
+GB = 1024 ** 3
+
+
+def test_slope_needs_samples():
+    trend = forecast.Trend(3600, min_samples=3)
+    trend.add(NOW, 10)
+    trend.add(NOW + 60, 20)
+    assert trend.slope is None
+    assert trend.time_to(100) is None
+    trend.add(NOW + 120, 30)
+    assert trend.slope == pytest.approx(1 / 6.0)
+
+
+def test_sliding_window_follows_the_latest_rate():
+    trend = forecast.Trend(3600)
+    # filling at 1 GB an hour, then 5 GB an hour
+    for minute in range(0, 600, 10):
+        rate = GB if minute < 300 else 5 * GB
+        previous = min(minute, 300) * GB / 60.0
+        trend.add(NOW + minute * 60,
+                  previous + max(0, minute - 300) * rate / 60.0)
+    assert len(trend.samples) == 6
+    assert trend.slope == pytest.approx(5 * GB / 3600.0)
+    used = trend.samples[-1][1]
+    assert trend.time_to(used + 10 * GB) == pytest.approx(7200)
+    # freeing space never fills up
+    assert trend.time_to(used - GB) is None
+
+
+def test_long_running_trend_stays_accurate():
+    trend = forecast.Trend(3600)
+    for i in range(24 * 365):
+        trend.add(NOW + i * 600, 500 * GB + i * 1000)
+    assert trend.slope == pytest.approx(1000 / 600.0)
+
+
+def test_load_from_history():
+    history = stats.History('forecast_test', 600)
+    for i in range(10):
+        history.add(NOW + i * 600, i * 600)
+    trend = forecast.Trend(3600)
+    with mock.patch.dict('local_api.apiv1.stats._HISTORIES',
+                         forecast_test=history), \
+            mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = NOW + 5400
+        assert forecast.load(trend, 'forecast_test', NOW + 5400) == 6
+    assert trend.slope == pytest.approx(1)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import mock
+
+from local_api.apiv1 import ledger
+
+HOUR = 1519776000  # 2018-02-28T00:00:00+0000
+PHONE = 'dc:a9:04:81:74:4b'
+LAPTOP = '3c:15:c2:aa:01:02'
+
+
+def client(mac, rx, tx, session='5b32003c00000001'):
+    return dict(mac_address=mac, rx_bytes=str(rx), tx_bytes=str(tx),
+                session_id=session)
+
+
+def test_account_deltas_and_resets():
+    book = ledger.Ledger()
+    book.account([client(PHONE, 1000, 100)], HOUR)
+    book.account([client(PHONE, 1500, 300)], HOUR + 10)
+    # reconnected: counters start again
+    book.account([client(PHONE, 200, 50, session='2')], HOUR + 20)
+    # a client that connects later is counted from the start
+    book.account(
+        [client(PHONE, 400, 50, session='2'), client(LAPTOP, 7000, 900)],
+        HOUR + 30)
+    assert book.usage() == {PHONE: [900, 250], LAPTOP: [7000, 900]}
+    assert book.top_talkers(limit=1) == [
+        dict(mac_address=LAPTOP, rx_bytes=7000, tx_bytes=900,
+             total_bytes=7900)
+    ]
+
+
+def test_hourly_buckets():
+    book = ledger.Ledger()
+    book.account([client(PHONE, 0, 0)], HOUR)
+    book.account([client(PHONE, 100, 10)], HOUR + 10)
+    book.account([client(PHONE, 300, 30)], HOUR + 3600)
+    assert book.client_usage(PHONE.upper()) == [
+        dict(timestamp='2018-02-28T00:00:00+0000', rx_bytes=100, tx_bytes=10),
+        dict(timestamp='2018-02-28T01:00:00+0000', rx_bytes=200, tx_bytes=20)
+    ]
+    assert book.usage(start=HOUR + 3600) == {PHONE: [200, 20]}
+    assert book.usage(end=HOUR + 3599) == {PHONE: [100, 10]}
+
+
+def test_buckets_are_stored_and_reloaded(tmpdir):
+    directory = str(tmpdir.join('ledger'))
+    with mock.patch('local_api.apiv1.ledger.time') as clock:
+        clock.time.return_value = HOUR + 3600
+        book = ledger.Ledger(directory)
+        book.account([client(PHONE, 0, 0)], HOUR)
+        book.account([client(PHONE, 100, 10)], HOUR + 10)
+        book.flush()
+        book.account([client(PHONE, 150, 20)], HOUR + 20)
+        book.account([client(PHONE, 150, 20)], HOUR + 3600)
+        path = os.path.join(directory, '2018-02-28.ledger')
+        # the open bucket at exit, then the rest when it closed
+        assert os.path.getsize(path) == 2 * ledger.RECORD.size
+
+        # another process does not store anything
+        other = ledger.Ledger(directory)
+        other.account([client(PHONE, 150, 20)], HOUR + 3610)
+        other.account([client(PHONE, 180, 20)], HOUR + 7200)
+        assert os.path.getsize(path) == 2 * ledger.RECORD.size
+        book._lock.close()
+        assert other._lock is None
+
+        restarted = ledger.Ledger(directory)
+        assert restarted.usage() == {PHONE: [150, 20]}
+        restarted._lock.close()
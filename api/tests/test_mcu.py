@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import eventlet
+import mock
+
+from local_api.apiv1 import mcu
+
+BATTERY = '{"soc":98,"iadp":0,"charging":0}'
+
+
+def test_query_runs_querymcu():
+    client = mcu.MCUClient(device='/dev/missing-mcu')
+    with mock.patch('local_api.apiv1.mcu._CLIENT', client):
+        with mock.patch('local_api.apiv1.mcu.run_command',
+                        side_effect=[BATTERY]) as run_command:
+            assert mcu.query('battery_extended') == BATTERY
+            run_command.assert_called_once_with(
+                ['querymcu', 'battery', '--extended'], output=True)
+
+
+def test_write_opens_the_port_for_the_write_only():
+    client = mcu.MCUClient(device='/dev/ttyACM0')
+    with mock.patch('local_api.apiv1.mcu._CLIENT', client), \
+            mock.patch('local_api.apiv1.mcu.serial.Serial') as open_port:
+        assert mcu.write('WRC15,1,5,0,22,0,0,1,120,1') is True
+        port = open_port.return_value
+        port.write.assert_called_once_with('WRC15,1,5,0,22,0,0,1,120,1')
+        assert port.close.called
+
+
+def test_write_waits_for_a_read():
+    client = mcu.MCUClient(device='/dev/ttyACM0')
+    calls = []
+
+    def querymcu(command, output):
+        calls.append('read')
+        eventlet.sleep(0.01)
+        calls.append('read done')
+        return BATTERY
+
+    def open_port(device, timeout):
+        calls.append('write')
+        return mock.Mock()
+
+    with mock.patch('local_api.apiv1.mcu._CLIENT', client), \
+            mock.patch('local_api.apiv1.mcu.run_command', querymcu), \
+            mock.patch('local_api.apiv1.mcu.serial.Serial', open_port):
+        reader = eventlet.spawn(mcu.query, 'battery')
+        eventlet.sleep(0)
+        assert mcu.write('WRC15,1,5,0,22,0,0,1,120,1') is True
+        assert reader.wait() == BATTERY
+    assert calls == ['read', 'read done', 'write']
+
+
+def test_write_fails_without_port():
+    client = mcu.MCUClient(device='/dev/missing-mcu')
+    with mock.patch('local_api.apiv1.mcu._CLIENT', client):
+        assert mcu.write('WRC15,1,5,0,22,0,0,1,120,1') is False
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+
+from local_api.apiv1 import modem
+
+from .fakes import FakeModem
+
+MODEM_RESPONSES = {
+    '+CPIN?': ['+CPIN: READY'],
+    '+COPS?': ['+COPS: 0,0,"Safaricom",2'],
+    '+CGSN': ['350089999084990'],
+    '+CIMI': ['639020000000001'],
+    '+CSQ': ['+CSQ: 24,99'],
+    '+CGMM': ['ME936'],
+    '^CHIPTEMP?': ['^CHIPTEMP: 392,392,65535,34,65535'],
+    '+XCELLINFO?': ['+XCELLINFO: 0,2,639,  3,017a,72731,306,10637, 52,  9,255'],
+}
+
+
+@pytest.fixture
+def fake_modem():
+    fake = FakeModem(MODEM_RESPONSES).start()
+    session = modem.ModemSession(device=fake.device, timeout=1)
+    with mock.patch('local_api.apiv1.modem._SESSION', session):
+        yield fake
+    session.close()
+    fake.stop()
+
+
+def test_query(fake_modem):
+    assert modem.query('check_pin') == 'READY'
+    assert modem.query('carrier') == 'Safaricom'
+    assert modem.query('imei') == '350089999084990'
+    assert modem.query('signal') == '24'
+    assert modem.query('temp') == '39.2'
+    assert modem.query('network_mode') == 'WCDMA'
+
+
+def test_port_stays_open(fake_modem):
+    modem.query('imei')
+    modem.query('imsi')
+    # echo is only disabled once, when the port is opened
+    assert fake_modem.lines == ['ATE0', 'AT+CGSN', 'AT+CIMI']
+
+
+def test_query_many_single_round_trip(fake_modem):
+    resp = modem.query_many('carrier', 'imei', 'imsi', 'model_id', 'signal')
+    assert resp == dict(carrier='Safaricom', imei='350089999084990',
+                        imsi='639020000000001', model_id='ME936', signal='24')
+    assert fake_modem.lines[1:] == ['AT+COPS?;+CGSN;+CIMI;+CGMM;+CSQ']
+
+
+def test_query_many_retries_failed_line(fake_modem):
+    del fake_modem.responses['+CIMI']
+    resp = modem.query_many('imei', 'imsi')
+    assert resp == dict(imei='350089999084990', imsi='ERROR')
+    assert fake_modem.lines[1:] == ['AT+CGSN;+CIMI', 'AT+CGSN', 'AT+CIMI']
+
+
+def test_run(fake_modem):
+    assert modem.run('AT+XCELLINFO?') == \
+        '0,2,639,  3,017a,72731,306,10637, 52,  9,255'
+    assert modem.run('AT+CFUN=4') == 'ERROR'
+
+
+def test_fallback_to_querymodem():
+    session = modem.ModemSession(device='/dev/does-not-exist')
+    with mock.patch('local_api.apiv1.modem._SESSION', session):
+        with mock.patch('local_api.apiv1.modem.run_command',
+                        side_effect=['ME936', '24', 'OK']) as run_command:
+            assert modem.query_many('model_id', 'signal') == dict(
+                model_id='ME936', signal='24')
+            assert modem.run('AT+CFUN=4') == 'OK'
+            assert run_command.call_args_list == [
+                mock.call(['querymodem', 'model_id'], output=True, shared=True),
+                mock.call(['querymodem', 'signal'], output=True, shared=True),
+                mock.call(['querymodem', 'run', 'AT+CFUN=4'], output=True)]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import eventlet
+import mock
+from eventlet.semaphore import Semaphore
+
+from local_api.apiv1 import process
+
+
+def test_run_command():
+    assert process.run_command(['echo', 'hello'], output=True) == 'hello'
+    assert process.run_command(['true']) is True
+    assert process.run_command(['false']) is False
+    assert process.run_command(['false'], output=True) is False
+    assert process.run_command(['/nonexistent/command']) is False
+
+
+def test_execute_with_input():
+    assert process.execute(['cat'], data='abc') == (0, 'abc', '')
+
+
+def test_command_timeout():
+    start = time.time()
+    assert process.run_command(['sleep', '5'], timeout=0.2) is False
+    assert time.time() - start < 2
+
+
+def test_concurrent_commands_overlap():
+    pool = eventlet.GreenPool()
+    start = time.time()
+    results = list(pool.imap(
+        lambda _: process.run_command(['sleep', '0.5']), range(4)))
+    assert results == [True] * 4
+    # run back to back these would take at least 2s
+    assert time.time() - start < 1.5
+
+
+def test_other_greenlets_run_while_waiting():
+    ticks = []
+
+    def tick():
+        for _ in range(5):
+            ticks.append(time.time())
+            eventlet.sleep(0.05)
+
+    start = time.time()
+    ticker = eventlet.spawn(tick)
+    assert process.run_command(['sleep', '0.5']) is True
+    ticker.wait()
+    assert len(ticks) == 5
+    assert ticks[-1] - start < 0.5
+
+
+def test_concurrency_cap():
+    with mock.patch('local_api.apiv1.process._SLOTS', Semaphore(1)):
+        pool = eventlet.GreenPool()
+        start = time.time()
+        list(pool.imap(
+            lambda _: process.run_command(['sleep', '0.3']), range(3)))
+        assert time.time() - start >= 0.9
+
+
+def test_run_in_thread():
+    assert process.run_in_thread(sum, [1, 2, 3]) == 6
+
+
+def test_shared_commands_run_once():
+    calls = []
+
+    def execute(command, timeout):
+        calls.append(command)
+        eventlet.sleep(0.1)
+        return (0, '{"soc":98}', '')
+
+    with mock.patch('local_api.apiv1.process.execute', side_effect=execute):
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda _: process.run_command(
+                ['querymcu', 'battery'], output=True, shared=True),
+            range(3)))
+    assert results == ['{"soc":98}'] * 3
+    assert calls == [['querymcu', 'battery']]
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from array import array
+
+import mock
+import pytest
+
+from local_api.apiv1 import stats
+
+NOW = 1519776000  # 2018-02-28T00:00:00+0000
+# seconds allowed to aggregate a year of 1-minute samples
+AGGREGATE_BUDGET = 1
+
+
+def test_ring_buffer_overwrites_oldest():
+    series = stats.RingBuffer(None, capacity=3, flush_interval=0)
+    for i in range(5):
+        series.append(100 + i, i)
+    timestamps, columns = series.read()
+    assert list(timestamps) == [102, 103, 104]
+    assert list(columns['value']) == [2, 3, 4]
+    timestamps, columns = series.read(103, 103)
+    assert list(timestamps) == [103]
+
+
+def test_ring_buffer_reads_pending_records():
+    series = stats.RingBuffer(None, capacity=3)
+    series.append(100, 1.5)
+    series.append(101, 2.5)
+    assert series._read_header() == (0, 0)
+    assert list(series.read(101)[1]['value']) == [2.5]
+    series.flush()
+    assert series._read_header() == (2, 2)
+    assert list(series.read()[1]['value']) == [1.5, 2.5]
+
+
+def test_ring_buffer_iter_read_matches_read():
+    series = stats.RingBuffer(None, capacity=10)
+    for i in range(13):
+        series.append(100 + i, i)
+        if i == 10:
+            series.flush()
+    for start, end in [(None, None), (104, 111), (90, 103), (112, 200)]:
+        chunks = list(series.iter_read(start, end, size=3))
+        assert all(len(timestamps) <= 3 for timestamps, _ in chunks)
+        timestamps, columns = series.read(start, end)
+        assert [t for ts, _ in chunks for t in ts] == list(timestamps)
+        assert [v for _, cs in chunks for v in cs['value']] == list(
+            columns['value'])
+
+
+def test_span_and_iter_read_of_written_records():
+    series = stats.RingBuffer(None, capacity=4)
+    assert series.span() == (None, None)
+    for i in range(6):
+        series.append(100 + i, i)
+        if i == 4:
+            series.flush()
+    # 105 is pending, 100 overwritten
+    assert series.span() == (101, 104)
+    assert series.span(102, 200) == (102, 104)
+    assert series.span(200) == (None, None)
+    chunks = list(series.iter_read(103, None, pending=False))
+    assert [t for ts, _ in chunks for t in ts] == [103, 104]
+    rollup = stats.Rollup(
+        stats.RingBuffer(None, 10, fields=stats.ROLLUP_FIELDS), 60)
+    for minute in range(3):
+        rollup.add(NOW + minute * 60, minute)
+    rollup.flush()
+    # the bucket of the last minute is still being filled
+    assert rollup.span() == (NOW, NOW + 60)
+    chunks = list(rollup.iter_read(pending=False))
+    assert [t for ts, _ in chunks for t in ts] == [NOW, NOW + 60]
+
+
+def test_ring_buffer_survives_restart(tmpdir):
+    path = str(tmpdir.join('stats', 'battery.ring'))
+    series = stats.RingBuffer(path, capacity=3)
+    for i in range(4):
+        series.append(100 + i, i)
+    series.flush()
+    assert os.path.getsize(path) == stats.HEADER.size + 3 * 8
+    series.close()
+
+    series = stats.RingBuffer(path, capacity=3)
+    assert list(series.read()[0]) == [101, 102, 103]
+    series.close()
+
+    # a change of layout starts afresh
+    series = stats.RingBuffer(path, capacity=3, fields=stats.ROLLUP_FIELDS)
+    assert len(series.read()[0]) == 0
+    series.close()
+
+
+def test_ring_buffer_single_writer(tmpdir):
+    path = str(tmpdir.join('battery.ring'))
+    writer = stats.RingBuffer(path, capacity=3)
+    reader = stats.RingBuffer(path, capacity=3)
+    assert writer.writable
+    assert not reader.writable
+    writer.append(100, 1)
+    reader.append(101, 2)
+    writer.flush()
+    assert list(reader.read()[0]) == [100]
+    writer.close()
+    reader.close()
+
+
+def test_rollup_buckets():
+    buffer = stats.RingBuffer(None, 10, fields=stats.ROLLUP_FIELDS)
+    rollup = stats.Rollup(buffer, 60)
+    for timestamp, value in [(0, 4), (30, 2), (59, 6), (60, 1), (150, 3)]:
+        rollup.add(timestamp, value)
+    timestamps, columns = rollup.read()
+    assert list(timestamps) == [0, 60, 120]
+    assert list(columns['min']) == [2, 1, 3]
+    assert list(columns['max']) == [6, 1, 3]
+    assert list(columns['avg']) == [4, 1, 3]
+    assert list(columns['count']) == [3, 1, 1]
+    # the open bucket is not stored yet
+    assert list(buffer.read()[0]) == [0, 60]
+    assert list(rollup.read(100)[0]) == [120]
+
+
+def test_history_selects_coarsest_sufficient_tier():
+    history = stats.History('battery', 30)
+    widths = [tier.width for tier in history.tiers]
+    assert widths == [30, stats.MINUTE, stats.HOUR]
+    with mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = NOW
+
+        def select(start, resolution=None):
+            return history.select(NOW - start, resolution=resolution).width
+
+        assert select(stats.HOUR) == 30
+        assert select(stats.DAY) == stats.MINUTE
+        assert select(stats.DAY, resolution=1) == 30
+        assert select(stats.DAY * 30) == stats.HOUR
+        # the raw samples are gone by then
+        assert select(stats.DAY * 2, resolution=1) == stats.MINUTE
+        assert select(stats.DAY * 365 * 10) == stats.HOUR
+
+
+def test_get_records():
+    history = stats.History('battery', 30)
+    with mock.patch.dict('local_api.apiv1.stats._HISTORIES',
+                         battery=history), \
+            mock.patch('local_api.apiv1.stats.time') as clock:
+        clock.time.return_value = NOW + 60
+        stats.record('battery', 3.7, timestamp=NOW)
+        stats.record('battery', 3.9, timestamp=NOW + 30)
+        assert stats.get_records('battery', NOW, resolution=30) == [
+            dict(timestamp='2018-02-28T00:00:00+0000', value=3.7),
+            dict(timestamp='2018-02-28T00:00:30+0000', value=3.9)
+        ]
+        assert stats.get_records('battery', NOW, resolution=60) == [
+            dict(timestamp='2018-02-28T00:00:00+0000', value=3.8, min=3.7,
+                 max=3.9)
+        ]
+    assert stats.parse_timestamp('2018-02-28T00:00:00+0000') == NOW
+    assert stats.parse_timestamp('1519776000') == NOW
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def engine(request):
+    if request.param == 'numpy':
+        if stats.numpy is None:
+            pytest.skip('numpy is not installed')
+        yield request.param
+    else:
+        with mock.patch('local_api.apiv1.stats.numpy', None):
+            yield request.param
+
+
+def test_aggregate_raw(engine):
+    timestamps = array('I', [0, 10, 20, 30, 130, 140])
+    columns = dict(value=array('f', [4, 2, 6, 8, 1, 3]))
+    windows, results = stats.aggregate(timestamps, columns, 0, 179, 60)
+    assert windows == [0, 2]
+    assert results == dict(min=[2, 1], max=[8, 3], avg=[5, 2], p95=[8, 3])
+
+
+def test_aggregate_rollups(engine):
+    timestamps = array('I', [0, 60, 120])
+    columns = dict(min=array('f', [1, 2, 5]), max=array('f', [3, 4, 9]),
+                   avg=array('f', [2, 3, 7]), count=array('f', [1, 3, 2]))
+    windows, results = stats.aggregate(
+        timestamps, columns, 0, 179, 120, ['min', 'max', 'avg'])
+    assert windows == [0, 1]
+    assert results == dict(min=[1, 5], max=[4, 9], avg=[2.75, 7])
+
+
+def test_aggregate_year_of_minutes_within_budget(engine):
+    minutes = 365 * 24 * 60
+    timestamps = array('I', xrange(0, minutes * 60, 60))
+    columns = dict(value=array('f', (i % 100 for i in xrange(minutes))))
+    began = time.time()
+    windows, results = stats.aggregate(
+        timestamps, columns, 0, minutes * 60 - 1, stats.DAY)
+    elapsed = time.time() - began
+    assert len(windows) == 365
+    assert results['p95'][0] == 94
+    assert elapsed < AGGREGATE_BUDGET
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import mock
+
+from local_api.apiv1 import event
+from local_api.apiv1 import telemetry
+
+
+def make_sampler(readings):
+    sampler = telemetry.Sampler()
+    sampler.register('battery', lambda: readings['battery'].pop(0), 30)
+    sampler.register('network', lambda: readings['network'].pop(0), 5)
+    return sampler
+
+
+def test_read_without_sampler_calls_reader():
+    readings = dict(battery=[1, 2], network=[])
+    sampler = make_sampler(readings)
+    assert sampler.read('battery') == 1
+    assert sampler.read('battery') == 2
+    assert 'battery' not in sampler.snapshot
+
+
+def test_sample_due_respects_intervals():
+    readings = dict(battery=[90, 80], network=['a', 'b', 'c'])
+    sampler = make_sampler(readings)
+    with mock.patch('local_api.apiv1.telemetry.time') as clock:
+        clock.time.return_value = 1000
+        assert sampler.sample_due() == 5
+        assert sampler.snapshot.as_dict() == dict(battery=90, network='a')
+        assert sampler.snapshot.version == 2
+        clock.time.return_value = 1005
+        assert sampler.sample_due() == 5
+        assert sampler.snapshot.as_dict() == dict(battery=90, network='b')
+        clock.time.return_value = 1030
+        sampler.sample_due()
+        assert sampler.snapshot.as_dict() == dict(battery=80, network='c')
+        assert sampler.snapshot.version == 5
+
+
+def test_failed_sample_keeps_last_reading():
+    readings = dict(battery=[90], network=['a'])
+    sampler = make_sampler(readings)
+    with mock.patch('local_api.apiv1.telemetry.time') as clock:
+        clock.time.return_value = 1000
+        sampler.sample_due()
+        clock.time.return_value = 1030
+        sampler.sample_due()
+    assert sampler.snapshot.as_dict() == dict(battery=90, network='a')
+
+
+def test_read_serves_snapshot_while_running():
+    readings = dict(battery=[90, 80], network=[])
+    sampler = make_sampler(readings)
+    sampler._thread = mock.Mock()
+    try:
+        assert sampler.read('battery') == 90
+        assert sampler.read('battery') == 90
+        assert readings['battery'] == [80]
+    finally:
+        sampler.stop()
+    assert len(sampler.snapshot.as_dict()) == 0
+
+
+def test_resample_on_change_event():
+    readings = dict(battery=[90, 80], network=[])
+    sampler = make_sampler(readings)
+    sampler.resample_on('battery', 'battery_changed')
+    sampler._thread = mock.Mock()
+    try:
+        assert sampler.read('battery') == 90
+        event.publish('other_changed')
+        assert sampler.read('battery') == 90
+        event.publish('battery_changed')
+        assert 'battery' not in sampler.snapshot
+        assert sampler.read('battery') == 80
+    finally:
+        sampler.stop()
+        event._SUBSCRIBERS.pop('battery_changed', None)
+
+
+def test_resample_reads_the_device_now():
+    readings = dict(battery=[90, 80], network=[])
+    sampler = make_sampler(readings)
+    # nothing to resample: reads go to the device
+    sampler.resample('battery')
+    assert readings['battery'] == [90, 80]
+    sampler._thread = mock.Mock()
+    try:
+        assert sampler.read('battery') == 90
+        sampler.resample('battery')
+        assert sampler.read('battery') == 80
+    finally:
+        sampler.stop()
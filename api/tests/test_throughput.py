@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import mock
+
+from local_api.apiv1 import throughput
+
+NET_DEV = '''Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:    6552      10    0    0    0     0          0         0     6552      10    0    0    0     0       0          0
+  eth0: 1000000    2000    0    0    0     0          0         0   250000    1500    0    0    0     0       0          0
+3g-wan:{rx}     100    0    0    0     0          0         0 {tx}     100    0    0    0     0       0          0
+'''
+
+IFNAMES = {'network.wan.ifname': '3g-wan', 'network.lan.ifname': 'eth0'}
+
+
+def test_parse_net_dev():
+    counters = throughput.parse_net_dev(NET_DEV.format(rx=5000, tx=700))
+    assert counters == {
+        'lo': (6552, 6552),
+        'eth0': (1000000, 250000),
+        '3g-wan': (5000, 700)
+    }
+
+
+def test_meter_smooths_rates():
+    meter = throughput.Meter('eth0')
+    assert meter.update(1000, 100, 0) is None
+    assert meter.update(2000, 600, 10) == (100, 50)
+    assert (meter.down, meter.up) == (100, 50)
+    meter.update(4000, 600, 20)
+    assert (meter.down, meter.up) == (130, 35)
+    # counters reset when the interface comes back up
+    assert meter.update(10, 10, 30) is None
+    assert (meter.down, meter.up) == (130, 35)
+
+
+def test_sample_connections():
+    throughput.reset()
+    now = [1000.0]
+    counters = [(10000, 2000), (60000, 4000)]
+    with mock.patch('local_api.apiv1.throughput.time') as clock, \
+            mock.patch('local_api.apiv1.throughput.uci.get',
+                       side_effect=lambda path: IFNAMES.get(path, False)), \
+            mock.patch('local_api.apiv1.throughput.stats.record') as record:
+        clock.time.side_effect = lambda: now[0]
+        for rx, tx in counters:
+            with mock.patch('local_api.apiv1.throughput.read_counters',
+                            return_value=throughput.parse_net_dev(
+                                NET_DEV.format(rx=rx, tx=tx))):
+                speeds = throughput.sample()
+            now[0] += 5
+    # up is transmitted, down received
+    assert speeds == {'wan': (400, 10000), 'lan': (0, 0)}
+    record.assert_any_call('wan_down', 10000, 1005.0)
+    record.assert_any_call('wan_up', 400, 1005.0)
+    throughput.reset()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import mock
+import pytest
+
+from local_api.apiv1 import uci
+
+NETWORK_CONFIG = """
+config interface 'loopback'
+	option ifname 'lo'
+	option proto 'static'
+
+config interface 'lan'
+	option ifname 'eth0'
+	option proto "dhcp"
+	list dns '8.8.8.8'
+	list dns '8.8.4.4'
+	# option gateway '10.0.0.1'
+
+config route
+	option target '10.1.0.0'
+"""
+NETWORK_STATE = """network.lan.up='1'
+network.lan.connected='1'
+network.eth0.connected='1'
+-network.loopback.proto
+"""
+
+
+@pytest.fixture
+def uci_dirs(tmpdir):
+    config_dir = tmpdir.mkdir('config')
+    state_dir = tmpdir.mkdir('state')
+    config_dir.join('network').write(NETWORK_CONFIG)
+    state_dir.join('network').write(NETWORK_STATE)
+    with mock.patch('local_api.apiv1.uci.CONFIG_DIR', str(config_dir)):
+        with mock.patch('local_api.apiv1.uci.STATE_DIR', str(state_dir)):
+            yield config_dir, state_dir
+
+
+def test_get(uci_dirs):
+    assert uci.get('network.lan') == 'interface'
+    assert uci.get('network.lan.proto') == 'dhcp'
+    assert uci.get('network.lan.dns') == '8.8.8.8 8.8.4.4'
+    assert uci.get('network.lan.gateway') is False
+    assert uci.get('network.@route[0].target') == '10.1.0.0'
+    assert uci.get('wireless.radio0') is False
+
+
+def test_state_overlay(uci_dirs):
+    assert uci.get('network.lan.up') == '1'
+    assert uci.get('network.lan.up', with_state=False) is False
+    assert uci.get('network.loopback.proto') is False
+    assert uci.get('network.loopback.proto', with_state=False) == 'static'
+
+
+def test_get_state_matches_uci_show(uci_dirs):
+    state = uci.get_state('network')
+    assert state['network.lan'] == 'interface'
+    assert state['network.lan.ifname'] == 'eth0'
+    assert state['network.eth0.connected'] == '1'
+    assert 'network.eth0' not in state
+    assert uci.get_state('network.lan.ifname', as_dict=False) == \
+        "network.lan.ifname='eth0'"
+    assert uci.get_state('network.wan') == {}
+    assert uci.get_state('network.lan.ifname', command='get',
+                         as_dict=False) == 'eth0'
+    assert uci.get_state('network.wan.ifname', command='get',
+                         as_dict=False) is False
+
+
+def test_package_reparsed_on_change(uci_dirs):
+    _, state_dir = uci_dirs
+    with mock.patch('local_api.apiv1.uci._parse_config',
+                    wraps=uci._parse_config) as parse:
+        uci.clear_cache()
+        assert uci.get('network.lan.up') == '1'
+        assert uci.get('network.lan.connected') == '1'
+        assert parse.call_count == 1
+        state_file = state_dir.join('network')
+        state_file.write("network.lan.up='0'\n")
+        stat = os.stat(str(state_file))
+        os.utime(str(state_file), (stat.st_atime, stat.st_mtime + 1))
+        assert uci.get('network.lan.up') == '0'
+        assert parse.call_count == 2
+
+
+def test_transaction_batches_changes(uci_dirs):
+    with mock.patch('local_api.apiv1.uci.run_batch',
+                    side_effect=[True, True]) as batch:
+        with uci.Transaction() as txn:
+            txn.set('network.lan.proto', 'static')
+            txn.set('network.lan.ipaddr', '10.0.0.1')
+            txn.delete('network.lan.dns')
+            txn.delete('network.lan.gateway')
+            txn.set('brck.active_sim', '1')
+        assert txn.committed
+        assert batch.call_args_list == [
+            mock.call([
+                "set network.lan.proto='static'",
+                "set network.lan.ipaddr='10.0.0.1'",
+                "delete network.lan.dns",
+                "set brck.active_sim='1'"]),
+            mock.call(['commit network', 'commit brck'])]
+
+
+def test_transaction_rolls_back(uci_dirs):
+    with mock.patch('local_api.apiv1.uci.run_batch',
+                    side_effect=[False, True]) as batch:
+        txn = uci.Transaction()
+        txn.set('network.lan.proto', "it's")
+        assert txn.commit() is False
+        assert not txn.committed
+        assert batch.call_args_list == [
+            mock.call(["set network.lan.proto='it'\\''s'"]),
+            mock.call(['revert network'])]
+
+
+def test_transaction_discarded_on_error(uci_dirs):
+    with mock.patch('local_api.apiv1.uci.run_batch') as batch:
+        with pytest.raises(ValueError):
+            with uci.Transaction() as txn:
+                txn.set('network.lan.proto', 'dhcp')
+                raise ValueError('validation failed')
+        assert not batch.called
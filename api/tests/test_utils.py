@@ -136,7 +136,7 @@ def test_get_signal_strength():
         chain(
             *[['ME936', v] for v in ['99', '0', '1', '30', '31', '255', '']]))
     with mock.patch(
-            'local_api.apiv1.utils.run_command', side_effect=_side_effect):
+            'local_api.apiv1.modem.run_command', side_effect=_side_effect):
         assert utils.get_signal_strength('wan') == 99
         assert utils.get_signal_strength('wan') == 0
         assert utils.get_signal_strength('wan') == 1
@@ -148,7 +148,7 @@ def test_get_signal_strength():
         chain(
             *[['MU736', v] for v in ['99', '0', '1', '30', '31', '255', '']]))
     with mock.patch(
-            'local_api.apiv1.utils.run_command', side_effect=_side_effect):
+            'local_api.apiv1.modem.run_command', side_effect=_side_effect):
         assert utils.get_signal_strength('wan') == 0
         assert utils.get_signal_strength('wan') == 0
         assert utils.get_signal_strength('wan') == 3
@@ -159,7 +159,7 @@ def test_get_signal_strength():
     _side_effect = list(
         chain(*[[None, v] for v in ['99', '0', '1', '30', '31', '255', '']]))
     with mock.patch(
-            'local_api.apiv1.utils.run_command', side_effect=_side_effect):
+            'local_api.apiv1.modem.run_command', side_effect=_side_effect):
         assert utils.get_signal_strength('wan') == 0
         assert utils.get_signal_strength('wan') == 0
         assert utils.get_signal_strength('wan') == 3
@@ -169,14 +169,23 @@ def test_get_signal_strength():
         assert utils.get_signal_strength('wan') == 0
 
 
-def test_get_soc_settings():
+def test_read_soc_settings():
     with mock.patch(
-            'local_api.apiv1.soc.run_command',
+            'local_api.apiv1.mcu.run_command',
             side_effect=[DUMMY_SOC_RESPONSE]):
-        settings = soc.get_soc_settings()
+        settings = soc.read_soc_settings()
         assert settings == EXPECTED_SOC_SETTINGS
 
 
+def test_read_battery_temperature():
+    with mock.patch(
+            'local_api.apiv1.mcu.run_command',
+            side_effect=['{"temperature":31.5}', '{"temperature":32}', '']):
+        assert soc.read_battery_temperature() == 31.5
+        assert soc.read_battery_temperature() == 32.0
+        assert soc.read_battery_temperature() == soc.STATE_UNKNOWN
+
+
 @pytest.mark.parametrize("payload,valid,out", SOC_SCENARIOS)
 def test_validate_soc_settings(payload, valid, out):
     orig = copy(payload)
@@ -195,7 +204,7 @@ def test_soc_command():
 
 def test_get_firmware_version():
     with mock.patch(
-            'local_api.apiv1.soc.run_command',
+            'local_api.apiv1.mcu.run_command',
             side_effect=[DUMMY_VERSION_RESPONSE]):
         version = soc.get_firmware_version()
         assert version == EXPECTED_FIRMWARE_VERSION
@@ -228,18 +237,18 @@ def test_get_modem_net_info():
     expected_01 = dict(
         mnc=' 23', net_type='UMTS (3G)', cell_id=468785, lac=378)
     with mock.patch(
-            'local_api.apiv1.sim.run_command',
+            'local_api.apiv1.modem.run_command',
             side_effect=[_xcell_info, _xcell_info_01, '']):
         assert sim.get_modem_network_info() == expected
         assert sim.get_modem_network_info() == expected_01
         assert sim.get_modem_network_info() == {}
 
 
-def test_get_battery():
+def test_read_battery():
     with mock.patch(
-            'local_api.apiv1.utils.run_command',
+            'local_api.apiv1.mcu.run_command',
             side_effect=[BAT_SIDE_EFFECT]):
-        assert utils.get_battery_status(no_cache=False) == EXPECTED_BAT_CONFIG
+        assert utils.read_battery_status() == EXPECTED_BAT_CONFIG
 
 
 def test_get_connected_clients():
@@ -263,4 +272,28 @@ def test_get_modem_status():
             side_effect=[DUMMY_MODEM_STATUS]):
 
         modem_status = utils.get_modem_status()
-        assert modem_status == EXPECTED_MODEM_STATUS
\ No newline at end of file
+        assert modem_status == EXPECTED_MODEM_STATUS
+
+def test_storage_resampled_on_change():
+    full = dict(total_space=100, used_space=100, available_space=0)
+    empty = dict(total_space=100, used_space=0, available_space=100)
+    sampler = utils.telemetry.SAMPLER
+    with mock.patch('local_api.apiv1.utils.read_storage_status',
+                    side_effect=[full, empty]), \
+            mock.patch.object(sampler, '_thread', mock.Mock()):
+        try:
+            assert utils.get_storage_status()['used_space'] == 100
+            assert utils.get_storage_status()['used_space'] == 100
+            utils.event.publish(utils.event.STORAGE_CHANGED, login='ftp')
+            assert utils.get_storage_status()['used_space'] == 0
+        finally:
+            sampler.snapshot.clear()
+
+
+def test_storage_of_other_mount_point():
+    other = dict(total_space=10, used_space=5, available_space=5)
+    with mock.patch('local_api.apiv1.utils.read_storage_status',
+                    return_value=other) as read:
+        assert utils.get_storage_status('/mnt/usb') == dict(
+            other, fill_rate=None, time_to_full=None)
+        read.assert_called_once_with('/mnt/usb')
@@ -5,6 +5,7 @@ import Loading from './Loading';
 import Container from './Container';
 import Header from './Header';
 import API from '../utils/API';
+import Sync from '../utils/Sync';
 
 import IconNoConnection from '../media/icons/icon_ethernet-white.svg';
 import IconEthernet from '../media/icons/icon_ethernet-white.svg';
@@ -46,7 +47,7 @@ class Dashboard extends Component {
       }
     };
     this.socket = io('/dashboard', opts);
-    this.socket.on('system', (data) => {
+    Sync.subscribe(this.socket, 'system', (data) => {
       this.setState({
         system: data
       });
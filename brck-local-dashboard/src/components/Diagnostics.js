@@ -4,6 +4,7 @@ import io from 'socket.io-client';
 import { AlertError, AlertWarning } from './Alerts';
 
 import API from '../utils/API';
+import Sync from '../utils/Sync';
 import Container from './Container';
 import Loading from './Loading';
 import Header from './Header';
@@ -44,9 +45,12 @@ class Diagnostics extends Component {
       }
     };
     this.socket = io('/diagnostics', opts);
-    this.socket.on('diagnostics', (data) => {
+    // the clients are pushed keyed by MAC address
+    Sync.subscribe(this.socket, 'diagnostics', (data) => {
+      const clients = Object.keys(data.clients).sort().map(
+        (mac) => data.clients[mac]);
       this.setState({
-        diagnostics: data
+        diagnostics: Object.assign({}, data, { clients: clients })
       });
     }); 
   }
@@ -0,0 +1,74 @@
+// Keeps a copy of the state pushed by the API over socket.io.
+//
+// The whole state comes as `<event>` with its sequence number, then the
+// changes as `<event>_patch`: the keys changed (nested objects patched key
+// by key) and the paths of the keys removed. A missed patch is detected
+// from the sequence numbers and the whole state asked for again, and
+// again every RESYNC_TIMEOUT until it comes.
+
+const RESYNC_TIMEOUT = 10000;
+
+function applyPatch(state, patch, removed) {
+    const next = Object.assign({}, state);
+    Object.keys(patch).forEach((key) => {
+        const value = patch[key];
+        const current = next[key];
+        if (isObject(value) && isObject(current)) {
+            next[key] = applyPatch(current, value, []);
+        } else {
+            next[key] = value;
+        }
+    });
+    (removed || []).forEach((path) => {
+        let parent = next;
+        path.slice(0, -1).forEach((key) => {
+            parent[key] = Object.assign({}, parent[key]);
+            parent = parent[key];
+        });
+        delete parent[path[path.length - 1]];
+    });
+    return next;
+}
+
+function isObject(value) {
+    return value !== null && typeof value === 'object' && !Array.isArray(value);
+}
+
+const Sync = {
+    applyPatch: applyPatch,
+    subscribe: (socket, event, callback) => {
+        let state = null;
+        let seq = null;
+        let resyncTimer = null;
+        const stopResync = () => {
+            clearTimeout(resyncTimer);
+            resyncTimer = null;
+        };
+        const resync = () => {
+            socket.emit('resync');
+            // the server may have failed to compute the state
+            resyncTimer = setTimeout(resync, RESYNC_TIMEOUT);
+        };
+        socket.on(event, (message) => {
+            state = message.state;
+            seq = message.seq;
+            stopResync();
+            callback(state);
+        });
+        socket.on(event + '_patch', (message) => {
+            if (state === null || message.seq !== seq + 1) {
+                if (resyncTimer === null) {
+                    resync();
+                }
+                return;
+            }
+            state = applyPatch(state, message.patch, message.removed);
+            seq = message.seq;
+            callback(state);
+        });
+        // the whole state is sent again on reconnecting
+        socket.on('disconnect', stopResync);
+    }
+}
+
+export default Sync;